@@ -1,14 +1,27 @@
-import threading
 import logging
 import random
-import pygame
+import queue
 import socket
 import json
+import time
 
-import gui_text
-import ip_connection_screen as connect
+# For logging how long the window takes to show up. Set before pygame and the game's
+# modules are imported, since importing them is a large part of starting up.
+STARTED = time.perf_counter()
 
-from networking import send, receive
+import pygame  # noqa: E402
+
+import gui_text  # noqa: E402
+import ip_connection_screen as connect  # noqa: E402
+
+from frames import FrameEncoder, BoardDecoder, SNAPSHOT, INPUT  # noqa: E402
+from interpolation import OpponentView  # noqa: E402
+from timestep import FixedTimestep, TurnQueue  # noqa: E402
+from simulation import SnakeState  # noqa: E402
+from renderer import board_cells, cached_background, cell_rect, grid_slots, layer_class  # noqa: E402
+
+from networking import ConnectionLost, NetworkWorker, get_connection, negotiate, receive  # noqa: E402
+from protocol import SUPPORTED_PROTOCOLS, PROTOCOL_JSON, SPECTATOR  # noqa: E402
 
 
 logging.basicConfig(
@@ -21,8 +34,7 @@ logging.basicConfig(
 logger = logging.getLogger()
 logger.setLevel(20)
 
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-client_socket.settimeout(10)
+client_socket = None  # created by main() once the window is up
 
 HEADERSIZE = 10
 
@@ -34,12 +46,35 @@ with open("screen_sizes.json") as f:
 
 GUI = "small" if SETTINGS.get("small_gui") else "large"
 
+# Protocol versions offered to the server, in order of preference
+PROTOCOLS = SUPPORTED_PROTOCOLS if SETTINGS.get("binary_protocol", True) else (PROTOCOL_JSON,)
+
+# Spectators watch matches instead of playing, which needs a server with server_mode set to asyncio
+ROLE = SPECTATOR if SETTINGS.get("spectate") else None
+
+# Ask for snapshots over UDP, which the server only sends when it runs the game
+UDP = SETTINGS.get("udp", False) and ROLE is None
+
 WIDTH = SIZES[GUI]["width"]
 PLAYER_OFFSET = SIZES[GUI]["player_offset"]
 OPPONENT_OFFSET = SIZES[GUI]["opponent_offset"]
 HEIGHT = SIZES[GUI]["height"]
 
-FONT = pygame.font.SysFont("Calibri Light", 30)
+# Fonts are loaded on first use, see gui_text.font
+FONT_SIZE = 30
+END_FONT_SIZE = 40
+
+# How boards are drawn: "cells" draws a rect per cell, "array" draws whole boards from numpy arrays.
+# main() picks the class after the connection screen is up, since numpy is slow to import
+RENDERER = SETTINGS.get("renderer", "cells")
+BOARD_LAYER = None
+
+# Boards per row when there are several opponents, 0 for a square grid
+OPPONENT_COLUMNS = SETTINGS.get("opponent_columns", 0)
+OPPONENT_GAP = 10  # pixels between opponent boards
+
+RECONNECT_INTERVAL = 0.5  # seconds between attempts to reconnect to a game after the connection dropped
+RECONNECT_TIMEOUT = 2  # seconds to wait for the server on each attempt
 
 SNAKE_COLOR = SETTINGS["snake_color"]
 APPLE_COLOR = SETTINGS["apple_color"]
@@ -50,96 +85,88 @@ ENDGAME_MESSAGES = {
     "Client disconnected": "Enemy left."
 }
 
+# Results sent by a server that runs the game, from this player's point of view
+RESULT_MESSAGES = {
+    "won": ("You won with a score of {score}!", (0, 255, 0)),
+    "lost": ("You lost with a score of {score}.", (255, 0, 0)),
+    "draw": ("Draw with a score of {score}.", (255, 255, 255)),
+    "left": ("Enemy left.", (255, 255, 255))
+}
+
+# A player's relayed result, from a spectator's point of view
+SPECTATOR_MESSAGES = {
+    "won": "Player {player} won!",
+    "lost": "Player {player} lost.",
+    "Client disconnected": "Player {player} left."
+}
 
-pygame.init()
+KEY_DIRECTIONS = {
+    pygame.K_LEFT: (-1, 0),
+    pygame.K_RIGHT: (1, 0),
+    pygame.K_UP: (0, -1),
+    pygame.K_DOWN: (0, 1)
+}
 
 
 class Cube:
+    __slots__ = ("x", "y", "color")
+
     def __init__(self, x, y, color):
         self.x = x
         self.y = y
         self.color = color
 
     def draw(self, surface, board_size, y_offset) -> None:
-        if self.x < 0 or self.x >= board_size or self.y < 0 or self.y >= board_size:
-            return
-
-        dist = WIDTH // board_size
+        rect = cell_rect(self.x, self.y, board_size, y_offset, WIDTH)
 
-        x = self.x
-        y = self.y
+        if rect is not None:
+            pygame.draw.rect(surface, self.color, rect)
 
-        pygame.draw.rect(surface, self.color, (x * dist + 1, y * dist + y_offset + 1, dist - 2, dist - 2))
 
+"""
+The snake rules from simulation.py, with keyboard input and drawing.
+"""
+class Snake(SnakeState):
+    def __init__(self, start, board_size):
+        super().__init__(start, board_size)
+        self.turns = TurnQueue()
 
-class Snake:
-    def __init__(self, default_coords):
-        self.coords = [Cube(coord[0], coord[1], SNAKE_COLOR) for coord in default_coords]
-        self.dir = (0, 0)
-        self.pop = True  # pop the end of the snake when moving, used for eating an apple
-        self.prev_frame_dir = (0, 0)
-
+    """
+    Handles the window's events, queueing a turn for every arrow key press. Key presses
+    are read as events rather than by checking which keys are held, so a key that is
+    pressed and released between two ticks still counts.
+    """
     def get_input(self) -> None:
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 exit()
 
-        keys = pygame.key.get_pressed()
-
-        if keys[pygame.K_LEFT] and self.prev_frame_dir != (1, 0):
-            self.dir = (-1, 0)
-
-        elif keys[pygame.K_RIGHT] and self.prev_frame_dir != (-1, 0):
-            self.dir = (1, 0)
-
-        elif keys[pygame.K_UP] and self.prev_frame_dir != (0, 1):
-            self.dir = (0, -1)
-
-        elif keys[pygame.K_DOWN] and self.prev_frame_dir != (0, -1):
-            self.dir = (0, 1)
-
-    def check_apple_eaten(self, apple) -> bool:
-        apple_x, apple_y = apple.get_xy()
+            if event.type == pygame.KEYDOWN and event.key in KEY_DIRECTIONS:
+                self.turns.push(KEY_DIRECTIONS[event.key], self.dir)
 
-        if self.coords[-1].x == apple_x and self.coords[-1].y == apple_y:
-            self.pop = False
-            return True
-
-        return False
+    """
+    Takes the next queued turn, once per tick before moving.
+    Returns: whether the snake turned
+    """
+    def next_turn(self) -> bool:
+        direction = self.turns.pop()
 
-    def move(self) -> None:
-        self.coords.append(Cube(self.coords[-1].x + self.dir[0],
-                                self.coords[-1].y + self.dir[1],
-                                SNAKE_COLOR))
+        if direction is None:
+            return False
 
-        if self.pop:
-            self.coords.pop(0)
+        old_dir = self.dir
+        self.turn(direction)
 
-        self.pop = True
-        self.prev_frame_dir = self.dir
+        return self.dir != old_dir
 
     def draw_snake(self, surface, board_size, y_offset=0) -> None:
-        for cube in self.coords:
-            cube.draw(surface, board_size, y_offset)
-
-    def won(self, win_len) -> bool:
-        return len(self.coords) >= win_len
-
-    def lost(self, board_size) -> bool:
-        head = self.coords[-1]
+        cube = Cube(0, 0, SNAKE_COLOR)
 
-        if head.x >= board_size or head.x < 0 or head.y >= board_size or head.y < 0:
-            return True
-
-        for i, block in enumerate(self.coords):
-            if i == len(self.coords) - 1:  # skip the head
-                continue
-
-            if block.x == head.x and block.y == head.y:  # if a block intersects the head
-                return True
-
-        return False
+        for x, y in self.coords:
+            cube.x = x
+            cube.y = y
+            cube.draw(surface, board_size, y_offset)
 
 
 class Apple:
@@ -163,110 +190,260 @@ class Apple:
         return self.cube.x, self.cube.y
 
     """
-    Find new coords for the apple
+    Find new coords for the apple. Leaves the apple where it is if the snake fills the board.
     
-    snake: the snake Cube object array
+    snake: the Snake object
     board_size: The width of the board (height is the same as the width)
     """
     def regenerate_coords(self, snake, board_size: int) -> None:
-        while True:
-            x = random.randint(0, board_size - 1)
-            y = random.randint(0, board_size - 1)
+        cell = snake.coords.random_free_cell(random)
 
-            for block in snake.coords:
-                if block.x == x and block.y == y:
-                    break
-
-            else:  # nobreak
-                self.cube.x = x
-                self.cube.y = y
-                return
+        if cell is not None:
+            self.cube.x, self.cube.y = cell
 
 
 class Game:
-    def __init__(self, surface):
-        self.board_size = receive(client_socket)
-        self.speed = receive(client_socket)
-        self.apple_goal = receive(client_socket)
+    def __init__(self, surface, network):
+        self.network = network  # NetworkWorker for client_socket
+
+        self.board_size = network.get()
+        self.speed = network.get()
+        self.apple_goal = network.get()
+
+        self.tick_length = (self.speed + 1) / 60  # the snake moves once every speed + 1 frames at 60 fps
+
+        # Servers that answered the hello say how the match is played
+        self.match_info = network.get() if get_connection(client_socket).negotiated else {"mode": "relay"}
+        self.authoritative = self.match_info["mode"] == "authoritative"
+        self.player_index = self.match_info.get("player", 0)
+        self.players = self.match_info.get("players", 2)
 
-        self.snake = Snake([(self.board_size // 2, self.board_size // 2)])
+        # Games the server runs can be rejoined with the session token after the connection drops
+        self.session = self.match_info.get("session")
+        self.resume_timeout = self.match_info.get("resume_timeout", 0)
+        self.server_address = client_socket.getpeername()
+
+        self.snake = Snake((self.board_size // 2, self.board_size // 2), self.board_size)
         self.apple = Apple(2, 2)
 
-        self.opponent_board = []
+        self.encoder = FrameEncoder(SNAKE_COLOR)
+        self.opponents = [BoardDecoder() for _ in range(self.players - 1)]  # the other players' boards, in player order
+        self.opponent_result = None  # "won", "lost" or "Client disconnected" once the opponent's game ended
+
+        self.own = BoardDecoder()  # this player's board, when the server runs the game
+
+        # Smooth mode: the local snake never waits for the opponent's frame, and the opponent is
+        # drawn every frame from a buffer of received boards
+        self.smooth = SETTINGS.get("smooth_opponent", False) and not self.authoritative
+        self.opponent_view = OpponentView(self.tick_length)
+
+        if self.smooth:
+            self.opponents[0] = self.opponent_view.board
+
+        self.opponent = self.opponents[0]  # the only opponent in relayed games
 
         self.surface = surface
 
-        self.your_board_text = gui_text.Text("Your board:", FONT, (255, 255, 255), (60, PLAYER_OFFSET // 2))
-        self.opponent_board_text = gui_text.Text("Enemy board:", FONT, (255, 0, 0), (70, HEIGHT - WIDTH - 30))
-        self.score_text = gui_text.Text("Score: 1", FONT, (255, 255, 255), (WIDTH - 70, PLAYER_OFFSET // 2))
-        self.opponent_score_text = gui_text.Text("Enemy Score: 1", FONT, (255, 0, 0),
+        self.your_board_text = gui_text.Text("Your board:", gui_text.font(FONT_SIZE), (255, 255, 255), (60, PLAYER_OFFSET // 2))
+        self.opponent_board_text = gui_text.Text("Enemy board:", gui_text.font(FONT_SIZE), (255, 0, 0), (70, HEIGHT - WIDTH - 30))
+        self.score_text = gui_text.Text("Score: 1", gui_text.font(FONT_SIZE), (255, 255, 255), (WIDTH - 70, PLAYER_OFFSET // 2))
+        self.opponent_score_text = gui_text.Text("Enemy Score: 1", gui_text.font(FONT_SIZE), (255, 0, 0),
                                                  (WIDTH - 70, OPPONENT_OFFSET - 30))
 
+        self.make_layers((self.board_size, len(self.opponents)))
+        self.dirty = []  # rects drawn since the last display update
+
+    """
+    Lays out the boards: this player's board at PLAYER_OFFSET and the other boards in a grid
+    at OPPONENT_OFFSET. The grids and labels are drawn once per layout, and each frame only
+    redraws what changed.
+
+    background_key: identifies the layout and labels for cached_background()
+    """
+    def make_layers(self, background_key) -> None:
+        self.opponent_slots = grid_slots(len(self.opponents), OPPONENT_COLUMNS, WIDTH, OPPONENT_GAP)
+        self.background = cached_background(background_key, (WIDTH, HEIGHT), self.draw_background)
+
+        self.player_layer = BOARD_LAYER(self.surface, self.background, self.board_size, PLAYER_OFFSET, WIDTH)
+        self.opponent_layers = [BOARD_LAYER(self.surface, self.background, self.board_size, OPPONENT_OFFSET + y, size, x)
+                                for x, y, size in self.opponent_slots]
+        self.opponent_layer = self.opponent_layers[0]
+
     """
     Draw the grid for the snake board.
     
     y_offset (optional parameter): the y offset of the board, higher = lower on the screen
+    surface (optional parameter): the surface to draw on, defaults to the window
+    x_offset (optional parameter): the x offset of the board
+    width (optional parameter): the width of the board, defaults to the window's width
     """
-    def draw_grid(self, y_offset=0) -> None:
-        size_between = WIDTH // self.board_size
+    def draw_grid(self, y_offset=0, surface=None, x_offset=0, width=WIDTH) -> None:
+        surface = surface or self.surface
+        size_between = width // self.board_size
 
-        x = 0
+        x = x_offset
         y = y_offset
 
         for _ in range(self.board_size + 1):
             # Draw vertical lines
-            pygame.draw.line(self.surface, (100, 100, 100),
+            pygame.draw.line(surface, (100, 100, 100),
                              (x, y_offset),
                              (x, self.board_size * size_between + y_offset))
 
             # Draw horizontal lines
-            pygame.draw.line(self.surface, (100, 100, 100), (0, y), (WIDTH, y))
+            pygame.draw.line(surface, (100, 100, 100), (x_offset, y), (x_offset + width, y))
 
             x += size_between
             y += size_between
 
     """
-    Give essential data for the snake position and apple position to the server
+    Draws everything that stays the same through a game: the grids and the board labels
+    """
+    def draw_background(self, surface) -> None:
+        surface.fill((0, 0, 0))
+
+        self.draw_grid(PLAYER_OFFSET, surface)
+
+        # Smaller boards leave a few pixels of their slot unused, which the lines stop short of
+        for x, y, size in self.opponent_slots:
+            self.draw_grid(OPPONENT_OFFSET + y, surface, x, size - size % self.board_size if size < WIDTH else size)
+
+        self.your_board_text.draw(surface)
+        self.opponent_board_text.draw(surface)
+
+    """
+    Draws the background and the score over the whole window, before the first frame
+    """
+    def draw_first_frame(self) -> None:
+        self.surface.blit(self.background, (0, 0))
+        self.score_text.draw(self.surface)
+        self.opponent_score_text.draw(self.surface)
+
+        self.player_layer.clear()
+
+        for layer in self.opponent_layers:
+            layer.clear()
+
+        self.dirty = []
+
+        pygame.display.update()
+
+    """
+    Shows the rects drawn since the last call
+    """
+    def update_display(self) -> None:
+        pygame.display.update(self.dirty)
+        self.dirty = []
+
+    """
+    Give what changed in the snake position and apple position since the last tick to the server
     """
     def send_screen_info(self) -> None:
-        pos_data = [(cube.x, cube.y, SNAKE_COLOR) for cube in self.snake.coords]
-        pos_data.insert(0, (self.apple.cube.x, self.apple.cube.y, (255, 0, 0)))
-        send(pos_data, client_socket)
+        self.network.send(self.encoder.encode(self.snake.coords, self.apple.get_xy()))
 
     """
-    Receive the other player's board
+    Receive the other player's board frame and apply it to the opponent board.
+    Keeps the last board if nothing arrives within timeout seconds.
     """
-    def get_other_board(self) -> None:
-        self.opponent_board = receive(client_socket)
+    def get_other_board(self, timeout=5) -> None:
+        try:
+            packet = self.network.get(timeout)
+
+        except queue.Empty:
+            logging.warning("No board from the opponent")
+            return
+
+        self.handle_opponent_packet(packet)
 
     """
-    Draws the opponent board at the offest OPPONENT_OFFEST. This can be configured in screen_sizes.json.
+    Applies a frame to the opponent board, or records the opponent's result.
+    """
+    def handle_opponent_packet(self, packet) -> None:
+        if type(packet) == str:
+            self.opponent_result = packet
+
+        elif self.smooth:
+            self.opponent_view.add_frame(packet)
+
+        else:
+            self.opponent.apply(packet)
+
+    """
+    Draws a board rebuilt from frames.
+
+    layer: the BoardLayer to draw on
+    board: BoardDecoder
+    snake_color: the snake's color, defaults to the color in the board's keyframes
+    """
+    def draw_board(self, layer, board, snake_color=None, apple_color=(255, 0, 0)) -> None:
+        if not board.synced():  # wait for the next keyframe
+            return
+
+        self.dirty += layer.update(board_cells(board.coords, snake_color or board.snake_color, board.apple, apple_color))
+
+    """
+    Draws this player's snake and apple at the offset PLAYER_OFFSET.
+    """
+    def draw_player_board(self) -> None:
+        cells = board_cells(self.snake.coords, SNAKE_COLOR, self.apple.get_xy(), APPLE_COLOR)
+        self.dirty += self.player_layer.update(cells)
+
+    """
+    Draws the opponent boards at the offest OPPONENT_OFFEST. This can be configured in screen_sizes.json.
     """
     def draw_opponent_board(self) -> None:
-        self.draw_grid(OPPONENT_OFFSET)
+        for layer, board in zip(self.opponent_layers, self.opponents):
+            self.draw_board(layer, board)
+
+    """
+    Draws the opponent board from the buffered boards, with the head sliding between cells.
+    """
+    def draw_smooth_opponent_board(self) -> None:
+        sample = self.opponent_view.sample()
+
+        if sample is None:
+            return
+
+        coords, apple, color, head = sample
 
-        opponent_cubes = [Cube(*pos_data) for pos_data in self.opponent_board]
+        cells = board_cells(coords[:-1], color, apple)
+        overlay = {} if head is None else {head: tuple(color)}
 
-        for cube in opponent_cubes:
-            cube.draw(self.surface, self.board_size, OPPONENT_OFFSET)
+        self.dirty += self.opponent_layer.update(cells, overlay)
+
+    """
+    Returns this player's score
+    """
+    def score(self) -> int:
+        return len(self.own) if self.authoritative else len(self.snake.coords)
 
     """
     Draws the text on the screen.
     """
     def draw_text(self) -> None:
-        self.score_text.change_text(f"Score: {len(self.snake.coords)} / {self.apple_goal}")
-        self.opponent_score_text.change_text(f"Score: {len(self.opponent_board) - 1} / {self.apple_goal}")
+        self.update_text(self.score_text, f"Score: {self.score()} / {self.apple_goal}")
+        self.update_text(self.opponent_score_text, f"Score: {max(map(len, self.opponents))} / {self.apple_goal}")
 
-        self.your_board_text.draw(self.surface)
-        self.opponent_board_text.draw(self.surface)
-        self.score_text.draw(self.surface)
-        self.opponent_score_text.draw(self.surface)
+    """
+    Redraws a text over the background if its message changed
+    """
+    def update_text(self, text, message) -> None:
+        if message == text.message:
+            return
+
+        old_rect = text.rect
+        self.surface.blit(self.background, old_rect, old_rect)
+
+        text.change_text(message)
+        text.draw(self.surface)
+
+        self.dirty += [old_rect, text.rect]
 
     """
     Returns if the opponent ended the game (either if they won or lost)
     """
     def check_endgame(self) -> bool:
-        return type(self.opponent_board) == str
+        return self.opponent_result is not None
 
     """
     Show the end screen.
@@ -278,11 +455,19 @@ class Game:
         self.surface.fill((0, 0, 0))
 
         self.draw_grid(OPPONENT_OFFSET)
-        self.snake.draw_snake(self.surface, self.board_size, OPPONENT_OFFSET)
-        self.apple.draw(self.surface, self.board_size, OPPONENT_OFFSET)
 
-        font = pygame.font.SysFont("Calibri Light", 40)
-        text = font.render(message, True, color)
+        if self.authoritative:
+            if self.own.apple is not None:
+                Cube(*self.own.apple, APPLE_COLOR).draw(self.surface, self.board_size, OPPONENT_OFFSET)
+
+            for x, y in self.own.coords:
+                Cube(x, y, SNAKE_COLOR).draw(self.surface, self.board_size, OPPONENT_OFFSET)
+
+        else:
+            self.snake.draw_snake(self.surface, self.board_size, OPPONENT_OFFSET)
+            self.apple.draw(self.surface, self.board_size, OPPONENT_OFFSET)
+
+        text = gui_text.render(message, gui_text.font(END_FONT_SIZE), color)
 
         text_rect = text.get_rect()
         text_rect.center = (WIDTH // 2, HEIGHT - WIDTH - 50)
@@ -294,102 +479,432 @@ class Game:
         pygame.time.wait(3000)
 
     """
-    Main game loop. The loop runs in the order of:
-    1. Get input and move the snake
+    Main game loop. Input is read every frame, and the game ticks on a fixed timestep
+    (see timestep.py). Each tick runs in the order of:
+    1. Take the next queued turn and move the snake
     2. Check if an apple is eaten
     3. Draw the board
     4. Check if the game ended from the opponent winning/losing
     5. Draw the opponent board
     6. Check if the client won/lost
-    7. Start the send/receive threads again for less latency
+    7. Queue this tick's board for the network worker to send
     """
     def run(self) -> None:
-        clock = pygame.time.Clock()
+        if self.authoritative:
+            self.run_authoritative()
+            return
 
-        receive_thread = threading.Thread(target=self.get_other_board)
-        receive_thread.start()
+        if self.smooth:
+            self.run_smooth()
+            return
 
-        send_thread = threading.Thread(target=self.send_screen_info)
-        send_thread.start()
+        clock = pygame.time.Clock()
+        timestep = FixedTimestep(self.tick_length)
 
-        frame_count = 0
+        self.draw_first_frame()
+        self.send_screen_info()
+        timestep.start()
 
         while True:
-            # Wait until the game ticks
-            if frame_count != self.speed:
-                self.snake.get_input()
+            self.snake.get_input()
 
-                frame_count += 1
-                clock.tick(60)
-                continue
+            for _ in range(timestep.due()):
+                if self.play_tick():
+                    return
+
+            clock.tick(60)
+
+    """
+    Runs one tick of the main game loop.
+    Returns: whether the game ended
+    """
+    def play_tick(self) -> bool:
+        # Move
+        self.snake.next_turn()
+        self.snake.move()
+
+        # Check if the apple is eaten
+        if self.snake.check_apple_eaten(self.apple.get_xy()):
+            self.apple.regenerate_coords(self.snake, self.board_size)
+
+        # Draw the board
+        self.draw_player_board()
 
-            # Move
+        self.get_other_board()
+
+        # Check if the opponent won/lost
+        if self.opponent_result == "Client disconnected":
+            self.show_end_screen(ENDGAME_MESSAGES[self.opponent_result], (255, 255, 255))
+            pygame.quit()
+            exit()
+
+        if self.check_endgame() is True:
+            self.show_end_screen(ENDGAME_MESSAGES[self.opponent_result], (255, 255, 255))
+            return True
+
+        # Draw the opponent board
+        self.draw_opponent_board()
+        self.draw_text()
+
+        # Check if the snake won or lost
+        if self.snake.won(self.apple_goal):
+            self.network.send("won")
+            self.show_end_screen(f"You won with a score of {len(self.snake.coords)}!", (0, 255, 0))
+            return True
+
+        elif self.snake.lost(self.board_size):
+            self.network.send("lost")
+            self.show_end_screen(f"You lost with a score of {len(self.snake.coords)}.", (255, 0, 0))
+            return True
+
+        self.update_display()
+
+        self.send_screen_info()
+
+        return False
+
+    """
+    Game loop for smooth mode. Same rules as run(), but the snake moves on its own tick
+    without waiting for the opponent's board, and the screen is redrawn every frame.
+    """
+    def run_smooth(self) -> None:
+        clock = pygame.time.Clock()
+        timestep = FixedTimestep(self.tick_length)
+
+        self.draw_first_frame()
+        self.send_screen_info()
+        timestep.start()
+
+        while True:
             self.snake.get_input()
-            self.snake.move()
 
-            # Check if the apple is eaten
-            if self.snake.check_apple_eaten(self.apple):
-                self.apple.regenerate_coords(self.snake, self.board_size)
+            for _ in range(timestep.due()):
+                self.snake.next_turn()
+                self.snake.move()
 
-            # Draw the board
-            self.surface.fill((0, 0, 0))
-            self.draw_grid(PLAYER_OFFSET)
-            self.draw_text()
+                if self.snake.check_apple_eaten(self.apple.get_xy()):
+                    self.apple.regenerate_coords(self.snake, self.board_size)
 
-            self.apple.draw(self.surface, self.board_size, PLAYER_OFFSET)
-            self.snake.draw_snake(self.surface, self.board_size, PLAYER_OFFSET)
+                self.send_screen_info()
 
-            receive_thread.join()
-            send_thread.join()
+                if self.snake.won(self.apple_goal) or self.snake.lost(self.board_size):
+                    break  # don't catch up past the end of the game
+
+            for packet in self.network.poll():
+                self.handle_opponent_packet(packet)
 
             # Check if the opponent won/lost
-            if self.opponent_board == "Client disconnected":
-                self.show_end_screen(ENDGAME_MESSAGES[self.opponent_board], (255, 255, 255))
+            if self.opponent_result == "Client disconnected":
+                self.show_end_screen(ENDGAME_MESSAGES[self.opponent_result], (255, 255, 255))
                 pygame.quit()
                 exit()
 
             if self.check_endgame() is True:
-                self.show_end_screen(ENDGAME_MESSAGES[self.opponent_board], (255, 255, 255))
+                self.show_end_screen(ENDGAME_MESSAGES[self.opponent_result], (255, 255, 255))
                 break
 
-            # Draw the opponent board
-            self.draw_opponent_board()
-
             # Check if the snake won or lost
             if self.snake.won(self.apple_goal):
-                send("won", client_socket)
+                self.network.send("won")
                 self.show_end_screen(f"You won with a score of {len(self.snake.coords)}!", (0, 255, 0))
                 break
 
             elif self.snake.lost(self.board_size):
-                send("lost", client_socket)
+                self.network.send("lost")
                 self.show_end_screen(f"You lost with a score of {len(self.snake.coords)}.", (255, 0, 0))
                 break
 
-            pygame.display.update()
+            # Draw both boards
+            self.draw_player_board()
+            self.draw_smooth_opponent_board()
+            self.draw_text()
+
+            self.update_display()
+            clock.tick(60)
+
+    """
+    Applies one frame per player from a snapshot, and keeps the local snake's last
+    direction in step with the server so it can't be turned back into itself.
+    """
+    def apply_snapshot(self, frames) -> None:
+        old_head = self.own.coords[-1] if len(self.own) else None
+        boards = self.opponents[:self.player_index] + [self.own] + self.opponents[self.player_index:]
 
-            receive_thread = threading.Thread(target=self.get_other_board)
-            receive_thread.start()
+        for board, frame in zip(boards, frames):
+            board.apply(frame)
+
+        if old_head is not None and len(self.own):
+            new_head = self.own.coords[-1]
+            self.snake.prev_frame_dir = (new_head[0] - old_head[0], new_head[1] - old_head[1])
+
+    """
+    Shows the result sent by a server that runs the game.
+    """
+    def show_result(self, result) -> None:
+        message, color = RESULT_MESSAGES[result["result"]]
+        self.show_end_screen(message.format(score=result["score"]), color)
 
-            send_thread = threading.Thread(target=self.send_screen_info)
-            send_thread.start()
+        if result["result"] == "left":
+            pygame.quit()
+            exit()
+
+    """
+    Game loop when the server runs the game. The loop reads input at 60 fps and redraws
+    whenever a snapshot has arrived. The server ticks once per snapshot, so at most one
+    queued turn is sent per snapshot and the server never gets two turns in one tick.
+    """
+    def run_authoritative(self) -> None:
+        clock = pygame.time.Clock()
+        turn_sent = False  # a turn was sent since the last snapshot
+
+        self.draw_first_frame()
+        self.network.resumable = self.session is not None
+
+        while True:
+            self.snake.get_input()
+
+            if not turn_sent and self.snake.next_turn():
+                self.network.send([INPUT, *self.snake.dir])
+                turn_sent = True
+
+            try:
+                messages = self.network.poll()
+
+            except ConnectionLost:
+                if not self.resume():
+                    self.show_end_screen("Connection lost.", (255, 255, 255))
+                    pygame.quit()
+                    exit()
+
+                turn_sent = False
+                continue
+
+            redraw = False
+
+            for message in messages:
+                if type(message) == dict:
+                    self.network.resumable = False
+                    self.show_result(message)
+                    return
+
+                if type(message) == list and message[0] == SNAPSHOT:
+                    self.apply_snapshot(message[1])
+                    turn_sent = False
+                    redraw = True
+
+            if redraw:
+                self.draw_board(self.player_layer, self.own, SNAKE_COLOR, APPLE_COLOR)
+                self.draw_opponent_board()
+                self.draw_text()
+
+                self.update_display()
 
-            frame_count = 0
             clock.tick(60)
 
-        send_thread.join()
-        receive_thread.join()
+    """
+    Reconnects after the connection to the server dropped and rejoins the game with the
+    session token from the match info. The server answers with every board as it has them,
+    so the game carries on from there.
+
+    Returns: whether the game was rejoined within resume_timeout
+    """
+    def resume(self) -> bool:
+        global client_socket
+
+        logging.warning("Lost the connection to the server, reconnecting")
+        pygame.display.set_caption("Multiplayer Snake - reconnecting...")
+
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)  # wakes the network threads if they are stuck on the socket
+
+        except OSError:
+            pass
+
+        self.network.stop()
+        client_socket.close()
+
+        deadline = time.monotonic() + self.resume_timeout
+        resumed = False
+
+        while not resumed and time.monotonic() < deadline:
+            self.snake.get_input()  # keeps the window responsive
+
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(RECONNECT_TIMEOUT)
+
+            try:
+                sock.connect(self.server_address)
+                negotiate(sock, PROTOCOLS, udp=UDP, resume=self.session)
+                reply = receive(sock) if get_connection(sock).negotiated else None
+
+            except (OSError, SystemExit):  # receive() exits when the server closes the connection
+                reply = None
+
+            if reply is None:
+                sock.close()
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+
+            if type(reply) != dict or not reply.get("resumed"):
+                logging.warning(f"The server could not resume the game: {reply}")
+                sock.close()
+                break
+
+            sock.settimeout(None)
+            client_socket = sock
+
+            self.network = NetworkWorker(sock)
+            self.network.resumable = True
+            resumed = True
+
+            logging.info("Rejoined the game")
+
+        pygame.display.set_caption("Multiplayer Snake")
+
+        return resumed
+
+
+"""
+Watches matches on the server without playing. Reuses the game's drawing: the first
+player's board is drawn where this player's board would be, and the other players' boards
+where the opponents' would be. Runs until the window is closed, following the server from
+game to game and from room to room.
+
+info: the "watching" message for the first game
+"""
+class SpectatorGame(Game):
+    def __init__(self, surface, network, info):
+        self.network = network
+        self.surface = surface
+
+        self.your_board_text = gui_text.Text("Player 1:", gui_text.font(FONT_SIZE), (255, 255, 255), (60, PLAYER_OFFSET // 2))
+        self.opponent_board_text = gui_text.Text("Player 2:", gui_text.font(FONT_SIZE), (255, 255, 255), (70, HEIGHT - WIDTH - 30))
+        self.status_text = gui_text.Text("", gui_text.font(FONT_SIZE), (255, 255, 255), (WIDTH // 2, PLAYER_OFFSET + WIDTH + 25))
+
+        self.sender = None  # index of the player whose relayed message comes next
+        self.start(info)
+
+    """
+    Resets the boards for a new game.
+    """
+    def start(self, info) -> None:
+        self.board_size = info["board_size"]
+        self.apple_goal = info["apple_goal"]
+        self.boards = [BoardDecoder() for _ in range(info.get("players", 2))]
+        self.opponents = self.boards[1:]
+
+        players = len(self.boards)
+        self.opponent_board_text.change_text("Player 2:" if players == 2 else f"Players 2-{players}:")
+
+        self.score_text = gui_text.Text("Score: 1", gui_text.font(FONT_SIZE), (255, 255, 255), (WIDTH - 70, PLAYER_OFFSET // 2))
+        self.opponent_score_text = gui_text.Text("Score: 1", gui_text.font(FONT_SIZE), (255, 255, 255),
+                                                 (WIDTH - 70, OPPONENT_OFFSET - 30))
+
+        self.make_layers((self.board_size, len(self.opponents), "spectator"))
+
+        self.draw_first_frame()
+        self.update_text(self.status_text, f"Watching room {info['watching']}")
+        self.update_display()
+
+    """
+    Shows the results sent by a server that runs the game.
+    """
+    def show_results(self, results) -> None:
+        outcomes = [result["result"] for result in results]
+
+        if "won" in outcomes:
+            winner = outcomes.index("won")
+            message = f"Player {winner + 1} won with a score of {results[winner]['score']}!"
+
+        elif "draw" in outcomes:
+            message = "Draw."
+
+        else:
+            message = "A player left."
+
+        self.update_text(self.status_text, message)
+
+    """
+    Applies a message from the server.
+
+    Returns: whether the boards need to be redrawn
+    """
+    def handle_message(self, message) -> bool:
+        if type(message) == dict:
+            if "watching" in message:
+                self.start(message)
+
+            elif "results" in message:
+                self.show_results(message["results"])
+
+            return False
+
+        if type(message) == int:  # the next message is from this player
+            self.sender = message
+            return False
+
+        if type(message) == str:
+            if self.sender is not None and message in SPECTATOR_MESSAGES:
+                self.update_text(self.status_text, SPECTATOR_MESSAGES[message].format(player=self.sender + 1))
+
+            return False
+
+        if message[0] == SNAPSHOT:
+            for board, frame in zip(self.boards, message[1]):
+                board.apply(frame)
+
+        elif self.sender is not None and 0 <= self.sender < len(self.boards):
+            self.boards[self.sender].apply(message)
+
+        return True
+
+    def draw_text(self) -> None:
+        self.update_text(self.score_text, f"Score: {len(self.boards[0])} / {self.apple_goal}")
+        self.update_text(self.opponent_score_text, f"Score: {max(map(len, self.opponents))} / {self.apple_goal}")
+
+    def run(self) -> None:
+        clock = pygame.time.Clock()
+
+        while True:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    exit()
+
+            redraw = False
+
+            for message in self.network.poll():
+                redraw = self.handle_message(message) or redraw
+
+            if redraw:
+                self.draw_board(self.player_layer, self.boards[0])
+                self.draw_opponent_board()
+                self.draw_text()
+
+            self.update_display()
+            clock.tick(60)
 
 
 def main():
-    global client_socket
+    global client_socket, BOARD_LAYER
 
-    # Setup pygame
+    # Setup pygame. Only the modules the game uses are started, pygame.init() would also start audio
+    pygame.display.init()
+    pygame.font.init()
     pygame.display.set_caption("Multiplayer Snake")
     surface = pygame.display.set_mode((WIDTH, HEIGHT))
 
-    # Run the IP connection screen
-    conn = connect.IPConnectionScreen(surface, WIDTH, PLAYER_OFFSET, client_socket)
+    # Show the IP connection screen before anything else
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.settimeout(10)
+
+    conn = connect.IPConnectionScreen(surface, WIDTH, PLAYER_OFFSET, client_socket, protocols=PROTOCOLS, role=ROLE,
+                                      udp=UDP)
+    conn.draw()
+
+    logging.info(f"First frame after {(time.perf_counter() - STARTED) * 1000:.0f} ms")
+
+    BOARD_LAYER = layer_class(RENDERER)
 
     while True:
         connected = conn.run()
@@ -399,25 +914,29 @@ def main():
 
         # Reset the client socket to avoid errors if the connection failed
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        conn = connect.IPConnectionScreen(surface, WIDTH, PLAYER_OFFSET, client_socket, "Failed")
+        client_socket.settimeout(10)
+        conn = connect.IPConnectionScreen(surface, WIDTH, PLAYER_OFFSET, client_socket, "Failed", PROTOCOLS, ROLE, UDP)
 
-    client_socket.settimeout(1000)
+    # The network worker's reader thread waits on the socket itself
+    client_socket.settimeout(None)
+    network = NetworkWorker(client_socket)
+
+    if ROLE == SPECTATOR:
+        SpectatorGame(surface, network, conn.start_message).run()
+        return
 
     # Run the game
     while True:
-        game = Game(surface)
-
-        client_socket.settimeout(5)
-
+        game = Game(surface, network)
         game.run()
 
-        send("ready", client_socket)
-        send("ready2", client_socket)
+        network = game.network  # a new connection if the game was resumed
 
-        # Clear all pending messages from the server before replaying
-        client_socket.settimeout(1000)
+        network.send("ready")
+        network.send("ready2")
 
-        while receive(client_socket) != "start":
+        # Clear all pending messages from the server before replaying
+        while network.get() != "start":
             pass
 
 
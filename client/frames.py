@@ -0,0 +1,122 @@
+# Board frames shared by the client and the server.
+# client/frames.py and server/frames.py must be kept identical.
+
+import collections
+
+
+"""
+Board frames sent each tick, between clients or from a server that runs the game.
+
+Keyframe: ["K", tick, [apple_x, apple_y], snake_color, [x0, y0, x1, y1, ...]]
+          The whole board, snake coordinates flattened from tail to head.
+
+Delta:    ["D", tick, head_x, head_y, popped] or
+          ["D", tick, head_x, head_y, popped, apple_x, apple_y]
+          The new head, whether the tail was popped (0 or 1), and the apple
+          position only when the apple moved.
+
+A keyframe is sent on the first tick and every KEYFRAME_INTERVAL ticks after
+that, so a receiver that missed or rejected a delta is back in sync soon.
+
+Snapshot: ["N", [frame_0, frame_1, ...]]
+          One frame per player, in player order, sent by a server that runs the game.
+
+Input:    ["I", dir_x, dir_y]
+          The direction a player turned, sent to a server that runs the game.
+"""
+
+KEYFRAME = "K"
+DELTA = "D"
+SNAPSHOT = "N"
+INPUT = "I"
+
+KEYFRAME_INTERVAL = 50
+
+
+class FrameEncoder:
+    def __init__(self, snake_color, keyframe_interval=KEYFRAME_INTERVAL):
+        self.snake_color = snake_color
+        self.keyframe_interval = keyframe_interval
+
+        self.tick = 0
+        self.length = 0
+        self.apple = None
+
+    """
+    Returns the frame for this tick. Call exactly once per tick, after the snake moved.
+
+    coords: the snake's (x, y) coordinates from tail to head
+    apple: the apple's (x, y) coordinates
+    """
+    def encode(self, coords, apple) -> list:
+        tick = self.tick
+        self.tick += 1
+
+        apple = tuple(apple)
+
+        if tick % self.keyframe_interval == 0:
+            frame = self.keyframe(tick, coords, apple)
+
+        else:
+            head_x, head_y = coords[-1]
+            popped = len(coords) == self.length  # the snake only grows when it doesn't pop its tail
+            frame = [DELTA, tick, head_x, head_y, int(popped)]
+
+            if apple != self.apple:
+                frame.extend(apple)
+
+        self.length = len(coords)
+        self.apple = apple
+
+        return frame
+
+    def keyframe(self, tick, coords, apple) -> list:
+        flat = []
+
+        for x, y in coords:
+            flat.append(x)
+            flat.append(y)
+
+        return [KEYFRAME, tick, list(apple), list(self.snake_color), flat]
+
+
+class BoardDecoder:
+    def __init__(self):
+        self.coords = collections.deque()
+        self.apple = None
+        self.snake_color = (255, 255, 255)
+        self.tick = None  # None until the first keyframe arrives
+
+    """
+    Applies a frame to the board.
+
+    Returns: whether the frame was applied. Deltas that don't follow the last
+    applied tick are dropped and the board waits for the next keyframe.
+    """
+    def apply(self, frame) -> bool:
+        if frame[0] == KEYFRAME:
+            _, self.tick, apple, self.snake_color, flat = frame
+            self.apple = tuple(apple)
+            self.coords = collections.deque(zip(flat[::2], flat[1::2]))
+            return True
+
+        if frame[0] != DELTA or self.tick is None or frame[1] != self.tick + 1:
+            self.tick = None
+            return False
+
+        self.tick = frame[1]
+        self.coords.append((frame[2], frame[3]))
+
+        if frame[4]:
+            self.coords.popleft()
+
+        if len(frame) > 5:
+            self.apple = (frame[5], frame[6])
+
+        return True
+
+    def synced(self) -> bool:
+        return self.tick is not None
+
+    def __len__(self):
+        return len(self.coords)
@@ -1,3 +1,103 @@
+import collections
+import logging
+import pygame
+import json
+import sys
+import os
+
+
+CACHE_SIZE = 256  # rendered texts kept for reuse
+
+FONT_NAME = "Calibri Light"
+
+
+"""
+Returns: the directory for files the game can always recreate, in the user's cache directory
+"""
+def cache_dir() -> str:
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+
+    return os.path.join(base, "multiplayer-snake")
+
+
+FONT_CACHE = os.path.join(cache_dir(), "font_cache.json")  # where the font file found for FONT_NAME is remembered between runs
+
+_fonts = {}  # (size, bold): font
+
+_rendered = collections.OrderedDict()  # (message, font, color): surface, least recently used first
+
+
+"""
+Renders a message, reusing the surface if the same message was rendered recently
+with the same font and color.
+"""
+def render(message, font, color):
+    key = (message, font, tuple(color))
+
+    if key in _rendered:
+        _rendered.move_to_end(key)
+        return _rendered[key]
+
+    surface = font.render(message, True, color)
+    _rendered[key] = surface
+
+    if len(_rendered) > CACHE_SIZE:
+        _rendered.popitem(last=False)
+
+    return surface
+
+
+"""
+Finds the file for FONT_NAME. Looking a font up by name lists every font on the system,
+which can take seconds on Linux, so the result is saved to FONT_CACHE and later runs
+open the file straight away. Delete FONT_CACHE to look the font up again.
+
+Returns: the font file's path, or None for pygame's default font if FONT_NAME isn't installed
+"""
+def font_path():
+    try:
+        with open(FONT_CACHE) as f:
+            cached = json.load(f)
+
+        if FONT_NAME in cached and (cached[FONT_NAME] is None or os.path.isfile(cached[FONT_NAME])):
+            return cached[FONT_NAME]
+
+    except (OSError, ValueError):
+        pass
+
+    path = pygame.font.match_font(FONT_NAME)
+
+    try:
+        os.makedirs(os.path.dirname(FONT_CACHE), exist_ok=True)
+
+        with open(FONT_CACHE, "w") as f:
+            json.dump({FONT_NAME: path}, f)
+
+    except OSError as e:
+        logging.warning(f"Could not save the font location: {e}")
+
+    return path
+
+
+"""
+Returns: FONT_NAME at a size, loaded the first time it is asked for
+"""
+def font(size, bold=False) -> pygame.font.Font:
+    key = (size, bold)
+
+    if key not in _fonts:
+        loaded = pygame.font.Font(font_path(), size)
+        loaded.set_bold(bold)
+        _fonts[key] = loaded
+
+    return _fonts[key]
 
 
 class Text:
@@ -5,8 +105,9 @@ class Text:
         self.font = font
         self.color = color
         self.pos = pos
+        self.message = message
 
-        self.text = self.font.render(message, True, self.color)
+        self.text = render(message, self.font, self.color)
         self.rect = self.text.get_rect()
         self.rect.center = self.pos
 
@@ -14,6 +115,10 @@ class Text:
         surface.blit(self.text, self.rect)
 
     def change_text(self, new_text):
-        self.text = self.font.render(new_text, True, self.color)
+        if new_text == self.message:
+            return
+
+        self.message = new_text
+        self.text = render(new_text, self.font, self.color)
         self.rect = self.text.get_rect()
         self.rect.center = self.pos
@@ -0,0 +1,105 @@
+import collections
+import threading
+import time
+
+from frames import BoardDecoder
+
+
+"""
+Buffers the opponent's board states as they arrive and works out what to show at any
+moment, so the opponent moves smoothly at the render rate even when frames arrive
+late or in bursts.
+
+Each state is shown delay_ticks after it was expected to arrive. Between two received
+states the head slides from one cell to the next. When the next state is late, the
+head keeps going in its last direction for up to max_extrapolate ticks and then waits.
+"""
+class OpponentView:
+    def __init__(self, tick_length, delay_ticks=1, max_extrapolate=2, buffer_size=8, clock=time.monotonic):
+        self.tick_length = tick_length
+        self.delay_ticks = delay_ticks
+        self.max_extrapolate = max_extrapolate
+        self.clock = clock
+
+        self.board = BoardDecoder()
+        self.states = collections.deque(maxlen=buffer_size)  # (tick, coords, apple, snake_color), oldest first
+        self.offsets = collections.deque(maxlen=buffer_size * 4)  # arrival time minus tick time of recent frames
+        self.lock = threading.Lock()
+
+    """
+    Applies a received frame and records the resulting board. Safe to call from the network thread.
+    """
+    def add_frame(self, frame) -> None:
+        if not self.board.apply(frame):
+            return
+
+        board = self.board
+        state = (board.tick, tuple(board.coords), board.apple, board.snake_color)
+
+        with self.lock:
+            if self.states and self.states[-1][0] >= board.tick:  # a keyframe restarted the ticks
+                self.states.clear()
+                self.offsets.clear()
+
+            self.states.append(state)
+            self.offsets.append(self.clock() - board.tick * self.tick_length)
+
+    """
+    The fastest recent arrival is the best guess of when a tick is sent, since frames
+    can arrive late but never early.
+    """
+    def render_tick(self, now) -> float:
+        return (now - min(self.offsets)) / self.tick_length - self.delay_ticks
+
+    """
+    Returns: (coords, apple, snake_color, head) to draw now, where head is the fractional
+    (x, y) of the head sliding towards its next cell. None until a state has arrived.
+    """
+    def sample(self, now=None):
+        with self.lock:
+            if not self.states:
+                return None
+
+            states = list(self.states)
+            render_tick = self.render_tick(self.clock() if now is None else now)
+
+        # The newest state at or before render_tick, or the oldest one if render_tick is before all of them
+        index = 0
+
+        for i, state in enumerate(states):
+            if state[0] <= render_tick:
+                index = i
+
+        tick, coords, apple, color = states[index]
+        head = coords[-1] if coords else None
+
+        if head is None or render_tick <= tick:
+            return coords, apple, color, head
+
+        if index + 1 < len(states):
+            # Interpolate towards the next state
+            next_tick, next_coords, _, _ = states[index + 1]
+            target = next_coords[-1] if next_coords else head
+            alpha = (render_tick - tick) / (next_tick - tick)
+
+        else:
+            # Extrapolate in the last direction the head moved
+            if len(states) < 2 or not states[-2][1]:
+                return coords, apple, color, head
+
+            previous = states[-2][1][-1]
+            direction = (head[0] - previous[0], head[1] - previous[1])
+
+            if abs(direction[0]) + abs(direction[1]) != 1:  # didn't move exactly one cell, don't guess
+                return coords, apple, color, head
+
+            alpha = min(render_tick - tick, self.max_extrapolate)
+            target = (head[0] + direction[0], head[1] + direction[1])
+
+        alpha = min(alpha, self.max_extrapolate)
+        sliding = (head[0] + (target[0] - head[0]) * alpha, head[1] + (target[1] - head[1]) * alpha)
+
+        return coords, apple, color, sliding
+
+    def __len__(self):
+        return len(self.board)
@@ -2,14 +2,13 @@ import threading
 import pygame
 import socket
 
-from networking import receive
-from gui_text import Text
-
-pygame.init()
+from networking import receive, negotiate, get_connection
+from protocol import SUPPORTED_PROTOCOLS
+from gui_text import Text, font
 
 COLOR_INACTIVE = pygame.Color('lightskyblue3')
 COLOR_ACTIVE = pygame.Color('dodgerblue2')
-FONT = pygame.font.SysFont("Calibri Light", 30, (255, 255, 255))
+FONT_SIZE = 30
 
 
 class InputBox:
@@ -17,7 +16,7 @@ class InputBox:
         self.rect = pygame.Rect(x, y, w, h)
         self.color = COLOR_INACTIVE
         self.text = text
-        self.txt_surface = FONT.render(text, True, (255, 255, 255))
+        self.txt_surface = font(FONT_SIZE, bold=True).render(text, True, (255, 255, 255))
         self.active = False
 
     def handle_event(self, event):
@@ -36,7 +35,7 @@ class InputBox:
                 self.text += event.unicode
 
             # Re-render the text.
-            self.txt_surface = FONT.render(self.text, True, self.color)
+            self.txt_surface = font(FONT_SIZE, bold=True).render(self.text, True, self.color)
 
     def update(self):
         width = max(200, self.txt_surface.get_width() + 10)
@@ -51,21 +50,25 @@ class InputBox:
 
 
 class IPConnectionScreen:
-    def __init__(self, surface, width, player_offset, client_socket, default_info_text="Press enter to connect"):
+    def __init__(self, surface, width, player_offset, client_socket, default_info_text="Press enter to connect",
+                 protocols=SUPPORTED_PROTOCOLS, role=None, udp=False):
         self.surface = surface
         self.client_socket = client_socket
+        self.protocols = protocols
+        self.role = role  # sent in the hello, see protocol.hello
+        self.udp = udp  # whether to ask for snapshots over UDP
 
         self.width = width
         self.player_offset = player_offset
 
         # Text
-        self.ip_text = Text("Server IP:", FONT, (255, 255, 255),
+        self.ip_text = Text("Server IP:", font(FONT_SIZE, bold=True), (255, 255, 255),
                             (self.width // 2, self.player_offset))
 
-        self.port_text = Text("Server Port:", FONT, (255, 255, 255),
+        self.port_text = Text("Server Port:", font(FONT_SIZE, bold=True), (255, 255, 255),
                               (self.width // 2, self.player_offset + 180))
 
-        self.info_text = Text(default_info_text, FONT, (255, 255, 255),
+        self.info_text = Text(default_info_text, font(FONT_SIZE, bold=True), (255, 255, 255),
                               (self.width // 2, self.player_offset + 300))
 
         # Input boxes
@@ -74,9 +77,14 @@ class IPConnectionScreen:
 
         self.start_message = ""
         self.connected = False
+        self.lost = False  # whether the server went away while the client waited for a match
 
     def get_start_message(self):
-        self.start_message = receive(self.client_socket)
+        try:
+            self.start_message = receive(self.client_socket)
+
+        except (OSError, SystemExit):  # a timeout, or receive() exiting because the server disconnected
+            self.lost = True
 
     def draw(self):
         self.surface.fill((0, 0, 0))
@@ -98,6 +106,9 @@ class IPConnectionScreen:
         clock = pygame.time.Clock()
 
         while not self.start_message:
+            if self.lost:
+                return False
+
             events = pygame.event.get()
 
             for event in events:
@@ -111,7 +122,9 @@ class IPConnectionScreen:
                     if self.connected is False:  # if the connection failed
                         return False  # the connection failed
 
-                    self.client_socket.settimeout(1000)
+                    # The server sends heartbeats while the client waits, so silence means it is gone
+                    heartbeat = get_connection(self.client_socket).heartbeat
+                    self.client_socket.settimeout(heartbeat["timeout"] if heartbeat else 1000)
 
                     t = threading.Thread(target=self.get_start_message)
                     t.start()
@@ -132,6 +145,7 @@ class IPConnectionScreen:
 
         try:
             self.client_socket.connect((self.ip_input.get_text(), int(self.port_input.get_text())))
+            negotiate(self.client_socket, self.protocols, self.role, self.udp)
 
         except (TypeError, socket.error, ConnectionRefusedError, TimeoutError, ValueError):
             self.info_text.change_text("Failed")
@@ -1,34 +1,333 @@
+import threading
 import logging
-import json
+import weakref
+import select
+import socket
+import queue
+import time
 
+from protocol import JSON_CODEC, CODECS, PROTOCOL_JSON, DECODE_ERRORS, DATAGRAM_SEQUENCE, HEARTBEAT, FrameError, FrameReader, \
+    OutboundQueue, hello
 
-HEADERSIZE = 10
+
+"""
+Per socket state: the negotiated codec, the buffered frame reader and the outbound queue.
+"""
+class Connection:
+    def __init__(self, client_socket):
+        self.codec = JSON_CODEC  # replaced once the server answers the hello
+        self.negotiated = False  # whether the server answered the hello, and so sends match info
+        self.udp = None  # {"port", "token"} if the server sends snapshots over UDP
+        self.heartbeat = None  # {"interval", "timeout"} in seconds if the server sends and expects heartbeats
+        self.reader = FrameReader()
+        self.outbox = OutboundQueue(client_socket)
+
+
+_connections = weakref.WeakKeyDictionary()
+
+
+def get_connection(client_socket) -> Connection:
+    if client_socket not in _connections:
+        _connections[client_socket] = Connection(client_socket)
+
+    return _connections[client_socket]
 
 
 def send(message, client_socket):
-    message = json.dumps(message, ensure_ascii=False).encode("utf-8")
-    header_info = f"{len(message):<{HEADERSIZE}}".encode("utf-8")
+    connection = get_connection(client_socket)
 
     try:
-        client_socket.send(header_info)
-        client_socket.send(message)
+        connection.outbox.send(connection.codec.encode(message))
 
     except ConnectionResetError:
         logging.critical("An existing connection was forcibly closed by the remote host")
         exit()
 
 
+"""
+Returns the next message from the server, skipping heartbeats.
+"""
 def receive(client_socket):
+    message = receive_message(client_socket)
+
+    while message == HEARTBEAT:
+        message = receive_message(client_socket)
+
+    return message
+
+
+def receive_message(client_socket):
     logging.debug("Attempting to receive packet")
 
-    message_length = client_socket.recv(HEADERSIZE)
+    try:
+        connection = get_connection(client_socket)
+        message = connection.reader.receive(client_socket, connection.codec)
 
-    if message_length == b"":
+    except EOFError:
         logging.critical("Server disconnected")
         exit()
 
-    message = client_socket.recv(int(message_length))
+    except FrameError as e:
+        logging.critical(f"{e} from the server, can't read any further")
+        exit()
 
     logging.debug("Received")
 
-    return json.loads(message)
+    return message
+
+
+"""
+Waits until a message can be received without blocking for long.
+
+Returns: whether a whole message is already buffered or the socket has data to read
+"""
+def wait_readable(client_socket, timeout) -> bool:
+    connection = get_connection(client_socket)
+
+    if connection.reader.next_frame_size(connection.codec) is not None:
+        return True
+
+    readable, _, _ = select.select([client_socket], [], [], timeout)
+    return bool(readable)
+
+
+"""
+Sends the hello and switches the socket to the protocol the server picked.
+Call right after connecting, before the server sends "start".
+
+protocols: protocol versions to offer, in order of preference
+role: sent in the hello, see protocol.hello
+udp: whether to ask for snapshots over UDP
+resume: session token of a game to rejoin, see protocol.hello
+
+Returns: the protocol version in use
+"""
+def negotiate(client_socket, protocols, role=None, udp=False, resume=None) -> int:
+    send(hello(protocols, role, udp, heartbeat=True, resume=resume), client_socket)
+
+    try:
+        reply = receive(client_socket)
+
+    except socket.timeout:
+        logging.warning("The server did not answer the hello, using JSON")
+        return PROTOCOL_JSON
+
+    if type(reply) != dict or "protocol" not in reply:
+        logging.warning(f"Unexpected answer to the hello: {reply}, using JSON")
+        return PROTOCOL_JSON
+
+    version = reply["protocol"]
+
+    connection = get_connection(client_socket)
+    connection.codec = CODECS.get(version, JSON_CODEC)
+    connection.negotiated = True
+    connection.udp = reply.get("udp")
+    connection.heartbeat = reply.get("heartbeat")
+
+    logging.info(f"Using protocol {version}")
+
+    return version
+
+
+"""
+Raised by NetworkWorker.get() and poll() when the server disconnects and the worker is resumable.
+"""
+class ConnectionLost(Exception):
+    pass
+
+
+"""
+Long-lived network threads for one connection, so the game loop never starts threads or
+waits on the socket itself. The reader thread decodes incoming messages into a bounded
+inbound queue. The writer thread takes messages from a bounded outbound queue and writes
+everything that is waiting in one go.
+
+When the inbound queue is full the reader stops reading, which lets TCP slow the server down.
+
+If the server sends snapshots over UDP, a third thread receives them into the same inbound
+queue, dropping stale ones and ones that don't fit in the queue, since a newer one follows.
+
+If the server asked for heartbeats, the writer sends one whenever nothing else was sent for
+an interval, and the reader treats a server it heard nothing from for the timeout as gone.
+"""
+class NetworkWorker:
+    SERVER_DISCONNECTED = object()
+    STOP = object()
+
+    REGISTER_INTERVAL = 0.5  # seconds between UDP registrations until the first snapshot arrives
+    KEEPALIVE_INTERVAL = 5  # seconds between UDP registrations after that
+
+    def __init__(self, client_socket, inbound_size=256, outbound_size=256):
+        self.client_socket = client_socket
+        self.inbound = queue.Queue(inbound_size)
+        self.outbound = queue.Queue(outbound_size)
+        self.stopped = threading.Event()
+
+        self.resumable = False  # whether get() and poll() raise ConnectionLost instead of exiting
+        self.last_received = time.monotonic()
+
+        heartbeat = get_connection(client_socket).heartbeat
+        self.heartbeat_interval = heartbeat["interval"] if heartbeat else None
+        self.heartbeat_timeout = heartbeat["timeout"] if heartbeat else None
+
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+
+        self.reader.start()
+        self.writer.start()
+
+        self.udp_reader = None
+        udp = get_connection(client_socket).udp
+
+        if udp is not None:
+            address = (client_socket.getpeername()[0], udp["port"])
+            self.udp_reader = threading.Thread(target=self.udp_loop, args=(address, udp["token"]), daemon=True)
+            self.udp_reader.start()
+
+    def read_loop(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                if not wait_readable(self.client_socket, 0.05):
+                    if self.heartbeat_timeout and time.monotonic() - self.last_received > self.heartbeat_timeout:
+                        logging.warning(f"Nothing from the server in {self.heartbeat_timeout} s")
+                        self.inbound.put(self.SERVER_DISCONNECTED)
+                        return
+
+                    continue
+
+                message = receive_message(self.client_socket)
+
+            except (SystemExit, OSError, FrameError):  # receive_message() exits when the server disconnects
+                self.inbound.put(self.SERVER_DISCONNECTED)
+                return
+
+            except DECODE_ERRORS:  # the frame is already out of the buffer, so the next one can still be read
+                logging.warning("Invalid packet received from the server")
+                continue
+
+            self.last_received = time.monotonic()
+
+            if message != HEARTBEAT:
+                self.inbound.put(message)
+
+    def udp_loop(self, address, token) -> None:
+        codec = get_connection(self.client_socket).codec
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.settimeout(0.1)
+
+        last_sequence = -1
+        registered = 0
+        interval = self.REGISTER_INTERVAL
+
+        while not self.stopped.is_set():
+            if time.monotonic() - registered >= interval:
+                try:
+                    udp_socket.sendto(token.encode("ascii"), address)
+
+                except OSError as e:
+                    logging.warning(f"Could not register for UDP snapshots: {e}")
+
+                registered = time.monotonic()
+
+            try:
+                data = udp_socket.recv(65536)
+
+            except OSError:  # a timeout, or the server's port isn't reachable yet
+                continue
+
+            interval = self.KEEPALIVE_INTERVAL
+            self.last_received = time.monotonic()
+
+            if len(data) < DATAGRAM_SEQUENCE.size + codec.header_size:
+                continue
+
+            sequence = DATAGRAM_SEQUENCE.unpack_from(data)[0]
+
+            if sequence <= last_sequence:  # older than a snapshot that already arrived
+                continue
+
+            last_sequence = sequence
+
+            try:
+                message = codec.decode(data[DATAGRAM_SEQUENCE.size + codec.header_size:])
+
+            except DECODE_ERRORS:
+                continue
+
+            try:
+                self.inbound.put_nowait(message)
+
+            except queue.Full:
+                pass
+
+        udp_socket.close()
+
+    def write_loop(self) -> None:
+        connection = get_connection(self.client_socket)
+
+        while True:
+            try:
+                messages = [self.outbound.get(timeout=self.heartbeat_interval)]
+
+            except queue.Empty:
+                messages = [HEARTBEAT]
+
+            while not self.outbound.empty():
+                messages.append(self.outbound.get_nowait())
+
+            for message in messages:
+                if message is self.STOP:
+                    return
+
+                connection.outbox.push(connection.codec.encode(message))
+
+            try:
+                connection.outbox.flush()
+
+            except OSError:
+                logging.critical("An existing connection was forcibly closed by the remote host")
+                return
+
+    """
+    Queues a message to be sent. Only blocks if the outbound queue is full.
+    """
+    def send(self, message) -> None:
+        self.outbound.put(message)
+
+    def check(self, message):
+        if message is self.SERVER_DISCONNECTED:
+            if self.resumable:
+                raise ConnectionLost()
+
+            logging.critical("Server disconnected")
+            exit()
+
+        return message
+
+    """
+    Waits for the next message.
+    Raises queue.Empty if none arrives within timeout seconds.
+    """
+    def get(self, timeout=None):
+        return self.check(self.inbound.get(timeout=timeout))
+
+    """
+    Returns: every message that has arrived, without waiting
+    """
+    def poll(self) -> list:
+        messages = []
+
+        while not self.inbound.empty():
+            messages.append(self.check(self.inbound.get_nowait()))
+
+        return messages
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.outbound.put(self.STOP)
+
+        self.reader.join()
+        self.writer.join()
+
+        if self.udp_reader is not None:
+            self.udp_reader.join()
@@ -0,0 +1,488 @@
+# Wire protocol shared by the client and the server.
+# client/protocol.py and server/protocol.py must be kept identical.
+
+import collections
+import itertools
+import threading
+import socket
+import struct
+import json
+
+
+PROTOCOL_JSON = 1
+PROTOCOL_BINARY = 2
+
+# In order of preference
+SUPPORTED_PROTOCOLS = (PROTOCOL_BINARY, PROTOCOL_JSON)
+
+# Raised by decode() for a malformed frame
+DECODE_ERRORS = (ValueError, struct.error)
+
+MAX_FRAME = 4 * 1024 * 1024  # bytes after the header, longer frames are refused before anything is read or allocated for them
+MAX_BOARDS = 255  # boards in one snapshot, since the binary codec packs their count as a uint8
+
+
+"""
+Raised by frame_length() for a header that can't be read or a frame longer than MAX_FRAME.
+The frames that follow can't be found after that, so the connection has to be closed
+rather than the frame skipped.
+"""
+class FrameError(Exception):
+    pass
+
+
+"""
+Version 1: a space padded 10 character ASCII length, then the message as JSON.
+Every connection starts out using this codec.
+"""
+class JsonCodec:
+    version = PROTOCOL_JSON
+    header_size = 10
+
+    def encode(self, message) -> bytes:
+        payload = json.dumps(message, ensure_ascii=False).encode("utf-8")
+        return f"{len(payload):<{self.header_size}}".encode("utf-8") + payload
+
+    def frame_length(self, header) -> int:
+        try:
+            length = int(bytes(header).decode("utf-8").strip())
+
+        except ValueError:  # also not UTF-8
+            raise FrameError(f"Invalid header {bytes(header)!r}")
+
+        if not 0 <= length <= MAX_FRAME:
+            raise FrameError(f"Frame length {length} out of range")
+
+        return length
+
+    def decode(self, payload):
+        return json.loads(str(payload, "utf-8"))
+
+
+"""
+Version 2: a little-endian uint32 length, then a message type byte and the packed message.
+The length counts the type byte and the packed message.
+
+Board frames (see frames.py) are packed as int16 coordinates:
+    keyframe: tick (uint32), apple x, y, snake color r, g, b (uint8), coordinate count (uint32), x0, y0, x1, y1...
+    delta:    tick (uint32), head x, y, flags (uint8: 1 = tail popped, 2 = apple follows), [apple x, y]
+    snapshot: board count (uint8), then for each board its frame's type byte and packed frame,
+              prefixed with their length (uint32)
+    input:    direction x, y (int8)
+"""
+class BinaryCodec:
+    version = PROTOCOL_BINARY
+    header_size = 4
+
+    TEXT = 0
+    INT = 1
+    KEYFRAME = 2
+    DELTA = 3
+    JSON = 4
+    SNAPSHOT = 5
+    INPUT = 6
+
+    HEADER = struct.Struct("<I")
+    INT_BODY = struct.Struct("<i")
+    KEYFRAME_BODY = struct.Struct("<IhhBBBI")
+    DELTA_BODY = struct.Struct("<IhhB")
+    APPLE = struct.Struct("<hh")
+    INPUT_BODY = struct.Struct("<bb")
+    COUNT = struct.Struct("<B")
+    LENGTH = struct.Struct("<I")
+
+    POPPED = 1
+    APPLE_MOVED = 2
+
+    def encode(self, message) -> bytes:
+        packed = self.pack(message)
+        return self.HEADER.pack(len(packed)) + packed
+
+    """
+    Returns: the message type byte followed by the packed message
+    """
+    def pack(self, message) -> bytes:
+        if type(message) == str:
+            return bytes((self.TEXT,)) + message.encode("utf-8")
+
+        if type(message) == int:
+            return bytes((self.INT,)) + self.INT_BODY.pack(message)
+
+        kind = message[0] if type(message) == list and message else None
+
+        if kind == "K":
+            _, tick, apple, color, flat = message
+            return (bytes((self.KEYFRAME,)) + self.KEYFRAME_BODY.pack(tick, *apple, *color, len(flat))
+                    + struct.pack(f"<{len(flat)}h", *flat))
+
+        if kind == "D":
+            flags = self.POPPED if message[4] else 0
+
+            if len(message) > 5:
+                flags |= self.APPLE_MOVED
+
+            packed = bytes((self.DELTA,)) + self.DELTA_BODY.pack(message[1], message[2], message[3], flags)
+
+            if flags & self.APPLE_MOVED:
+                packed += self.APPLE.pack(message[5], message[6])
+
+            return packed
+
+        if kind == "N":
+            parts = [bytes((self.SNAPSHOT,)), self.COUNT.pack(len(message[1]))]
+
+            for frame in message[1]:
+                packed = self.pack(frame)
+                parts.append(self.LENGTH.pack(len(packed)))
+                parts.append(packed)
+
+            return b"".join(parts)
+
+        if kind == "I":
+            return bytes((self.INPUT,)) + self.INPUT_BODY.pack(message[1], message[2])
+
+        return bytes((self.JSON,)) + json.dumps(message, ensure_ascii=False).encode("utf-8")
+
+    def frame_length(self, header) -> int:
+        length = self.HEADER.unpack_from(header)[0]
+
+        if not 1 <= length <= MAX_FRAME:  # every frame has at least its type byte
+            raise FrameError(f"Frame length {length} out of range")
+
+        return length
+
+    """
+    payload: the type byte and the packed message, as bytes or a memoryview
+    """
+    def decode(self, payload):
+        message_type = payload[0]
+
+        if message_type == self.TEXT:
+            return str(payload[1:], "utf-8")
+
+        if message_type == self.INT:
+            return self.INT_BODY.unpack_from(payload, 1)[0]
+
+        if message_type == self.KEYFRAME:
+            tick, apple_x, apple_y, r, g, b, count = self.KEYFRAME_BODY.unpack_from(payload, 1)
+            flat = list(struct.unpack_from(f"<{count}h", payload, 1 + self.KEYFRAME_BODY.size))
+            return ["K", tick, [apple_x, apple_y], [r, g, b], flat]
+
+        if message_type == self.DELTA:
+            tick, head_x, head_y, flags = self.DELTA_BODY.unpack_from(payload, 1)
+            frame = ["D", tick, head_x, head_y, flags & self.POPPED]
+
+            if flags & self.APPLE_MOVED:
+                frame.extend(self.APPLE.unpack_from(payload, 1 + self.DELTA_BODY.size))
+
+            return frame
+
+        if message_type == self.SNAPSHOT:
+            view = memoryview(payload)
+            frames = []
+            offset = 1 + self.COUNT.size
+
+            for _ in range(self.COUNT.unpack_from(view, 1)[0]):
+                length = self.LENGTH.unpack_from(view, offset)[0]
+                offset += self.LENGTH.size
+
+                # Every frame has at least its type byte and must end inside the snapshot
+                if not 1 <= length <= len(view) - offset:
+                    raise ValueError(f"Snapshot frame length {length} out of range")
+
+                frames.append(self.decode(view[offset:offset + length]))
+                offset += length
+
+            return ["N", frames]
+
+        if message_type == self.INPUT:
+            return ["I", *self.INPUT_BODY.unpack_from(payload, 1)]
+
+        if message_type == self.JSON:
+            return json.loads(str(payload[1:], "utf-8"))
+
+        raise ValueError(f"Unknown message type {message_type}")
+
+
+"""
+Reads frames from a blocking socket into one preallocated buffer with recv_into.
+
+Frames split across reads are kept until the rest arrives, and one read can hold
+several frames, which are then decoded straight from the buffer without copying
+them into new bytes objects. The codec is passed in per call so a connection can
+switch codecs after negotiating without losing bytes that were already read.
+"""
+class FrameReader:
+    def __init__(self, size=65536):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unread byte
+        self.end = 0  # one past the last received byte
+        self.received = 0  # bytes read from the socket so far
+
+    def buffered(self) -> int:
+        return self.end - self.start
+
+    """
+    Makes room for `needed` unread bytes, moving them to the front of the buffer or growing it.
+    """
+    def reserve(self, needed) -> None:
+        if self.start + needed <= len(self.buffer):
+            return
+
+        unread = self.buffered()
+
+        if needed > len(self.buffer):
+            buffer = bytearray(max(needed, len(self.buffer) * 2))
+            buffer[:unread] = self.view[self.start:self.end]
+
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+
+        else:
+            self.view[:unread] = self.view[self.start:self.end]
+
+        self.start = 0
+        self.end = unread
+
+    """
+    Returns: the bytes received but not read as frames yet, so another reader can take over the connection
+    """
+    def unread(self) -> bytes:
+        return bytes(self.view[self.start:self.end])
+
+    """
+    Adds bytes that were received before this reader took over the connection, see unread()
+    """
+    def feed(self, data) -> None:
+        self.reserve(self.buffered() + len(data))
+
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    """
+    Reads whatever the socket has into the buffer.
+
+    Returns: the number of bytes read, 0 if the peer closed the connection
+    """
+    def fill(self, sock) -> int:
+        if self.end == len(self.buffer):
+            self.reserve(len(self.buffer) - self.start + 1)
+
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        self.received += received
+
+        return received
+
+    """
+    Returns: the length of the next frame including its header, or None if it hasn't fully arrived
+    Raises FrameError if the header is invalid.
+    """
+    def next_frame_size(self, codec):
+        if self.buffered() < codec.header_size:
+            return None
+
+        size = codec.header_size + codec.frame_length(self.view[self.start:self.start + codec.header_size])
+
+        if self.buffered() < size:
+            self.reserve(size)
+            return None
+
+        return size
+
+    """
+    Removes the next frame from the buffer and decodes it in place.
+    """
+    def pop(self, size, codec):
+        payload = self.view[self.start + codec.header_size:self.start + size]
+        self.start += size
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        try:
+            return codec.decode(payload)
+
+        finally:
+            payload.release()
+
+    """
+    Decodes the frames that are fully in the buffer, one at a time.
+    """
+    def messages(self, codec):
+        size = self.next_frame_size(codec)
+
+        while size is not None:
+            yield self.pop(size, codec)
+            size = self.next_frame_size(codec)
+
+    """
+    Blocks until a whole frame has arrived and returns it decoded.
+    Raises EOFError if the peer closed the connection, and FrameError if the header is invalid.
+    """
+    def receive(self, sock, codec):
+        size = self.next_frame_size(codec)
+
+        while size is None:
+            if self.fill(sock) == 0:
+                raise EOFError("Connection closed")
+
+            size = self.next_frame_size(codec)
+
+        return self.pop(size, codec)
+
+
+"""
+Outbound frames for one blocking socket.
+
+Frames are queued and written together in one vectored sendmsg() call (one sendall()
+of the joined frames where sendmsg isn't available), so a header and its message
+never leave in separate segments. Partial writes are resumed where they stopped.
+Only one thread writes at a time. A thread that finds the socket busy leaves its
+frame in the queue for the writing thread to pick up, which is how messages that
+queue up behind a slow connection get coalesced.
+"""
+class OutboundQueue:
+    MAX_BUFFERS = 64  # buffers per sendmsg call, well under IOV_MAX
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        except OSError:  # not a TCP socket
+            pass
+
+    def send(self, frame) -> None:
+        self.pending.append(frame)
+        self.flush()
+
+    """
+    Queues a frame without writing it, for callers that queue several frames and then flush once.
+    """
+    def push(self, frame) -> None:
+        self.pending.append(frame)
+
+    def flush(self) -> None:
+        while self.pending:
+            if not self.lock.acquire(blocking=False):
+                return  # the thread holding the lock writes our frame too
+
+            try:
+                while self.pending:
+                    self.write()
+
+            finally:
+                self.lock.release()
+
+    def write(self) -> None:
+        buffers = list(itertools.islice(self.pending, self.MAX_BUFFERS))
+
+        if hasattr(self.sock, "sendmsg"):
+            sent = self.sock.sendmsg(buffers)
+
+        else:
+            data = b"".join(buffers)
+            self.sock.sendall(data)
+            sent = len(data)
+
+        while sent:
+            first = self.pending[0]
+
+            if len(first) <= sent:
+                self.pending.popleft()
+                sent -= len(first)
+
+            else:
+                self.pending[0] = memoryview(first)[sent:]
+                sent = 0
+
+    """
+    Returns: the number of bytes waiting to be written
+    """
+    def depth(self) -> int:
+        return sum(len(frame) for frame in list(self.pending))
+
+
+CODECS = {
+    PROTOCOL_JSON: JsonCodec(),
+    PROTOCOL_BINARY: BinaryCodec()
+}
+
+JSON_CODEC = CODECS[PROTOCOL_JSON]
+
+
+SPECTATOR = "spectator"  # the hello role of clients that watch matches instead of playing
+
+
+"""
+Heartbeats let both sides notice a connection that went quiet, like a client whose Wi-Fi
+dropped, without waiting minutes for TCP to give up. A client asks for them in its hello,
+and the server's reply then holds {"interval": seconds, "timeout": seconds}. From then on
+each side sends HEARTBEAT when it has sent nothing else for an interval, drops HEARTBEAT
+messages when reading, and treats a connection it heard nothing from for the timeout as closed.
+"""
+HEARTBEAT = "heartbeat"
+
+
+"""
+Snapshots can also travel over UDP, so a lost packet only loses one tick instead of holding
+up every message after it. The handshake, results and rematch messages stay on TCP.
+
+A client asks for it in its hello, and the server's reply then holds {"port": udp_port, "token": token}.
+The client sends the token in a datagram to that port until snapshots arrive, and every few
+seconds after that so routers keep the path open. Each datagram from the server is a
+sequence number followed by one message encoded like on TCP. The sequence numbers go up
+by one per datagram, and a datagram older than the newest one received is stale and dropped.
+"""
+DATAGRAM_SEQUENCE = struct.Struct("<I")
+MAX_DATAGRAM = 1200  # bytes, bigger snapshots go over TCP so no datagram is ever fragmented
+
+
+"""
+The first message a client sends after connecting, encoded with JSON_CODEC.
+
+protocols: protocol versions the client supports, in order of preference
+role: SPECTATOR to watch matches instead of playing, None to play
+udp: whether the client wants snapshots over UDP
+heartbeat: whether the client sends and expects heartbeats
+resume: the session token from the match info of a game to rejoin after the connection
+        dropped. The server answers the hello with {"resumed": true} followed by the
+        game's snapshots, or {"resumed": false} and closes the connection.
+"""
+def hello(protocols, role=None, udp=False, heartbeat=False, resume=None) -> dict:
+    message = {"hello": list(protocols)}
+
+    if role is not None:
+        message["role"] = role
+
+    if udp:
+        message["udp"] = True
+
+    if heartbeat:
+        message["heartbeat"] = True
+
+    if resume is not None:
+        message["resume"] = resume
+
+    return message
+
+
+"""
+Picks the protocol for a connection.
+
+offered: protocol versions from the client's hello, in the client's order of preference
+accepted: protocol versions the server allows
+
+Returns: the first offered version the server accepts, falling back to JSON
+"""
+def choose_protocol(offered, accepted) -> int:
+    for version in offered:
+        if version in accepted and version in CODECS:
+            return version
+
+    return PROTOCOL_JSON
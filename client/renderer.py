@@ -0,0 +1,259 @@
+import itertools
+import logging
+import pygame
+import math
+
+
+numpy = None  # only needed for the array renderer, imported by layer_class() since it is slow to import
+
+
+_backgrounds = {}
+
+
+"""
+Returns the background for a board size, drawing it the first time it is asked for.
+
+key: anything that identifies what draw() puts on the background, like the board size
+size: the (width, height) of the background
+draw: a function that draws the background on the surface it is given
+"""
+def cached_background(key, size, draw) -> pygame.Surface:
+    if key not in _backgrounds:
+        background = pygame.Surface(size)
+        draw(background)
+        _backgrounds[key] = background
+
+    return _backgrounds[key]
+
+
+"""
+Returns: the screen rect of a cell, or None if the cell is off the board.
+The rect leaves a one pixel gap on each side for the grid lines.
+"""
+def cell_rect(x, y, board_size, y_offset, width, x_offset=0):
+    if x < 0 or x >= board_size or y < 0 or y >= board_size:
+        return None
+
+    dist = width // board_size
+    return pygame.Rect(x * dist + x_offset + 1, y * dist + y_offset + 1, dist - 2, dist - 2)
+
+
+"""
+Splits a square area into a grid of square slots, one per board.
+
+columns: boards per row, 0 for the smallest square grid that fits them all
+size: the width and height of the area
+gap: pixels between slots
+
+Returns: the (x, y, size) of each slot, relative to the area's top left corner
+"""
+def grid_slots(count, columns, size, gap=0) -> list:
+    columns = min(columns, count) if columns else math.ceil(math.sqrt(count))
+    rows = math.ceil(count / columns)
+    slots = max(columns, rows)
+    slot = (size - gap * (slots - 1)) // slots
+
+    return [((i % columns) * (slot + gap), (i // columns) * (slot + gap), slot) for i in range(count)]
+
+
+"""
+Returns: {(x, y): color} for a board, with the snake drawn over the apple
+"""
+def board_cells(coords, snake_color, apple=None, apple_color=(255, 0, 0)) -> dict:
+    cells = {} if apple is None else {tuple(apple): tuple(apple_color)}
+    cells.update(dict.fromkeys(coords, tuple(snake_color)))
+
+    return cells
+
+
+"""
+Returns: (cells in old that aren't in new, {cell: color} in new that are new or a different color)
+"""
+def diff_cells(old, new):
+    removed = list(old.keys() - new.keys())
+    changed = {cell: color for cell, color in new.items() if old.get(cell) != color}
+
+    return removed, changed
+
+
+"""
+One board on the screen. It remembers which cells it drew, and each update only redraws
+the cells that changed and returns their rects for pygame.display.update(), so drawing
+a tick costs about the same however big the board is.
+"""
+class BoardLayer:
+    def __init__(self, surface, background, board_size, y_offset, width, x_offset=0):
+        self.surface = surface
+        self.background = background
+        self.board_size = board_size
+        self.y_offset = y_offset
+        self.width = width
+        self.x_offset = x_offset
+
+        self.drawn = {}  # {(x, y): color} of the cells on the screen
+        self.overlay = {}  # {(x, y): color} of the cells drawn on top, which can be between cells
+
+    """
+    Forget what was drawn, after the background was drawn over the whole screen
+    """
+    def clear(self) -> None:
+        self.drawn = {}
+        self.overlay = {}
+
+    """
+    Draws the board's cells over what was drawn last time.
+
+    cells: {(x, y): color} from board_cells()
+    overlay: {(x, y): color} drawn on top of cells, with coordinates that may be fractional,
+    like a head sliding between cells
+
+    Returns: the rects that changed
+    """
+    def update(self, cells, overlay=None) -> list:
+        overlay = overlay or {}
+
+        dirty = []
+        removed, draw = diff_cells(self.drawn, cells)
+
+        for x, y in removed:
+            rect = cell_rect(x, y, self.board_size, self.y_offset, self.width, self.x_offset)
+
+            if rect is not None:
+                self.surface.blit(self.background, rect, rect)
+                dirty.append(rect)
+
+        # The overlay covers parts of the cells around it, so those are drawn again too
+        for (x, y), _ in self.overlay.items():
+            rect = cell_rect(x, y, self.board_size, self.y_offset, self.width, self.x_offset)
+
+            if rect is None:
+                continue
+
+            self.surface.blit(self.background, rect, rect)
+            dirty.append(rect)
+
+            for cell in ((math.floor(x), math.floor(y)), (math.ceil(x), math.floor(y)),
+                         (math.floor(x), math.ceil(y)), (math.ceil(x), math.ceil(y))):
+                if cell in cells:
+                    draw[cell] = cells[cell]
+
+        for (x, y), color in list(draw.items()) + list(overlay.items()):
+            rect = cell_rect(x, y, self.board_size, self.y_offset, self.width, self.x_offset)
+
+            if rect is not None:
+                pygame.draw.rect(self.surface, color, rect)
+                dirty.append(rect)
+
+        self.drawn = cells
+        self.overlay = overlay
+
+        return dirty
+
+
+"""
+A board drawn from an array with one color per cell. Each update writes the cells that
+changed into the array, blits it to a surface with one pixel per cell and scales that up
+to the board in one call, which is much faster than a rect per cell on boards with
+hundreds of cells on each side.
+
+Needs numpy. Cells between cells, like the sliding head, are drawn on the nearest cell.
+Boards with more cells than pixels are scaled down to fit.
+"""
+class ArrayBoardLayer:
+    def __init__(self, surface, background, board_size, y_offset, width, x_offset=0):
+        self.surface = surface
+        self.background = background
+        self.board_size = board_size
+        self.dist = width // board_size
+
+        size = board_size * self.dist if self.dist else width
+        self.rect = pygame.Rect(x_offset, y_offset, size, size)
+        self.colors = numpy.zeros((board_size, board_size, 3), numpy.uint8)  # indexed [x, y] like surfarray
+        self.cell_surface = pygame.Surface((board_size, board_size))
+        self.board_surface = pygame.Surface(self.rect.size)
+
+        # Leave a gap around each cell for the grid lines when the cells are big enough to see them
+        if self.dist >= 4:
+            offsets = numpy.arange(size) % self.dist
+            edge = (offsets == 0) | (offsets == self.dist - 1)
+            gaps = edge[:, None] | edge[None, :]
+
+            # Black in the gaps and white, which isn't blitted, everywhere else
+            self.grid = pygame.Surface(self.rect.size)
+            pygame.surfarray.blit_array(self.grid, numpy.where(gaps[:, :, None], 0, 255).astype(numpy.uint8).repeat(3, 2))
+            self.grid.set_colorkey((255, 255, 255))
+
+            self.board_surface.set_colorkey((0, 0, 0))  # empty cells and gaps show the grid under them
+
+        else:
+            self.grid = None
+
+        self.drawn = {}  # {(x, y): color} of the cells on the screen
+
+    def clear(self) -> None:
+        self.colors[:] = 0
+        self.drawn = {}
+
+    """
+    Sets the color of every cell in coords that is on the board
+    """
+    def paint(self, coords, colors) -> None:
+        if not coords:
+            return
+
+        xs, ys = numpy.fromiter(itertools.chain.from_iterable(coords), numpy.intp, len(coords) * 2).reshape(-1, 2).T
+        colors = numpy.fromiter(itertools.chain.from_iterable(colors), numpy.uint8, len(coords) * 3).reshape(-1, 3)
+        inside = (xs >= 0) & (xs < self.board_size) & (ys >= 0) & (ys < self.board_size)
+
+        self.colors[xs[inside], ys[inside]] = colors[inside]
+
+    """
+    Same as BoardLayer.update(), but returns the whole board's rect when anything changed.
+    """
+    def update(self, cells, overlay=None) -> list:
+        if overlay:
+            cells = dict(cells)
+
+            for (x, y), color in overlay.items():
+                cells[round(x), round(y)] = tuple(color)
+
+        removed, changed = diff_cells(self.drawn, cells)
+
+        if not removed and not changed:
+            return []
+
+        self.paint(removed, [(0, 0, 0)] * len(removed))
+        self.paint(list(changed.keys()), list(changed.values()))
+        self.drawn = cells
+
+        pygame.surfarray.blit_array(self.cell_surface, self.colors)
+        pygame.transform.scale(self.cell_surface, self.rect.size, self.board_surface)
+
+        if self.grid is not None:
+            self.board_surface.blit(self.grid, (0, 0))
+
+        self.surface.blit(self.background, self.rect, self.rect)
+        self.surface.blit(self.board_surface, self.rect)
+
+        return [self.rect]
+
+
+"""
+Returns: the board layer class for the "renderer" preference, "cells" or "array".
+Falls back to drawing each cell if numpy isn't installed.
+"""
+def layer_class(name):
+    global numpy
+
+    if name == "array":
+        try:
+            import numpy
+            return ArrayBoardLayer
+
+        except ImportError:
+            logging.warning("The array renderer needs numpy, drawing each cell instead")
+
+    elif name != "cells":
+        logging.warning(f"Unknown renderer {name}, drawing each cell instead")
+
+    return BoardLayer
@@ -0,0 +1,84 @@
+import collections
+import time
+
+
+"""
+Decides when the game ticks, independently of how often the screen is drawn. Elapsed time
+is added up each frame and a tick is run for every tick_length of it, so the snake moves
+at the same speed when a frame runs long or the frame rate drops.
+
+After a stall (the window being dragged, a slow opponent) at most max_catch_up ticks are
+run back to back and the rest of the missed time is dropped, like the server's tick loop.
+"""
+class FixedTimestep:
+    def __init__(self, tick_length, max_catch_up=3, clock=time.monotonic):
+        self.tick_length = tick_length
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+
+        self.last = clock()
+        self.accumulator = 0.0  # time that hasn't been ticked yet
+        self.dropped = 0  # ticks skipped after stalls
+
+    """
+    Starts counting from now, for when the first tick should be a whole tick after drawing the first frame
+    """
+    def start(self) -> None:
+        self.last = self.clock()
+        self.accumulator = 0.0
+
+    """
+    Returns: the number of ticks to run this frame
+    """
+    def due(self) -> int:
+        now = self.clock()
+        self.accumulator += now - self.last
+        self.last = now
+
+        ticks = int(self.accumulator // self.tick_length)
+
+        if ticks > self.max_catch_up:
+            self.dropped += ticks - self.max_catch_up
+            self.accumulator = 0.0
+            return self.max_catch_up
+
+        self.accumulator -= ticks * self.tick_length
+
+        return ticks
+
+
+"""
+Turns pressed since the last tick, in order. The game takes one per tick, so pressing
+up then left quickly between two ticks turns the snake twice instead of only the last
+key counting.
+
+A turn is only queued if it changes the direction the snake will be going after the
+turns already queued, and isn't straight back into itself.
+"""
+class TurnQueue:
+    def __init__(self, max_turns=3):
+        self.turns = collections.deque()
+        self.max_turns = max_turns
+
+    """
+    current: the direction the snake is going, used when no turn is queued
+    """
+    def push(self, direction, current) -> None:
+        last = self.turns[-1] if self.turns else current
+
+        if direction == last or direction == (-last[0], -last[1]) or len(self.turns) >= self.max_turns:
+            return
+
+        self.turns.append(direction)
+
+    """
+    Returns: the oldest queued turn, or None
+    """
+    def pop(self):
+        return self.turns.popleft() if self.turns else None
+
+    def clear(self) -> None:
+        self.turns.clear()
+
+    def __len__(self):
+        return len(self.turns)
@@ -0,0 +1,392 @@
+import logging
+import asyncio
+import time
+
+from networking import Heartbeats, async_send, async_receive, async_negotiate, DISCONNECTED
+from protocol import JSON_CODEC, DECODE_ERRORS, SPECTATOR, CODECS
+from lobby import Lobby, Room
+from authoritative import AuthoritativeGame
+from metrics import METRICS
+from spectators import Spectator
+from recording import start_recording
+from udp import start_udp
+from sessions import Sessions
+from supervisor import OPEN_ROOM, ADD_SPECTATOR
+
+
+class AsyncClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.ip = writer.get_extra_info("peername")
+        self.codec = JSON_CODEC  # replaced once the client's hello is read
+        self.hello = None  # the client's hello, None for clients that only speak JSON
+        self.udp_address = None  # where snapshots go over UDP, once the client registered it
+        self.udp_sequence = 0  # sequence number of the last datagram sent
+        self.udp_fallback = False  # whether snapshots go over TCP because the keyframes don't fit in a datagram
+        self.heartbeat_timeout = None  # seconds of silence before the client counts as gone, if it sends heartbeats
+        self.stats = METRICS.track(self, self.ip)
+
+    def close(self) -> None:
+        self.writer.close()
+
+    """
+    Returns: the number of bytes written to the transport that haven't reached the socket yet
+    """
+    def queue_depth(self) -> int:
+        return self.writer.transport.get_write_buffer_size()
+
+    def __repr__(self):
+        return f"AsyncClient({self.ip})"
+
+
+class AsyncGameSetup:
+    def __init__(self, clients, options, sessions=None):
+        self.clients = clients
+        self.board_size = options["board_size"]  # board_size x board_size board
+        self.speed = options["speed"]  # server tickrate and movement speed, updates every speed / 60 seconds
+        self.apple_goal = options["apple_goal"]  # how long your snake needs to be to win
+        self.mode = "authoritative" if options.get("authoritative") else "relay"
+
+        # Only games the server runs can be resumed, since only then does the server have the boards
+        self.sessions = sessions if self.mode == "authoritative" else None
+        self.tokens = self.sessions.issue(len(clients)) if self.sessions is not None else []
+
+    """
+    Give starting game information to the clients
+    The order is: "start" string, self.board_size, self.speed, self.apple_goal, then for
+    clients that sent a hello, the match info {"mode": "relay" | "authoritative", "player": index, "players": count}.
+    When the game can be resumed, the match info also holds "session": the player's token
+    and "resume_timeout": the seconds the game waits for a player whose connection dropped.
+    """
+    async def give_start_info(self) -> None:
+        logging.info("Giving start info")
+
+        for index, client in enumerate(self.clients):
+            for message in ("start", self.board_size, self.speed, self.apple_goal):
+                await async_send(client, message)
+
+            if client.hello is not None:
+                info = {"mode": self.mode, "player": index, "players": len(self.clients)}
+
+                if self.sessions is not None:
+                    info["session"] = self.tokens[index]
+                    info["resume_timeout"] = self.sessions.timeout
+
+                await async_send(client, info)
+
+    async def setup(self):
+        await self.give_start_info()
+        return self.clients
+
+
+class AsyncGame:
+    def __init__(self, clients, broadcast=None, recorder=None):
+        self.clients = clients
+        self.broadcast = broadcast  # spectators watching the game, if any
+        self.recorder = recorder  # records the relayed frames, if recording is on
+        self.ended = asyncio.Event()
+
+    """
+    Gets giver's screen and sends it to recipient until the game ends, then
+    discards the giver's queued packets until it sends "ready2".
+
+    giver: AsyncClient that gives the board
+    recipient: AsyncClient that receives the board
+
+    Returns: whether the giver is still connected and ready for another game
+    """
+    async def get_player_screen(self, giver, recipient) -> bool:
+        while not self.ended.is_set():
+            try:
+                screen = await async_receive(giver)
+
+            except DECODE_ERRORS:
+                logging.warning(f"Invalid packet received from socket {giver}")
+                giver.stats.invalid_packets += 1
+                continue
+
+            received = time.perf_counter()
+
+            if screen == "ready":  # If the client is ready for a new game, start one
+                break
+
+            await async_send(recipient, screen)
+
+            METRICS.frames_relayed += 1
+            METRICS.relay_latency.observe((time.perf_counter() - received) * 1000)
+
+            # Only queues the frame, spectators are written to by their own tasks
+            if self.broadcast is not None:
+                self.broadcast.send_from(self.clients.index(giver), screen)
+
+            if self.recorder is not None:
+                self.recorder.record(self.clients.index(giver), screen)
+
+            # If the player won or lost
+            if screen in ("won", "lost", DISCONNECTED):
+                logging.info(f"Client {screen}")
+                self.ended.set()
+
+            if screen == DISCONNECTED:
+                return False
+
+        # Clear queued messages from the client
+        while True:
+            try:
+                packet = await async_receive(giver)
+
+            except DECODE_ERRORS:
+                giver.stats.invalid_packets += 1
+                continue
+
+            if packet == DISCONNECTED:
+                return False
+
+            if packet == "ready2":
+                return True
+
+    """
+    Relays both boards on the event loop. The game ends as soon as either
+    relay sees a result, without polling.
+
+    Returns: the clients that are ready for another game
+    """
+    async def run(self) -> list:
+        results = await asyncio.gather(
+            self.get_player_screen(self.clients[0], self.clients[1]),
+            self.get_player_screen(self.clients[1], self.clients[0])
+        )
+
+        return [client for client, ready in zip(self.clients, results) if ready]
+
+
+"""
+Plays games in a room until a player leaves. Each room is its own task, so a
+room that is waiting on a slow client never holds up the others.
+"""
+async def run_room(room, lobby, options, udp=None, sessions=None) -> None:
+    clients = room.clients
+
+    try:
+        while len(clients) == lobby.players_per_room:
+            room.state = Room.PLAYING
+
+            setup = AsyncGameSetup(clients, options, sessions)
+            await setup.setup()
+
+            room.broadcast.start({"watching": room.id, "board_size": setup.board_size, "speed": setup.speed,
+                                  "apple_goal": setup.apple_goal, "mode": setup.mode, "players": len(clients)})
+
+            recorder = start_recording(options, room, setup.mode)
+            started = time.monotonic()
+            METRICS.games_started += 1
+
+            if options.get("authoritative"):
+                ready = await AuthoritativeGame(clients, options, broadcast=room.broadcast, recorder=recorder,
+                                                udp=udp, sessions=setup.sessions, tokens=setup.tokens).run()
+            else:
+                ready = await AsyncGame(clients, room.broadcast, recorder).run()
+
+            if recorder is not None:
+                recorder.close()
+
+            METRICS.games_finished += 1
+            METRICS.game_duration.observe(time.monotonic() - started)
+
+            room.games_played += 1
+            room.state = Room.REMATCH
+
+            for client in clients:
+                if client not in ready:
+                    client.close()
+
+            clients = ready
+
+    except Exception:
+        logging.exception(f"{room} crashed")
+
+        for client in clients:
+            client.close()
+
+        clients = []
+
+    for client in room.clients:
+        logging.info(f"{client} outbound buffer peaked at {client.stats.max_queue_depth} byte(s)")
+
+    lobby.close_room(room, clients)
+
+
+async def serve(ip, port, options, protocols) -> None:
+    # Only games the server runs send snapshots, so only they can use UDP
+    udp = await start_udp(ip, options["udp_port"]) if options.get("authoritative") and options.get("udp_port") else None
+    sessions = Sessions(options["resume_timeout"]) if options.get("authoritative") and options.get("resume_timeout") \
+        else None
+
+    def lost(client):
+        if lobby.remove_client(client):
+            logging.info(f"{client} left while waiting for a match")
+            client.close()
+
+    heartbeats = Heartbeats(options["heartbeat_interval"], options["heartbeat_timeout"], lost) \
+        if options.get("heartbeat_interval") else None
+
+    lobby = Lobby(lambda room: asyncio.create_task(run_room(room, lobby, options, udp, sessions)),
+                  options.get("players_per_match", 2))
+    METRICS.gauges["lobby"] = lobby.stats
+
+    async def accept(reader, writer):
+        client = AsyncClient(reader, writer)
+        logging.info(f"Accepted client with address {client.ip}")
+        METRICS.connections_accepted += 1
+
+        METRICS.handshakes_pending += 1
+
+        try:
+            await async_negotiate(client, protocols, udp, heartbeats)
+
+        finally:
+            METRICS.handshakes_pending -= 1
+
+        if client.hello is not None and client.hello.get("resume"):
+            if sessions is None or not sessions.resume(client.hello["resume"], client):
+                await async_send(client, {"resumed": False})
+                client.close()
+
+            return
+
+        if client.hello is not None and client.hello.get("role") == SPECTATOR:
+            logging.info(f"{client} is a spectator")
+            lobby.add_spectator(Spectator(client))
+            return
+
+        if options.get("authoritative") and client.hello is None:
+            logging.warning(f"Closing {client}, clients need to send a hello to play on a server that runs the game")
+            client.close()
+            return
+
+        lobby.add_client(client)
+
+    server = await asyncio.start_server(accept, ip, port, reuse_address=True)
+
+    background = [heartbeats.async_run()] if heartbeats is not None else []
+
+    async with server:
+        await asyncio.gather(server.serve_forever(), *background)
+
+
+"""
+Async version of the server's detach(). Stops reading from the client and waits until
+everything written to it is sent, so the next owner starts where this one stopped.
+Raises OSError if the client disconnected.
+"""
+async def detach(client, heartbeats=None) -> tuple:
+    if heartbeats is not None:
+        heartbeats.discard(client)
+
+    transport = client.writer.transport
+    transport.pause_reading()
+
+    transport.set_write_buffer_limits(0)
+    await client.writer.drain()
+
+    client.reader.feed_eof()  # read() then returns what is buffered instead of waiting for more
+    unread = await client.reader.read()
+
+    clientsocket = client.writer.get_extra_info("socket").dup()
+    client.close()  # only closes this process's copy of the socket
+
+    return clientsocket, client.ip, client.hello, client.codec.version, unread
+
+
+"""
+Async version of the server's adopt(). The bytes the last owner received but didn't read
+are fed to the reader before the socket is.
+"""
+async def adopt(handoff, heartbeats=None) -> AsyncClient:
+    clientsocket, _, hello, version, unread = handoff
+    loop = asyncio.get_running_loop()
+
+    reader = asyncio.StreamReader()
+    reader.feed_data(unread)
+
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport, _ = await loop.connect_accepted_socket(lambda: protocol, clientsocket)
+
+    client = AsyncClient(reader, asyncio.StreamWriter(transport, protocol, reader, loop))
+    client.hello = hello
+    client.codec = CODECS[version]
+
+    if heartbeats is not None and hello is not None and hello.get("heartbeat"):
+        heartbeats.add(client)
+
+    return client
+
+
+"""
+Sends the clients of a closed room that are ready for another game back to the supervisor
+"""
+async def send_back(room, clients, link, heartbeats) -> None:
+    handoffs = []
+
+    for client in clients:
+        try:
+            handoffs.append(await detach(client, heartbeats))
+
+        except OSError:
+            logging.info(f"{client} left before it could be sent back")
+            client.close()
+
+    await asyncio.get_running_loop().run_in_executor(None, link.room_closed, room, handoffs)
+
+
+"""
+Runs the rooms and spectators the supervisor hands an asyncio worker, until the supervisor
+is gone. Players are matched and greeted by the supervisor, so there is no UDP or resuming here.
+
+link: the worker's SupervisorLink
+"""
+async def serve_rooms(options, link) -> None:
+    heartbeats = Heartbeats(options["heartbeat_interval"], options["heartbeat_timeout"]) \
+        if options.get("heartbeat_interval") else None
+
+    returning = set()  # keeps the send_back() tasks alive until they finish
+
+    def requeue(room, clients):
+        task = asyncio.create_task(send_back(room, clients, link, heartbeats))
+        returning.add(task)
+        task.add_done_callback(returning.discard)
+
+    lobby = Lobby(lambda room: asyncio.create_task(run_room(room, lobby, options)),
+                  options.get("players_per_match", 2), requeue)
+    METRICS.gauges["lobby"] = lobby.stats
+
+    async def receive() -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            kind, *message = await loop.run_in_executor(None, link.receive)
+
+            if kind == OPEN_ROOM:
+                room_id, handoffs = message
+                lobby.open_room([await adopt(handoff, heartbeats) for handoff in handoffs], room_id)
+
+            elif kind == ADD_SPECTATOR:
+                client = await adopt(message[0], heartbeats)
+                logging.info(f"{client} is a spectator")
+                lobby.add_spectator(Spectator(client))
+
+    background = [heartbeats.async_run()] if heartbeats is not None else []
+
+    await asyncio.gather(receive(), *background)
+
+
+def main(ip, port, options, protocols) -> None:
+    asyncio.run(serve(ip, port, options, protocols))
+
+
+"""
+Runs an asyncio worker, see serve_rooms()
+"""
+def work(options, link) -> None:
+    asyncio.run(serve_rooms(options, link))
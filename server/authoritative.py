@@ -0,0 +1,347 @@
+import logging
+import asyncio
+import random
+
+from networking import async_send, async_receive, async_broadcast, DISCONNECTED
+from metrics import METRICS
+from protocol import DECODE_ERRORS
+from simulation import BoardState
+from frames import FrameEncoder, SNAPSHOT, INPUT
+
+
+# Snake colors for each player, shown on the other players' screens
+PLAYER_COLORS = ((0, 155, 255), (255, 155, 0), (0, 200, 90), (200, 90, 255),
+                 (255, 230, 0), (255, 90, 160), (0, 220, 220), (170, 170, 170))
+
+MAX_CATCH_UP = 3  # ticks the loop may run back to back after a stall before it skips ahead instead
+
+
+"""
+A game the server runs itself, for any number of players. Clients only send
+["I", dir_x, dir_y] when they turn, and every tick the server sends everyone one snapshot
+with a frame for each player's board.
+
+A player whose snake dies gets {"result": "lost", "score": length} straight away and the
+others play on; the last snake left, or the first to reach apple_goal, wins. Everyone
+still playing at the end gets {"result": "won" | "lost" | "draw" | "left", "score": length},
+where "draw" means the last snakes died on the same tick and "left" that the other
+players disconnected.
+
+With sessions, a player whose connection drops has sessions.timeout seconds to reconnect
+with their token (see rejoin()). Their snake keeps going the way it was in the meantime.
+"""
+class AuthoritativeGame:
+    def __init__(self, clients, options, rng=random, broadcast=None, recorder=None, udp=None, sessions=None,
+                 tokens=()):
+        self.clients = clients
+        self.broadcast = broadcast  # spectators watching the game, if any
+        self.recorder = recorder  # records every snapshot, if recording is on
+        self.udp = udp  # UdpChannel for clients that get snapshots over UDP, if it is on
+        self.sessions = sessions  # Sessions that reconnecting players are looked up in, if resuming is on
+        self.tokens = tokens  # each player's session token
+        self.board_size = options["board_size"]
+        self.apple_goal = options["apple_goal"]
+        self.tick_length = (options["speed"] + 1) / 60  # the client moves once every speed + 1 frames at 60 fps
+
+        self.boards = [BoardState(self.board_size, rng) for _ in clients]
+        self.encoders = [FrameEncoder(PLAYER_COLORS[i % len(PLAYER_COLORS)]) for i in range(len(clients))]
+
+        self.ended = asyncio.Event()
+        self.left = set()  # indices of players that disconnected
+        self.out = set()  # indices of players whose snake died
+        self.results = {}  # index: result of the players that were sent their result
+        self.dropped = {}  # index: loop time by which a player whose connection dropped has to be back
+        self.readers = {}  # index: task reading the player's current connection
+
+    """
+    Returns: the indices of the players whose snakes are still moving
+    """
+    def playing(self) -> list:
+        return [index for index in range(len(self.clients)) if index not in self.out and index not in self.left]
+
+    """
+    Reads a player's turns until their game ends, then discards their packets until "ready2".
+
+    Returns: whether the player is still connected and ready for another game
+    """
+    async def read_inputs(self, index) -> bool:
+        client = self.clients[index]
+
+        while True:
+            try:
+                message = await async_receive(client)
+
+            except DECODE_ERRORS:
+                logging.warning(f"Invalid packet received from socket {client}")
+                client.stats.invalid_packets += 1
+                continue
+
+            if message == DISCONNECTED:
+                if self.clients[index] is client:  # not already replaced by a reconnected client
+                    self.drop(index)
+
+                return False
+
+            if self.ended.is_set() or index in self.results:
+                if message == "ready2":
+                    return True
+
+                continue
+
+            if type(message) == list and len(message) == 3 and message[0] == INPUT:
+                self.boards[index].snake.turn((message[1], message[2]))
+
+    """
+    Waits for a player whose connection dropped to come back, or lets them leave straight
+    away if they can't resume
+    """
+    def drop(self, index) -> None:
+        if self.sessions is None or self.ended.is_set() or index in self.results:
+            self.leave(index)
+            return
+
+        logging.info(f"Player {index} dropped, waiting {self.sessions.timeout} s for them to come back")
+        self.dropped[index] = asyncio.get_running_loop().time() + self.sessions.timeout
+
+    def leave(self, index) -> None:
+        self.dropped.pop(index, None)
+        self.left.add(index)
+
+        if len(self.playing()) < 2:
+            self.ended.set()
+
+    """
+    Lets the dropped players that didn't come back in time leave
+    """
+    def expire_dropped(self, now) -> None:
+        for index, deadline in list(self.dropped.items()):
+            if now >= deadline:
+                logging.info(f"Player {index} didn't come back")
+                self.leave(index)
+
+    """
+    Puts a player whose connection dropped back in the game on a new connection. The client
+    gets {"resumed": true}, then a snapshot with a keyframe for every board, then the game's
+    snapshots like everyone else. A player can also take over from a connection the server
+    hasn't noticed is gone yet.
+
+    Returns: whether the player was taken back, False if their game is over
+    """
+    def rejoin(self, index, client) -> bool:
+        if self.ended.is_set() or index in self.left or index in self.results:
+            return False
+
+        old = self.clients[index]
+        self.clients[index] = client
+        self.dropped.pop(index, None)
+        old.close()
+
+        # Both are written before anything is awaited, so the keyframes reach the client
+        # ahead of any snapshot that builds on them
+        data = client.codec.encode({"resumed": True}) + client.codec.encode(self.keyframe_snapshot())
+        client.writer.write(data)
+
+        client.stats.frames_out += 2
+        client.stats.bytes_out += len(data)
+        client.stats.queued(client.queue_depth())
+
+        self.readers[index] = asyncio.create_task(self.read_inputs(index))
+
+        logging.info(f"{client} took player {index}'s place again")
+        METRICS.sessions_resumed += 1
+
+        return True
+
+    """
+    Returns: the frame of a player's board for this tick
+    """
+    def frame(self, index, playing) -> list:
+        encoder, board = self.encoders[index], self.boards[index]
+
+        if index in playing:
+            return encoder.encode(board.snake.coords, board.apple)
+
+        # A board that stopped can't be sent as deltas, which always move the head
+        encoder.tick += 1
+        return encoder.keyframe(encoder.tick - 1, board.snake.coords, board.apple)
+
+    def snapshot(self) -> list:
+        playing = set(self.playing())
+        return [SNAPSHOT, [self.frame(index, playing) for index in range(len(self.clients))]]
+
+    """
+    Returns: the last snapshot with a keyframe for every board, for UDP where a snapshot
+    can't rely on the ones before it having arrived, and for players that reconnect
+    """
+    def keyframe_snapshot(self) -> list:
+        return [SNAPSHOT, [encoder.keyframe(encoder.tick - 1, board.snake.coords, board.apple)
+                           for encoder, board in zip(self.encoders, self.boards)]]
+
+    """
+    Sends a snapshot to every player still in the game: over UDP to the players that
+    registered for it, and over TCP to the rest. Players on UDP may have missed the frames
+    the snapshot's deltas build on, so when the keyframes stop fitting in a datagram they
+    get them over TCP once, then the snapshots' deltas over TCP until they fit again.
+
+    udp: False to send over TCP only
+    """
+    async def send_snapshot(self, snapshot, udp=True) -> None:
+        receivers = self.receivers()
+
+        if udp and self.udp is not None and any(client.udp_address is not None for client in receivers):
+            keyframes = self.keyframe_snapshot()
+            unsent = self.udp.send(receivers, keyframes)
+
+            for client in receivers:
+                if client not in unsent:
+                    client.udp_fallback = False
+
+            fallback = [client for client in unsent if client.udp_address is not None and not client.udp_fallback]
+
+            for client in fallback:
+                client.udp_fallback = True
+
+            await async_broadcast(fallback, keyframes)
+            receivers = [client for client in unsent if client not in fallback]
+
+        await async_broadcast(receivers, snapshot)
+
+    """
+    playing: the players whose snakes moved this tick
+
+    Returns: ({index: result} for the players whose game ended this tick, whether the whole game ended)
+    """
+    def tick_results(self, playing):
+        won = [index for index in playing if self.boards[index].snake.won(self.apple_goal)]
+
+        if won:
+            return {index: "won" if index in won else "lost" for index in playing}, True
+
+        lost = [index for index in playing if self.boards[index].snake.lost(self.board_size)]
+        self.out.update(lost)
+        remaining = self.playing()
+
+        if not remaining:
+            return dict.fromkeys(lost, "draw" if len(lost) > 1 else "lost"), True
+
+        if len(remaining) == 1 and lost:
+            return {**dict.fromkeys(lost, "lost"), remaining[0]: "won"}, True
+
+        return dict.fromkeys(lost, "lost"), False
+
+    """
+    Hands a snapshot to the spectators and the recording, neither of which waits on the network or disk
+    """
+    def spectate(self, snapshot) -> None:
+        if self.broadcast is not None:
+            self.broadcast.send(snapshot)
+
+        if self.recorder is not None:
+            self.recorder.record_snapshot(snapshot)
+
+    """
+    Sends players their results. When the game is over, the spectators get every player's result.
+
+    results: {index: result}
+    """
+    async def send_results(self, results, game_over=False) -> None:
+        self.results.update(results)
+
+        for index, result in results.items():
+            if index not in self.left and index not in self.dropped:
+                await async_send(self.clients[index], {"result": result, "score": len(self.boards[index].snake.coords)})
+
+        if game_over and self.broadcast is not None:
+            self.broadcast.send({"results": [{"result": self.results.get(index, "left"),
+                                              "score": len(board.snake.coords)}
+                                             for index, board in enumerate(self.boards)]}, skippable=False)
+
+    """
+    Returns: the clients that still get snapshots, the ones whose game hasn't ended and that are connected
+    """
+    def receivers(self) -> list:
+        return [client for index, client in enumerate(self.clients)
+                if index not in self.results and index not in self.left and index not in self.dropped]
+
+    """
+    Fixed timestep tick loop. Ticks are scheduled from the loop's clock rather than
+    after each other, so time spent sending doesn't slow the game down.
+    """
+    async def tick_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+
+        # Every client draws the starting boards straight away. The first snapshot goes over
+        # TCP, so it can't overtake the start info
+        snapshot = self.snapshot()
+        self.spectate(snapshot)
+        await self.send_snapshot(snapshot, udp=False)
+
+        while not self.ended.is_set():
+            next_tick += self.tick_length
+            delay = next_tick - loop.time()
+
+            if delay < -MAX_CATCH_UP * self.tick_length:  # too far behind, drop the missed ticks
+                next_tick = loop.time()
+                delay = 0
+
+            try:
+                await asyncio.wait_for(self.ended.wait(), max(delay, 0))
+                break  # too many players left
+
+            except asyncio.TimeoutError:
+                pass
+
+            self.expire_dropped(loop.time())
+
+            if self.ended.is_set():
+                break
+
+            playing = self.playing()
+
+            for index in playing:
+                self.boards[index].step()
+
+            snapshot = self.snapshot()
+            self.spectate(snapshot)
+            await self.send_snapshot(snapshot)
+
+            results, game_over = self.tick_results(playing)
+
+            if game_over:
+                logging.info(f"Game ended with {results}")
+                self.ended.set()
+
+            if results:
+                await self.send_results(results, game_over)
+
+        # The game stopped because the other players left
+        unresolved = [index for index in range(len(self.clients)) if index not in self.results and index not in self.left]
+
+        if unresolved:
+            await self.send_results(dict.fromkeys(unresolved, "left"), game_over=True)
+
+    """
+    Returns: the clients that are ready for another game
+    """
+    async def run(self) -> list:
+        if self.sessions is not None:
+            self.sessions.register(self.tokens, self)
+
+        self.readers = {index: asyncio.create_task(self.read_inputs(index)) for index in range(len(self.clients))}
+
+        try:
+            await self.tick_loop()
+
+        finally:
+            if self.sessions is not None:
+                self.sessions.revoke(self.tokens)
+
+        ready = []
+
+        # A player that came back has a new reader, so look each one up after the game
+        for index in range(len(self.clients)):
+            if await self.readers[index]:
+                ready.append(self.clients[index])
+
+        return ready
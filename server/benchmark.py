@@ -0,0 +1,186 @@
+import tracemalloc
+import argparse
+import random
+import json
+import time
+import sys
+
+from simulation import BoardState
+
+
+"""
+Benchmarks the game rules in simulation.py without a display or a network.
+
+Each case puts a snake on a board of the given size, covering the given share of the cells,
+and moves it along a path that visits every cell, so it never dies and keeps eating apples
+wherever they spawn. That exercises moving, collision checks, growing and apple spawning
+at the fill ratio being measured.
+
+Run from the server directory:
+    python benchmark.py
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+
+--compare exits with status 1 if any case got slower by more than --tolerance.
+"""
+
+BOARD_SIZES = (20, 100, 400)
+FILL_RATIOS = (0.01, 0.5, 0.9)
+TICKS = 20000
+
+
+"""
+Returns: the cells of a board with an even size in an order that visits every cell once
+and ends next to where it started. Rows are walked back and forth right of the first
+column, and the first column leads back up.
+"""
+def cycle(board_size) -> list:
+    cells = []
+
+    for y in range(board_size):
+        xs = range(1, board_size) if y % 2 == 0 else range(board_size - 1, 0, -1)
+        cells.extend((x, y) for x in xs)
+
+    cells.extend((0, y) for y in range(board_size - 1, -1, -1))
+
+    return cells
+
+
+"""
+Returns: a board with a snake of the given length lying along the cycle, head last
+"""
+def make_board(board_size, length, path, rng) -> BoardState:
+    board = BoardState(board_size, rng)
+    board.snake.coords.pop_tail()
+
+    for x, y in path[:length]:
+        board.snake.coords.append_cell(board.snake.coords.pack(x, y))
+
+    board.regenerate_apple()
+
+    return board
+
+
+"""
+Runs one case repeat times and keeps the best time, which is the one least disturbed
+by the rest of the machine.
+
+Returns: {"ticks_per_second", "worst_tick_us", "apples", "peak_kib", "blocks"}.
+ticks_per_second only counts time spent in ticks, not setting boards up. blocks is the
+number of memory blocks still allocated after the run and peak_kib the most memory
+traced at once, both measured in a separate run with tracemalloc on.
+"""
+def run_case(board_size, fill, ticks, repeat=5, seed=0) -> dict:
+    path = cycle(board_size)
+    length = max(2, int(board_size * board_size * fill))
+
+    def play(board):
+        apples = 0
+        total = worst = 0
+        position = length - 1  # index of the head on the cycle
+        timer = time.perf_counter_ns
+
+        for _ in range(ticks):
+            head = path[position]
+            position = (position + 1) % len(path)
+            after = path[position]
+
+            start = timer()
+
+            board.snake.turn((after[0] - head[0], after[1] - head[1]))
+            old_apple = board.apple
+            board.step()
+            board.snake.lost(board_size)
+            won = board.snake.won(board_size * board_size)
+
+            took = timer() - start
+            total += took
+            worst = max(worst, took)
+
+            if board.apple != old_apple:
+                apples += 1
+
+            if won:  # the snake filled the board
+                board = make_board(board_size, length, path, random.Random(seed))
+                position = length - 1
+
+        return apples, total, worst
+
+    elapsed = worst = float("inf")
+
+    for _ in range(repeat):
+        board = make_board(board_size, length, path, random.Random(seed))
+
+        apples, run_total, run_worst = play(board)
+        elapsed = min(elapsed, run_total / 1e9)
+        worst = min(worst, run_worst)
+
+    board = make_board(board_size, length, path, random.Random(seed))
+
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    play(board)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sys.getallocatedblocks() - blocks
+
+    return {
+        "ticks_per_second": round(ticks / elapsed),
+        "worst_tick_us": round(worst / 1000, 1),
+        "apples": apples,
+        "peak_kib": round(peak / 1024, 1),
+        "blocks": blocks
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the game rules")
+    parser.add_argument("--ticks", type=int, default=TICKS)
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each case, the best one counts")
+    parser.add_argument("--sizes", type=int, nargs="+", default=BOARD_SIZES, help="even board sizes")
+    parser.add_argument("--fills", type=float, nargs="+", default=FILL_RATIOS, help="share of the board the snake covers")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare ticks per second with results saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown allowed by --compare")
+    args = parser.parse_args()
+
+    results = {}
+
+    print(f"{'board':>6} {'fill':>5} {'ticks/s':>10} {'worst us':>9} {'apples':>7} {'peak KiB':>9} {'blocks':>7}")
+
+    for board_size in args.sizes:
+        for fill in args.fills:
+            result = run_case(board_size, fill, args.ticks, args.repeat)
+            results[f"{board_size}x{fill}"] = result
+
+            print(f"{board_size:>6} {fill:>5} {result['ticks_per_second']:>10} {result['worst_tick_us']:>9} "
+                  f"{result['apples']:>7} {result['peak_kib']:>9} {result['blocks']:>7}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        slower = []
+
+        for case, result in results.items():
+            if case not in baseline:
+                continue
+
+            ratio = result["ticks_per_second"] / baseline[case]["ticks_per_second"]
+
+            if ratio < 1 - args.tolerance:
+                slower.append(f"{case}: {ratio:.0%} of the baseline")
+
+        if slower:
+            print("Slower than the baseline:\n" + "\n".join(slower))
+            sys.exit(1)
+
+        print("No case is slower than the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+import argparse
+import logging
+import asyncio
+import random
+import socket
+import time
+
+from networking import async_send, async_receive, DISCONNECTED
+from protocol import CODECS, SUPPORTED_PROTOCOLS, PROTOCOL_JSON, DECODE_ERRORS, hello
+from frames import FrameEncoder, KEYFRAME, DELTA
+from simulation import BoardState, DIRECTIONS
+from async_server import AsyncClient
+
+
+"""
+Headless bots for load testing a server. Each bot connects like the real client: it sends
+the hello, waits for "start", board_size, speed and apple_goal (and the match info), then
+plays a snake on its own board and streams its frames at the game's tick rate. When its
+game ends it sends "ready" and "ready2" and waits for the next "start", like the client.
+
+Every bot's frame ticks start at a different multiple of TICK_BASE, so a bot that receives
+a relayed frame knows which bot sent it and when, and the relay latency is measured on
+one clock.
+
+Run from the server directory with the server running:
+    python bots.py --bots 500 --games 3
+
+The bots share one event loop. With many bots, check the reported loop lag: if it is
+high, the bots themselves are the bottleneck and the latencies are too high.
+Running thousands of bots may need a higher open file limit (ulimit -n).
+"""
+
+TICK_BASE = 100000  # ticks available to each bot per game, frame ticks are 32 bit in the binary protocol
+BOT_COLOR = (128, 128, 128)
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.games = 0
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.latencies = []  # seconds, since the last report
+        self.loop_lag = 0  # worst event loop lag since the last report, in seconds
+
+    """
+    Returns: a line with the numbers since the last call, and resets them
+    """
+    def report(self, elapsed) -> str:
+        latencies = sorted(self.latencies)
+        self.latencies = []
+
+        if latencies:
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+            latency = (f"latency ms p50 {percentile(0.5):.1f} p90 {percentile(0.9):.1f} "
+                       f"p99 {percentile(0.99):.1f} max {latencies[-1] * 1000:.1f}")
+
+        else:
+            latency = "no frames relayed"
+
+        line = (f"{self.connected} bots, {self.games} bot games, {self.frames_sent / elapsed:.0f} frames/s sent, "
+                f"{self.frames_received / elapsed:.0f} frames/s received, {latency}, "
+                f"loop lag {self.loop_lag * 1000:.0f} ms")
+
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.loop_lag = 0
+
+        return line
+
+
+class Bot:
+    def __init__(self, index, bots, stats, rng):
+        self.index = index
+        self.bots = bots  # every bot by index, to find who sent a frame
+        self.stats = stats
+        self.rng = rng
+
+        self.client = None
+        self.sent = {}  # tick: time.perf_counter() when the frame with that tick was sent
+        self.game_over = asyncio.Event()
+
+    """
+    Connects and sends the hello.
+
+    Returns: whether the server answered the hello
+    """
+    async def connect(self, ip, port, protocols) -> bool:
+        reader, writer = await asyncio.open_connection(ip, port)
+        self.client = AsyncClient(reader, writer)
+
+        await async_send(self.client, hello(protocols))
+        reply = await async_receive(self.client)
+
+        if type(reply) != dict or "protocol" not in reply:
+            return False
+
+        self.client.codec = CODECS.get(reply["protocol"], self.client.codec)
+        self.client.hello = reply
+
+        return True
+
+    """
+    Picks a turn that doesn't run into a wall or the snake, if there is one.
+    """
+    def choose_direction(self, board):
+        snake = board.snake
+        head_x, head_y = snake.coords.head
+        options = [snake.dir] * 4 + list(DIRECTIONS) if snake.dir != (0, 0) else list(DIRECTIONS)
+        self.rng.shuffle(options)
+
+        for direction in options:
+            cell = (head_x + direction[0], head_y + direction[1])
+
+            if direction != (-snake.prev_frame_dir[0], -snake.prev_frame_dir[1]) and \
+                    0 <= cell[0] < board.board_size and 0 <= cell[1] < board.board_size and cell not in snake.coords:
+                return direction
+
+        return snake.dir
+
+    """
+    Plays the bot's board at the tick rate until it loses, wins, reaches max_ticks or the
+    opponent's game ends.
+    """
+    async def play(self, board_size, speed, apple_goal, max_ticks) -> None:
+        board = BoardState(board_size, self.rng)
+        encoder = FrameEncoder(BOT_COLOR)
+        encoder.tick = self.index * TICK_BASE
+        self.sent = {}
+
+        loop = asyncio.get_running_loop()
+        tick_length = (speed + 1) / 60
+        next_tick = loop.time()
+
+        for _ in range(min(max_ticks, TICK_BASE)):
+            self.sent[encoder.tick] = time.perf_counter()
+
+            if not await async_send(self.client, encoder.encode(board.snake.coords, board.apple)):
+                return
+
+            self.stats.frames_sent += 1
+
+            next_tick += tick_length
+
+            try:
+                await asyncio.wait_for(self.game_over.wait(), max(next_tick - loop.time(), 0))
+                return  # the opponent's game ended
+
+            except asyncio.TimeoutError:
+                pass
+
+            board.snake.turn(self.choose_direction(board))
+            board.step()
+
+            if board.snake.won(apple_goal):
+                await async_send(self.client, "won")
+                return
+
+            if board.snake.lost(board_size):
+                break
+
+        await async_send(self.client, "lost")
+
+    """
+    Returns: whether the server closed the connection. The server also relays
+    DISCONNECTED when the opponent leaves, which doesn't count.
+    """
+    def disconnected(self, message) -> bool:
+        return message == DISCONNECTED and self.client.reader.at_eof()
+
+    """
+    Reads the opponent's frames until their game ends, measuring how long each frame took to arrive.
+    Cancelled when this bot's game ends first.
+    """
+    async def read_frames(self) -> None:
+        while True:
+            try:
+                message = await async_receive(self.client)
+
+            except DECODE_ERRORS:
+                continue
+
+            if type(message) == str:  # "won", "lost" or DISCONNECTED, the opponent's game ended
+                self.game_over.set()
+                return
+
+            if type(message) == list and message[0] in (KEYFRAME, DELTA):
+                self.stats.frames_received += 1
+
+                sender = self.bots.get(message[1] // TICK_BASE)
+                sent = sender.sent.pop(message[1], None) if sender is not None else None
+
+                if sent is not None:
+                    self.stats.latencies.append(time.perf_counter() - sent)
+
+    """
+    Waits for the start info.
+
+    Returns: (board_size, speed, apple_goal, match_info), or None if the server disconnected
+    """
+    async def wait_for_start(self):
+        while True:
+            try:
+                message = await async_receive(self.client)
+
+            except DECODE_ERRORS:
+                continue
+
+            if self.disconnected(message):
+                return None
+
+            if message == "start":
+                break
+
+        board_size = await async_receive(self.client)
+        speed = await async_receive(self.client)
+        apple_goal = await async_receive(self.client)
+        match_info = await async_receive(self.client) if self.client.hello is not None else {"mode": "relay"}
+
+        return board_size, speed, apple_goal, match_info
+
+    async def run(self, ip, port, protocols, games, max_ticks) -> None:
+        try:
+            await self.connect(ip, port, protocols)
+
+        except OSError as e:
+            logging.warning(f"Bot {self.index} could not connect: {e}")
+            return
+
+        self.stats.connected += 1
+
+        try:
+            for game in range(games):
+                start = await self.wait_for_start()
+
+                if start is None:
+                    break
+
+                board_size, speed, apple_goal, match_info = start
+
+                if match_info.get("mode", "relay") != "relay":
+                    logging.warning("Bots only play relayed games, turn off authoritative on the server")
+                    break
+
+                self.game_over.clear()
+                reader = asyncio.create_task(self.read_frames())
+
+                await self.play(board_size, speed, apple_goal, max_ticks)
+
+                # The opponent's remaining frames are skipped while waiting for the next start
+                reader.cancel()
+                await asyncio.wait([reader])
+
+                self.stats.games += 1
+
+                if game == games - 1:
+                    break
+
+                await async_send(self.client, "ready")
+                await async_send(self.client, "ready2")
+
+        finally:
+            self.stats.connected -= 1
+            self.client.close()
+
+
+async def watch_loop_lag(stats, interval=0.1) -> None:
+    loop = asyncio.get_running_loop()
+
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        stats.loop_lag = max(stats.loop_lag, loop.time() - start - interval)
+
+
+async def run_bots(args) -> None:
+    stats = Stats()
+    rng = random.Random(args.seed)
+    protocols = (PROTOCOL_JSON,) if args.json else SUPPORTED_PROTOCOLS
+
+    bots = {}
+    tasks = []
+
+    lag_watcher = asyncio.create_task(watch_loop_lag(stats))
+
+    async def report():
+        last = time.perf_counter()
+
+        while True:
+            await asyncio.sleep(args.report)
+            now = time.perf_counter()
+            print(stats.report(now - last), flush=True)
+            last = now
+
+    reporter = asyncio.create_task(report())
+    started = time.perf_counter()
+
+    for index in range(args.bots):
+        bot = Bot(index, bots, stats, random.Random(rng.random()))
+        bots[index] = bot
+        tasks.append(asyncio.create_task(bot.run(args.ip, args.port, protocols, args.games, args.game_ticks)))
+
+        await asyncio.sleep(1 / args.connect_rate)
+
+    await asyncio.gather(*tasks)
+
+    reporter.cancel()
+    lag_watcher.cancel()
+
+    print(f"Done in {time.perf_counter() - started:.1f} s, {stats.games} bot games played")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Put load on a server with headless bot clients")
+    parser.add_argument("--ip", default=socket.gethostbyname(socket.gethostname()))
+    parser.add_argument("--port", type=int, default=9850)
+    parser.add_argument("--bots", type=int, default=100)
+    parser.add_argument("--games", type=int, default=1, help="games each bot plays before disconnecting")
+    parser.add_argument("--game-ticks", type=int, default=400, help="ticks after which a bot gives up its game")
+    parser.add_argument("--connect-rate", type=float, default=200, help="new connections per second")
+    parser.add_argument("--report", type=float, default=5, help="seconds between reports")
+    parser.add_argument("--json", action="store_true", help="only offer the JSON protocol")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.WARNING)
+
+    if args.bots * TICK_BASE >= 2 ** 32:
+        parser.error(f"at most {2 ** 32 // TICK_BASE} bots")
+
+    asyncio.run(run_bots(args))
+
+
+if __name__ == "__main__":
+    main()
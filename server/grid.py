@@ -0,0 +1,133 @@
+# Snake storage shared by the client and the server.
+# client/grid.py and server/grid.py must be kept identical.
+
+import collections
+import array
+
+
+"""
+A snake's cells from tail to head, stored as packed indices into the board with a one cell
+wall around it, plus a count of what is on each cell. The counts are kept up to date as
+the snake moves, so moving, growing and every collision check take the same time however
+long the snake is.
+
+It also keeps every free cell on the board in an array, with each cell's position in
+that array, so a random free cell can be picked straight away however full the board is.
+
+Behaves like a sequence of (x, y) coordinates from tail to head, so it can be passed
+straight to FrameEncoder.encode().
+
+The head may leave the board by one cell, onto the wall, which is where the snake loses.
+"""
+class SnakeBody:
+    __slots__ = ("board_size", "width", "cells", "occupancy", "free", "free_position")
+
+    def __init__(self, coords, board_size):
+        self.board_size = board_size
+        self.width = board_size + 2  # one wall cell on each side
+
+        self.cells = collections.deque()  # packed indices, tail first
+        self.occupancy = bytearray(self.width * self.width)  # snake cells on each cell, walls count as one
+
+        for i in range(self.width):
+            self.occupancy[i] = 1  # top
+            self.occupancy[-1 - i] = 1  # bottom
+            self.occupancy[i * self.width] = 1  # left
+            self.occupancy[i * self.width + self.width - 1] = 1  # right
+
+        self.free = array.array("i")  # packed indices of the cells nothing is on, in no order
+        self.free_position = array.array("i", [-1]) * len(self.occupancy)  # index into free, -1 if not free
+
+        for index in range(len(self.occupancy)):
+            if not self.occupancy[index]:
+                self.free_position[index] = len(self.free)
+                self.free.append(index)
+
+        for x, y in coords:
+            self.append_cell(self.pack(x, y))
+
+    def pack(self, x, y) -> int:
+        return (y + 1) * self.width + x + 1
+
+    def unpack(self, index) -> tuple:
+        y, x = divmod(index, self.width)
+        return x - 1, y - 1
+
+    def append_cell(self, index) -> None:
+        self.cells.append(index)
+        self.occupancy[index] += 1
+
+        if self.occupancy[index] == 1:
+            self.remove_free(index)
+
+    """
+    Adds a new head one cell from the current head in the given direction
+    """
+    def push_head(self, direction) -> None:
+        self.append_cell(self.cells[-1] + direction[0] + direction[1] * self.width)
+
+    def pop_tail(self) -> None:
+        index = self.cells.popleft()
+        self.occupancy[index] -= 1
+
+        if not self.occupancy[index]:
+            self.free_position[index] = len(self.free)
+            self.free.append(index)
+
+    """
+    Removes a cell from the free cells by moving the last free cell into its place
+    """
+    def remove_free(self, index) -> None:
+        position = self.free_position[index]
+        last = self.free.pop()
+
+        if last != index:
+            self.free[position] = last
+            self.free_position[last] = position
+
+        self.free_position[index] = -1
+
+    """
+    rng: anything with randrange(), like the random module
+
+    Returns: the (x, y) of a random cell the snake isn't on, or None if the board is full
+    """
+    def random_free_cell(self, rng):
+        if not self.free:
+            return None
+
+        return self.unpack(self.free[rng.randrange(len(self.free))])
+
+    def full(self) -> bool:
+        return not self.free
+
+    @property
+    def head(self) -> tuple:
+        return self.unpack(self.cells[-1])
+
+    """
+    Returns: whether the head is off the board or on another part of the snake
+    """
+    def collided(self) -> bool:
+        return self.occupancy[self.cells[-1]] > 1
+
+    """
+    Returns: whether the snake covers the cell at (x, y)
+    """
+    def __contains__(self, coord) -> bool:
+        x, y = coord
+
+        if x < 0 or x >= self.board_size or y < 0 or y >= self.board_size:
+            return False
+
+        return self.occupancy[self.pack(x, y)] > 0
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __iter__(self):
+        for index in self.cells:
+            yield self.unpack(index)
+
+    def __getitem__(self, i) -> tuple:
+        return self.unpack(self.cells[i])
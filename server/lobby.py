@@ -0,0 +1,202 @@
+import collections
+import itertools
+import threading
+import logging
+import time
+
+from spectators import Broadcast
+
+
+"""
+First come, first served queue of clients waiting for a match.
+
+Enqueue and dequeue are O(1). Cancelling a waiting client is also O(1): the
+client is dropped from the waiting set and its stale queue entry is skipped
+when it reaches the front.
+"""
+class MatchmakingQueue:
+    def __init__(self):
+        self.queue = collections.deque()
+        self.waiting = set()
+        self.lock = threading.Lock()
+
+    def enqueue(self, client, front=False) -> None:
+        with self.lock:
+            if client in self.waiting:
+                return
+
+            self.waiting.add(client)
+
+            if front:
+                self.queue.appendleft(client)
+            else:
+                self.queue.append(client)
+
+    """
+    Returns: whether the client was waiting
+    """
+    def cancel(self, client) -> bool:
+        with self.lock:
+            if client not in self.waiting:
+                return False
+
+            self.waiting.remove(client)
+            return True
+
+    """
+    Removes and returns `size` clients in arrival order, or None if fewer are waiting.
+    """
+    def dequeue_group(self, size):
+        with self.lock:
+            if len(self.waiting) < size:
+                return None
+
+            group = []
+
+            while len(group) < size:
+                client = self.queue.popleft()
+
+                if client in self.waiting:  # skip cancelled entries
+                    self.waiting.remove(client)
+                    group.append(client)
+
+            return group
+
+    def __len__(self):
+        return len(self.waiting)
+
+
+"""
+A group of matched clients that play game after game together until one of them leaves
+"""
+class Room:
+    STARTING = "starting"
+    PLAYING = "playing"
+    REMATCH = "rematch"
+    CLOSED = "closed"
+
+    def __init__(self, room_id, clients):
+        self.id = room_id
+        self.clients = clients
+        self.state = Room.STARTING
+        self.games_played = 0
+        self.created = time.monotonic()
+        self.runner = None  # thread or task running the room, set by the lobby
+        self.broadcast = Broadcast()  # spectators watching the room
+
+    def __repr__(self):
+        return f"Room({self.id}, {self.state}, {self.clients})"
+
+
+"""
+Pairs arriving clients into rooms that run independently of each other.
+
+start_room: callable that starts running a room in the background (a thread or
+            an asyncio task) and returns a handle to it. The room must call
+            close_room() when it finishes.
+requeue: called with (room, ready_clients) when a room closes, instead of putting
+         the clients back in this lobby's queue. Used by workers, whose players
+         are matched by the supervisor.
+"""
+class Lobby:
+    def __init__(self, start_room, players_per_room=2, requeue=None):
+        self.start_room = start_room
+        self.players_per_room = players_per_room
+        self.requeue = requeue
+
+        self.queue = MatchmakingQueue()
+        self.rooms = {}
+        self.room_ids = itertools.count(1)
+        self.spectators = []  # spectators waiting for a room to open
+        self.lock = threading.Lock()
+
+    def add_client(self, client, front=False) -> None:
+        self.queue.enqueue(client, front)
+        self.make_rooms()
+
+    """
+    Takes a client that disconnected out of the queue.
+
+    Returns: whether the client was waiting, False if it is in a room, which notices by itself
+    """
+    def remove_client(self, client) -> bool:
+        return self.queue.cancel(client)
+
+    """
+    Puts a spectator in the open room with the fewest spectators, or keeps it
+    until a room opens.
+    """
+    def add_spectator(self, spectator) -> None:
+        with self.lock:
+            rooms = list(self.rooms.values())
+
+            if not rooms:
+                self.spectators.append(spectator)
+                return
+
+        room = min(rooms, key=lambda room: len(room.broadcast))
+        room.broadcast.add(spectator)
+        logging.info(f"{spectator} is watching {room}")
+
+    def make_rooms(self) -> None:
+        while True:
+            clients = self.queue.dequeue_group(self.players_per_room)
+
+            if clients is None:
+                return
+
+            self.open_room(clients)
+
+    """
+    Starts a room for clients that were matched. Spectators waiting for a room watch it.
+
+    room_id: the room's number, taken from this lobby's count if None
+    """
+    def open_room(self, clients, room_id=None) -> Room:
+        with self.lock:
+            room = Room(next(self.room_ids) if room_id is None else room_id, clients)
+            self.rooms[room.id] = room
+
+            spectators, self.spectators = self.spectators, []
+
+        logging.info(f"Opened {room}")
+
+        for spectator in spectators:
+            if not spectator.closed:
+                room.broadcast.add(spectator)
+        room.runner = self.start_room(room)
+
+        return room
+
+    """
+    Removes a finished room. Clients that are still connected and ready go back
+    to the front of the queue, since they have already been waiting.
+    """
+    def close_room(self, room, ready_clients) -> None:
+        room.state = Room.CLOSED
+
+        with self.lock:
+            self.rooms.pop(room.id, None)
+
+        logging.info(f"Closed {room} after {room.games_played} game(s)")
+
+        if self.requeue is not None:
+            self.requeue(room, ready_clients)
+
+        else:
+            for client in reversed(ready_clients):
+                self.queue.enqueue(client, front=True)
+
+            self.make_rooms()
+
+        # Spectators move on to another room, or wait for the next one
+        for spectator in room.broadcast.connected():
+            self.add_spectator(spectator)
+
+    def stats(self) -> dict:
+        with self.lock:
+            states = collections.Counter(room.state for room in self.rooms.values())
+
+            spectators = len(self.spectators) + sum(len(room.broadcast) for room in self.rooms.values())
+
+        return {"waiting": len(self.queue), "rooms": sum(states.values()), "spectators": spectators, **states}
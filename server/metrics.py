@@ -0,0 +1,288 @@
+import http.server
+import threading
+import logging
+import weakref
+import bisect
+import json
+
+
+"""
+Counters for one connection. The networking functions add to them on every message,
+so they are plain attributes: an increment costs about as much as a local variable.
+"""
+class ConnectionStats:
+    COUNTERS = ("frames_in", "frames_out", "bytes_in", "bytes_out", "invalid_packets")  # added up into the totals
+    __slots__ = COUNTERS + ("queue_depth", "max_queue_depth", "peer")
+
+    def __init__(self, peer=None):
+        self.peer = peer  # "host:port" of the other end
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.invalid_packets = 0
+        self.queue_depth = 0  # bytes written but not sent yet, when last written to
+        self.max_queue_depth = 0  # most bytes that were waiting at once
+
+    """
+    Records the bytes waiting to be sent, after a write
+    """
+    def queued(self, depth) -> None:
+        self.queue_depth = depth
+
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.COUNTERS}
+
+    """
+    Returns: the connection's counters and its outbound queue depth, for the per-connection stats
+    """
+    def details(self) -> dict:
+        return {**self.as_dict(), "queue_depth": self.queue_depth, "max_queue_depth": self.max_queue_depth}
+
+
+"""
+Counts values into fixed buckets, so observing a value is a bisect and an increment
+and percentiles come from the bucket counts.
+
+bounds: the upper bound of each bucket, ascending. Larger values go in one last bucket.
+"""
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    """
+    Returns: the upper bound of the bucket holding the p-th value (0 to 1), None if nothing was observed
+    """
+    def percentile(self, p):
+        if not self.count:
+            return None
+
+        seen = 0
+
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            seen += count
+
+            if seen >= p * self.count:
+                return bound
+
+        return float("inf")
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "buckets": dict(zip([str(bound) for bound in self.bounds] + ["inf"], self.counts))
+        }
+
+
+"""
+Everything the server counts. Counters that belong to a connection live on the connection's
+ConnectionStats, and the totals add up the open connections with the ones that were closed,
+so the hot path never takes a lock. Increments from several threads may rarely be lost,
+which is fine for monitoring.
+"""
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.live = {}  # id: ConnectionStats of connections that are still around
+        self.closed = ConnectionStats()  # totals of connections that are gone
+
+        self.connections_accepted = 0
+        self.handshakes_pending = 0  # accepted connections still waiting for their hello
+        self.games_started = 0
+        self.games_finished = 0
+        self.frames_relayed = 0
+        self.heartbeat_timeouts = 0  # connections closed because they went quiet
+        self.sessions_resumed = 0  # players that reconnected to their game
+
+        self.relay_latency = Histogram([0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000])  # ms
+        self.game_duration = Histogram([5, 10, 30, 60, 120, 300, 600, 1800])  # seconds
+
+        self.gauges = {}  # name: callable returning a number or a dict, read when stats are asked for
+
+    """
+    Returns: the ConnectionStats for a new connection. Its counts are moved to the closed
+    totals once the connection object is garbage collected.
+
+    address: the other end's (host, port)
+    """
+    def track(self, connection, address) -> ConnectionStats:
+        stats = ConnectionStats(f"{address[0]}:{address[1]}")
+
+        with self.lock:
+            self.live[id(stats)] = stats
+
+        weakref.finalize(connection, self.retire, stats)
+
+        return stats
+
+    def retire(self, stats) -> None:
+        with self.lock:
+            self.live.pop(id(stats), None)
+
+            for name in ConnectionStats.COUNTERS:
+                setattr(self.closed, name, getattr(self.closed, name) + getattr(stats, name))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            live = list(self.live.values())
+            totals = self.closed.as_dict()
+
+        for stats in live:
+            for name in ConnectionStats.COUNTERS:
+                totals[name] += getattr(stats, name)
+
+        gauges = {}
+
+        for name, gauge in self.gauges.items():
+            try:
+                gauges[name] = gauge()
+
+            except Exception:
+                logging.exception(f"Gauge {name} failed")
+
+        return {
+            "connections_open": len(live),
+            "connections_accepted": self.connections_accepted,
+            "handshakes_pending": self.handshakes_pending,
+            "games_started": self.games_started,
+            "games_finished": self.games_finished,
+            "frames_relayed": self.frames_relayed,
+            "heartbeat_timeouts": self.heartbeat_timeouts,
+            "sessions_resumed": self.sessions_resumed,
+            **totals,
+            "queued_bytes": sum(stats.queue_depth for stats in live),  # waiting to be sent to the open connections
+            "relay_latency_ms": self.relay_latency.as_dict(),
+            "game_duration_s": self.game_duration.as_dict(),
+            **gauges,
+            "connections": {stats.peer: stats.details() for stats in live}
+        }
+
+    def as_text(self) -> str:
+        return format_text(self.snapshot())
+
+
+METRICS = Metrics()
+
+
+"""
+Returns: the snapshot as "name value" lines, with nested values joined by dots
+"""
+def format_text(snapshot) -> str:
+    lines = []
+
+    def add(prefix, value):
+        if type(value) == dict:
+            for key, item in value.items():
+                add(f"{prefix}.{key}", item)
+
+        else:
+            lines.append(f"{prefix} {value}")
+
+    for name, value in snapshot.items():
+        add(name, value)
+
+    return "\n".join(lines) + "\n"
+
+
+"""
+Returns: a Histogram holding the counts of several Histogram.as_dict() results with the same bounds
+"""
+def merge_histograms(histograms) -> Histogram:
+    bounds = [json.loads(bound) for bound in list(histograms[0]["buckets"])[:-1]]  # the last one is "inf"
+    merged = Histogram(bounds)
+
+    for histogram in histograms:
+        merged.counts = [total + count for total, count in zip(merged.counts, histogram["buckets"].values())]
+        merged.count += histogram["count"]
+
+        if histogram["count"]:
+            merged.total += histogram["mean"] * histogram["count"]
+
+    return merged
+
+
+"""
+Adds up the snapshots of several processes. Numbers are summed and histograms are merged
+bucket by bucket, so their percentiles cover every process.
+"""
+def merge_snapshots(snapshots) -> dict:
+    values = {}  # name: the value in each snapshot that has it
+
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            values.setdefault(name, []).append(value)
+
+    merged = {}
+
+    for name, items in values.items():
+        if type(items[0]) != dict:
+            merged[name] = sum(items)
+
+        elif "buckets" in items[0]:
+            merged[name] = merge_histograms(items).as_dict()
+
+        else:
+            merged[name] = merge_snapshots(items)
+
+    return merged
+
+
+class StatsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/stats.json":
+            body = json.dumps(self.server.metrics.snapshot(), indent=2).encode()
+            content_type = "application/json"
+
+        elif self.path in ("/", "/stats"):
+            body = self.server.metrics.as_text().encode()
+            content_type = "text/plain; charset=utf-8"
+
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+"""
+Serves the stats on localhost from a background thread, as plain text on /stats and
+JSON on /stats.json. Reading them never touches the game's threads or event loop.
+
+metrics: where the stats come from, anything with snapshot() and as_text()
+"""
+def start_stats_server(port, metrics=METRICS) -> None:
+    try:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StatsHandler)
+
+    except OSError as e:
+        logging.error(f"Could not serve stats on port {port}: {e}")
+        return
+
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    logging.info(f"Serving stats on http://127.0.0.1:{port}/stats")
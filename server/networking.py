@@ -0,0 +1,364 @@
+import selectors
+import threading
+import logging
+import asyncio
+import weakref
+import time
+
+from protocol import CODECS, DECODE_ERRORS, HEARTBEAT, FrameError, choose_protocol
+from metrics import METRICS
+
+
+DISCONNECTED = "Client disconnected"
+
+HELLO_TIMEOUT = 1  # seconds to wait for a client's hello before treating it as a JSON only client
+
+
+def send(client, message):  # returns: whether the message was sent
+    logging.debug(f"Sending message {message}")
+
+    try:
+        data = client.codec.encode(message)
+        client.outbox.send(data)
+
+        client.stats.frames_out += 1
+        client.stats.bytes_out += len(data)
+        client.stats.queued(client.outbox.depth())  # other threads' frames, if this one found the socket busy
+
+        return True
+
+    except OSError:  # reset, closed, or stuck for longer than the heartbeat timeout
+        return False
+
+
+"""
+Returns the next message from the client, waiting for the rest of it if it arrives in pieces.
+Heartbeats are skipped, and a client that asked for heartbeats but sent nothing for
+their timeout counts as disconnected. Other socket timeouts raise TimeoutError.
+"""
+def receive(client):
+    logging.debug("Attemting to receive packet")
+
+    while True:
+        try:
+            message = client.reader.receive(client.clientsocket, client.codec)
+
+        except EOFError:
+            logging.warning(f"Socket {client} disconnected")
+            return DISCONNECTED
+
+        except (ConnectionResetError, ConnectionAbortedError):
+            logging.warning(f"Connection reset or connection aborted error: socket {client} disconnected")
+            return DISCONNECTED
+
+        except FrameError as e:
+            logging.warning(f"{e} from {client}, treating the socket as disconnected")
+            client.stats.invalid_packets += 1
+            return DISCONNECTED
+
+        except TimeoutError:
+            if client.heartbeat_timeout is None:  # not a heartbeat timeout, like negotiate() waiting for a hello
+                raise
+
+            logging.warning(f"No heartbeat from {client} in {client.heartbeat_timeout} s, socket disconnected")
+            METRICS.heartbeat_timeouts += 1
+            return DISCONNECTED
+
+        client.stats.frames_in += 1
+        client.stats.bytes_in = client.reader.received
+
+        if message != HEARTBEAT:
+            return message
+
+
+"""
+Sends HEARTBEAT to the clients that asked for heartbeats whenever nothing else was sent
+to them for an interval. One thread or task sends them for every client.
+
+A heartbeat that can't be sent also shows a connection that's gone, for clients nothing
+else reads from, like the ones waiting for a match.
+
+interval: seconds between heartbeats
+timeout: seconds of silence after which a connection counts as closed, sent to the clients
+lost: called with each client whose connection turned out to be closed, if given
+"""
+class Heartbeats:
+    def __init__(self, interval, timeout, lost=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.lost = lost
+
+        self.clients = weakref.WeakSet()
+        self.frames_out = weakref.WeakKeyDictionary()  # client: frames sent to it by the last check
+        self.lock = threading.Lock()
+
+    def add(self, client) -> None:
+        client.heartbeat_timeout = self.timeout
+
+        with self.lock:
+            self.clients.add(client)
+
+    """
+    Stops sending heartbeats to a client, like when another process takes it over
+    """
+    def discard(self, client) -> None:
+        with self.lock:
+            self.clients.discard(client)
+
+    def remove(self, client) -> None:
+        self.discard(client)
+
+        if self.lost is not None:
+            self.lost(client)
+
+    """
+    Returns: the clients that weren't sent anything since the last call
+    """
+    def idle(self) -> list:
+        with self.lock:
+            clients = list(self.clients)
+
+        idle = []
+
+        for client in clients:
+            frames_out = client.stats.frames_out
+
+            if self.frames_out.get(client) == frames_out:
+                idle.append(client)
+                frames_out += 1  # the heartbeat about to be sent
+
+            self.frames_out[client] = frames_out
+
+        return idle
+
+    """
+    Returns: the clients whose socket has room for a heartbeat right now, so sending it
+    doesn't block. Clients whose socket was closed are removed.
+    """
+    def writable(self, clients) -> list:
+        with selectors.DefaultSelector() as selector:
+            for client in clients:
+                try:
+                    selector.register(client.clientsocket, selectors.EVENT_WRITE, client)
+
+                except (ValueError, OSError):  # closed
+                    self.remove(client)
+
+            if not selector.get_map():
+                return []
+
+            return [key.data for key, _ in selector.select(0)]
+
+    """
+    Sends heartbeats forever, for the threaded server. One thread sends them all, so
+    clients that are stuck are skipped rather than waited on: frames still queued mean
+    another thread is stuck writing, and a full socket would block this one.
+    """
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+
+            for client in self.writable([client for client in self.idle() if not client.outbox.pending]):
+                if not send(client, HEARTBEAT):
+                    self.remove(client)
+
+    """
+    Coroutine version of run(), for the asyncio server. Heartbeats are written without
+    waiting for them to drain, so a slow client can't hold up the others.
+    """
+    async def async_run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+
+            for client in self.idle():
+                if client.writer.is_closing():  # a write failed, or the connection was closed on purpose
+                    self.remove(client)
+                    continue
+
+                data = client.codec.encode(HEARTBEAT)
+                client.writer.write(data)
+
+                client.stats.frames_out += 1
+                client.stats.bytes_out += len(data)
+                client.stats.queued(client.queue_depth())
+
+
+"""
+Reads the client's hello and answers with the protocol both sides will use from now on.
+Clients that don't send a hello within HELLO_TIMEOUT keep using JSON.
+
+accepted: protocol versions the server allows
+heartbeats: the Heartbeats to add clients that ask for heartbeats to, None to not offer them
+"""
+def negotiate(client, accepted, heartbeats=None) -> None:
+    client.clientsocket.settimeout(HELLO_TIMEOUT)
+
+    try:
+        hello = receive(client)
+
+    except (TimeoutError, *DECODE_ERRORS):
+        hello = None
+
+    finally:
+        client.clientsocket.settimeout(None)
+
+    if type(hello) != dict or "hello" not in hello:
+        logging.info(f"No hello from {client}, using JSON")
+        return
+
+    version = choose_protocol(hello["hello"], accepted)
+    reply = {"protocol": version}
+
+    if heartbeats is not None and hello.get("heartbeat"):
+        reply["heartbeat"] = {"interval": heartbeats.interval, "timeout": heartbeats.timeout}
+
+    send(client, reply)
+
+    client.hello = hello
+    client.codec = CODECS[version]
+    logging.info(f"Using protocol {version} with {client}")
+
+    if "heartbeat" in reply:
+        heartbeats.add(client)
+        client.clientsocket.settimeout(heartbeats.timeout)  # receive() then gives up on a silent client
+
+
+"""
+Coroutine version of send() for clients served by the asyncio server.
+The header and the message are written in one call so they leave in the same segment,
+and asyncio turns on TCP_NODELAY for its sockets.
+
+Returns: whether the message was sent
+"""
+async def async_send(client, message) -> bool:
+    logging.debug(f"Sending message {message}")
+
+    try:
+        data = client.codec.encode(message)
+        client.writer.write(data)
+
+        client.stats.frames_out += 1
+        client.stats.bytes_out += len(data)
+
+        client.stats.queued(client.queue_depth())
+        await client.writer.drain()
+
+        client.stats.queued(client.queue_depth())
+        return True
+
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+        return False
+
+
+"""
+Sends one message to several clients, encoding it once per codec rather than once per
+client. Every client's copy is written before waiting for any of them to drain, so a
+slow client doesn't hold up the writes to the others.
+"""
+async def async_broadcast(clients, message) -> None:
+    encoded = {}  # codec: bytes
+
+    for client in clients:
+        if client.codec not in encoded:
+            encoded[client.codec] = client.codec.encode(message)
+
+        data = encoded[client.codec]
+
+        try:
+            client.writer.write(data)
+
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            continue
+
+        client.stats.frames_out += 1
+        client.stats.bytes_out += len(data)
+        client.stats.queued(client.queue_depth())
+
+    # Lost connections show up as DISCONNECTED in the clients' readers
+    await asyncio.gather(*(client.writer.drain() for client in clients), return_exceptions=True)
+
+    for client in clients:
+        client.stats.queued(client.queue_depth())
+
+
+"""
+Coroutine version of receive(). readexactly() waits for the whole frame,
+so a header or message split across several TCP segments is reassembled.
+"""
+async def async_receive(client):
+    logging.debug("Attemting to receive packet")
+
+    while True:
+        try:
+            message = await asyncio.wait_for(async_receive_frame(client), client.heartbeat_timeout)
+
+        except asyncio.TimeoutError:
+            logging.warning(f"No heartbeat from {client} in {client.heartbeat_timeout} s, socket disconnected")
+            METRICS.heartbeat_timeouts += 1
+            return DISCONNECTED
+
+        if message != HEARTBEAT:
+            return message
+
+
+async def async_receive_frame(client):
+    codec = client.codec
+
+    try:
+        header = await client.reader.readexactly(codec.header_size)
+        message_length = codec.frame_length(header)
+        message = await client.reader.readexactly(message_length)
+
+    except asyncio.IncompleteReadError:
+        logging.warning(f"Socket {client} disconnected")
+        return DISCONNECTED
+
+    except OSError as e:  # reset, aborted, broken pipe...
+        logging.warning(f"{e!r}: socket {client} disconnected")
+        return DISCONNECTED
+
+    except FrameError as e:
+        logging.warning(f"{e} from {client}, treating the socket as disconnected")
+        client.stats.invalid_packets += 1
+        return DISCONNECTED
+
+    client.stats.frames_in += 1
+    client.stats.bytes_in += codec.header_size + message_length
+
+    return codec.decode(message)
+
+
+"""
+Coroutine version of negotiate().
+
+udp: the UdpChannel to offer clients that ask for UDP, None to not offer it
+heartbeats: the Heartbeats to add clients that ask for heartbeats to, None to not offer them
+"""
+async def async_negotiate(client, accepted, udp=None, heartbeats=None) -> None:
+    try:
+        hello = await asyncio.wait_for(async_receive(client), HELLO_TIMEOUT)
+
+    except (asyncio.TimeoutError, *DECODE_ERRORS):
+        hello = None
+
+    if type(hello) != dict or "hello" not in hello:
+        logging.info(f"No hello from {client}, using JSON")
+        return
+
+    version = choose_protocol(hello["hello"], accepted)
+    reply = {"protocol": version}
+
+    if udp is not None and hello.get("udp"):
+        reply["udp"] = {"port": udp.port, "token": udp.register(client)}
+
+    if heartbeats is not None and hello.get("heartbeat"):
+        reply["heartbeat"] = {"interval": heartbeats.interval, "timeout": heartbeats.timeout}
+
+    await async_send(client, reply)
+
+    client.hello = hello
+    client.codec = CODECS[version]
+    logging.info(f"Using protocol {version} with {client}")
+
+    if "heartbeat" in reply:
+        heartbeats.add(client)
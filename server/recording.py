@@ -0,0 +1,391 @@
+import argparse
+import threading
+import logging
+import struct
+import bisect
+import queue
+import mmap
+import json
+import time
+import os
+
+from protocol import CODECS, PROTOCOL_BINARY, DECODE_ERRORS, FrameError
+from frames import BoardDecoder, KEYFRAME, DELTA
+
+
+"""
+Match recordings. Every frame a game relays is written to a file, so a match can be
+replayed or inspected later.
+
+File layout, little-endian:
+    MAGIC, header length (uint32), header (JSON: board_size, speed, apple_goal, mode, players, ...)
+    records: milliseconds since the game started (uint32), player index (uint8), then the
+             message encoded with the binary protocol (uint32 length, type byte, packed message)
+    index:   player index (uint8), tick (uint32), record offset (uint64) for every keyframe,
+             sorted by player and tick
+    footer:  index offset (uint64), index entries (uint32), INDEX_MAGIC
+
+The index is written when the recording is closed. A recording cut short by a crash has
+no index, and Replay rebuilds it by reading the records once.
+"""
+
+MAGIC = b"SNAKREC1"
+INDEX_MAGIC = b"SNAKIDX1"
+EXTENSION = ".snakerec"
+
+HEADER_LENGTH = struct.Struct("<I")
+RECORD = struct.Struct("<IB")
+INDEX_ENTRY = struct.Struct("<BIQ")
+FOOTER = struct.Struct(f"<QI{len(INDEX_MAGIC)}s")
+
+BUFFER_SIZE = 64 * 1024
+
+CODEC = CODECS[PROTOCOL_BINARY]
+CLOSE = object()  # queued to finish a recording
+
+
+"""
+Writes every recording on one background thread. The game only puts the decoded message
+on a queue, and encoding and writing happen here, so recording never holds up a relay.
+"""
+class RecordingWriter:
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, item) -> None:
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, daemon=True)
+                    self.thread.start()
+
+        self.queue.put(item)
+
+    def run(self) -> None:
+        while True:
+            recorder, ms, player, message = self.queue.get()
+
+            try:
+                if message is CLOSE:
+                    recorder.finish()
+                else:
+                    recorder.write(ms, player, message)
+
+            except OSError as e:
+                logging.error(f"Could not write to {recorder.path}: {e}")
+
+            except (struct.error, TypeError, ValueError, IndexError):
+                logging.warning(f"Could not record {message!r} from player {player}")
+
+
+WRITER = RecordingWriter()
+
+
+"""
+Records one game. record() and close() only queue work for the writer thread.
+
+path: file to write, replaced if it exists
+info: dict written as the file's header
+"""
+class Recorder:
+    def __init__(self, path, info):
+        self.path = path
+        self.started = time.monotonic()
+
+        self.file = open(path, "wb", buffering=BUFFER_SIZE)
+        self.keyframes = []  # (player, tick, offset)
+
+        header = json.dumps(info).encode("utf-8")
+        self.file.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        self.offset = len(MAGIC) + HEADER_LENGTH.size + len(header)
+
+    """
+    Queues a message a player sent, usually a board frame
+    """
+    def record(self, player, message) -> None:
+        WRITER.put((self, int((time.monotonic() - self.started) * 1000), player, message))
+
+    """
+    Queues one frame per player from a snapshot
+    """
+    def record_snapshot(self, snapshot) -> None:
+        ms = int((time.monotonic() - self.started) * 1000)
+
+        for player, frame in enumerate(snapshot[1]):
+            WRITER.put((self, ms, player, frame))
+
+    def close(self) -> None:
+        WRITER.put((self, 0, 0, CLOSE))
+
+    def write(self, ms, player, message) -> None:
+        if self.file.closed:
+            return
+
+        data = RECORD.pack(ms, player) + CODEC.encode(message)
+
+        if type(message) == list and message and message[0] == KEYFRAME:
+            self.keyframes.append((player, message[1], self.offset))
+
+        self.file.write(data)
+        self.offset += len(data)
+
+    def finish(self) -> None:
+        if self.file.closed:
+            return
+
+        self.keyframes.sort()
+
+        self.file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in self.keyframes))
+        self.file.write(FOOTER.pack(self.offset, len(self.keyframes), INDEX_MAGIC))
+        self.file.close()
+
+        logging.info(f"Saved recording {self.path} with {len(self.keyframes)} keyframe(s)")
+
+
+"""
+Starts recording a room's next game if options["record_dir"] is set.
+
+Returns: a Recorder, or None if recording is off or the file can't be created
+"""
+def start_recording(options, room, mode) -> Recorder:
+    directory = options.get("record_dir")
+
+    if not directory:
+        return None
+
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-room{room.id}-game{room.games_played + 1}{EXTENSION}"
+
+    info = {
+        "board_size": options["board_size"],
+        "speed": options["speed"],
+        "apple_goal": options["apple_goal"],
+        "mode": mode,
+        "players": len(room.clients),
+        "room": room.id,
+        "started": time.time()
+    }
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        return Recorder(os.path.join(directory, name), info)
+
+    except OSError as e:
+        logging.error(f"Could not start a recording in {directory}: {e}")
+        return None
+
+
+"""
+The keyframe index of a mapped recording, read in place. Entries compare as (player, tick),
+so bisect can search it without loading it.
+"""
+class KeyframeIndex:
+    def __init__(self, buffer, offset, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+
+        return INDEX_ENTRY.unpack_from(self.buffer, self.offset + i * INDEX_ENTRY.size)
+
+    def __len__(self):
+        return self.count
+
+
+"""
+Reads a recording through a memory map, so opening and seeking don't read the whole file.
+
+Usage:
+    with Replay(path) as replay:
+        boards = replay.seek(tick)
+"""
+class Replay:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a recording")
+
+        header_length = HEADER_LENGTH.unpack_from(self.map, len(MAGIC))[0]
+        self.records_start = len(MAGIC) + HEADER_LENGTH.size + header_length
+        self.info = json.loads(self.map[len(MAGIC) + HEADER_LENGTH.size:self.records_start])
+
+        footer_start = len(self.map) - FOOTER.size
+        index_offset, count, magic = FOOTER.unpack_from(self.map, footer_start) if footer_start >= self.records_start \
+            else (0, 0, b"")
+
+        if magic == INDEX_MAGIC:
+            self.records_end = index_offset
+            self.index = KeyframeIndex(self.map, index_offset, count)
+
+        else:
+            logging.warning(f"{path} has no index, it was not closed properly")
+            self.records_end = len(self.map)
+            self.index = self.build_index()
+
+    """
+    Reads the records once to index a recording that has no index.
+    Returns: the index as a sorted list of (player, tick, offset)
+    """
+    def build_index(self) -> list:
+        keyframes = []
+
+        for offset, _, player, message in self.messages():
+            if type(message) == list and message and message[0] == KEYFRAME:
+                keyframes.append((player, message[1], offset))
+
+        keyframes.sort()
+
+        return keyframes
+
+    """
+    Yields (offset, milliseconds, player, message) for each record from offset on.
+    Stops at a record that was cut short or can't be read.
+    """
+    def messages(self, offset=None):
+        offset = self.records_start if offset is None else offset
+        end = self.records_end
+
+        while offset + RECORD.size + CODEC.header_size <= end:
+            ms, player = RECORD.unpack_from(self.map, offset)
+            start = offset + RECORD.size + CODEC.header_size
+
+            try:
+                length = CODEC.frame_length(self.map[offset + RECORD.size:start])
+
+            except FrameError:
+                logging.warning(f"Unreadable record at offset {offset}, stopping there")
+                return
+
+            if start + length > end:
+                return
+
+            try:
+                message = CODEC.decode(self.map[start:start + length])
+
+            except DECODE_ERRORS:
+                logging.warning(f"Unreadable record at offset {offset}, stopping there")
+                return
+
+            yield offset, ms, player, message
+
+            offset = start + length
+
+    """
+    Returns: the offset of the player's last keyframe at or before tick, or None
+    """
+    def keyframe_offset(self, player, tick):
+        i = bisect.bisect_right(self.index, (player, tick, float("inf")))
+
+        if i == 0:
+            return None
+
+        keyframe_player, _, offset = self.index[i - 1]
+
+        return offset if keyframe_player == player else None
+
+    """
+    Rebuilds every player's board as it was at a tick: from the player's last keyframe
+    before the tick, only the deltas up to the tick are read.
+
+    Returns: a BoardDecoder per player, unsynced for players with no keyframe by then
+    """
+    def seek(self, tick) -> list:
+        players = self.info.get("players", 2)
+        boards = [BoardDecoder() for _ in range(players)]
+        starts = [self.keyframe_offset(player, tick) for player in range(players)]
+        waiting = {player for player in range(players) if starts[player] is not None}
+
+        if not waiting:
+            return boards
+
+        for offset, _, player, message in self.messages(min(starts[player] for player in waiting)):
+            if player not in waiting or offset < starts[player]:
+                continue
+
+            if type(message) != list or not message or message[0] not in (KEYFRAME, DELTA):
+                continue
+
+            if message[1] > tick:
+                waiting.discard(player)
+
+                if not waiting:
+                    break
+
+                continue
+
+            boards[player].apply(message)
+
+        return boards
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+"""
+Returns: the board as text, one character per cell
+"""
+def draw_board(board, board_size) -> str:
+    rows = [["." for _ in range(board_size)] for _ in range(board_size)]
+
+    if board.apple is not None and 0 <= board.apple[0] < board_size and 0 <= board.apple[1] < board_size:
+        rows[board.apple[1]][board.apple[0]] = "@"
+
+    for x, y in board.coords:
+        if 0 <= x < board_size and 0 <= y < board_size:
+            rows[y][x] = "#"
+
+    if len(board):
+        x, y = board.coords[-1]
+
+        if 0 <= x < board_size and 0 <= y < board_size:
+            rows[y][x] = "O"
+
+    return "\n".join("".join(row) for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show a match recording")
+    parser.add_argument("path")
+    parser.add_argument("--tick", type=int, help="draw the boards at this tick")
+    args = parser.parse_args()
+
+    with Replay(args.path) as replay:
+        print(json.dumps(replay.info))
+
+        if args.tick is None:
+            count = 0
+            last = None
+
+            for record in replay.messages():
+                count += 1
+                last = record
+
+            duration = last[1] / 1000 if last is not None else 0
+            print(f"{count} messages over {duration:.1f} s, {len(replay.index)} keyframes")
+            return
+
+        for player, board in enumerate(replay.seek(args.tick)):
+            if not board.synced():
+                print(f"Player {player + 1}: no board at tick {args.tick}\n")
+                continue
+
+            print(f"Player {player + 1} at tick {board.tick}, length {len(board)}:")
+            print(draw_board(board, replay.info["board_size"]) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,27 @@ import socket
 import json
 import time
 
+from networking import Heartbeats, send, receive, negotiate
+from protocol import JSON_CODEC, PROTOCOL_JSON, SUPPORTED_PROTOCOLS, SPECTATOR, DECODE_ERRORS, CODECS, MAX_BOARDS, \
+    FrameReader, OutboundQueue
+from lobby import Lobby, Room
+from recording import start_recording
+from metrics import METRICS, start_stats_server
+from supervisor import Supervisor, SupervisorLink, OPEN_ROOM
+import async_server
+
 
 with open("preferences.json") as f:
     OPTIONS = json.load(f)
 
 
+LOG_FORMAT = "%(asctime)s %(levelname)-8s %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
 logging.basicConfig(
     filename="log.txt",
-    format='%(asctime)s %(levelname)-8s %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+    format=LOG_FORMAT,
+    datefmt=LOG_DATE_FORMAT
 )
 
 
@@ -23,54 +35,68 @@ logger.setLevel(OPTIONS["logging_level"])
 IP = socket.gethostbyname(socket.gethostname())
 PORT = 9850
 
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+SERVER_MODES = ("threaded", "asyncio")
 
-server_socket.bind((IP, PORT))
-server_socket.listen(2)
+# Protocol versions clients may pick in their hello
+PROTOCOLS = SUPPORTED_PROTOCOLS if OPTIONS.get("binary_protocol", True) else (PROTOCOL_JSON,)
 
-HEADERSIZE = 10
 
+def create_server_socket():
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-def send(client, message):  # returns: whether the message was sent
-    logging.debug(f"Sending message {message}")
+    server_socket.bind((IP, PORT))
+    server_socket.listen(socket.SOMAXCONN)
 
-    message = json.dumps(message, ensure_ascii=False).encode("utf-8")
-    header_info = f"{len(message):<{HEADERSIZE}}".encode("utf-8")
+    return server_socket
 
-    try:
-        client.clientsocket.send(header_info)
-        client.clientsocket.send(message)
-        return True
 
-    except ConnectionResetError:
-        return False
+class Client:
+    def __init__(self, clientsocket, ip):
+        self.clientsocket = clientsocket
+        self.ip = ip
+        self.codec = JSON_CODEC  # replaced once the client's hello is read
+        self.hello = None  # the client's hello, None for clients that only speak JSON
+        self.reader = FrameReader(16384)
+        self.outbox = OutboundQueue(clientsocket)
+        self.stats = METRICS.track(self, ip)
+        self.heartbeat_timeout = None  # seconds of silence before the client counts as gone, if it sends heartbeats
 
+    def __repr__(self):
+        return f"Client({self.ip})"
 
-def receive(client):
-    logging.debug("Attemting to receive packet")
 
-    try:
-        header = client.clientsocket.recv(HEADERSIZE)
+"""
+Gets a client ready to move to another process. The caller sends the result over a pipe,
+which copies the socket, then closes its own socket.
 
-        if header == b"":
-            logging.warning(f"Socket {client} disconnected")
-            return "Client disconnected"
+Returns: (socket, address, hello, protocol version, bytes received but not read yet), see adopt()
+"""
+def detach(client, heartbeats=None) -> tuple:
+    if heartbeats is not None:
+        heartbeats.discard(client)
 
-        message_length = int(header.decode('utf-8').strip())
-        message = client.clientsocket.recv(message_length)
+    with client.outbox.lock:  # lets a frame that is being written finish first
+        return client.clientsocket, client.ip, client.hello, client.codec.version, client.reader.unread()
 
-    except (ConnectionResetError, ConnectionAbortedError):
-        logging.warning(f"Connection reset or connection aborted error: socket {client} disconnected")
-        return "Client disconnected"
 
-    return json.loads(message)
+"""
+Takes over a client that another process detached, picking up where it left off.
+"""
+def adopt(handoff, heartbeats=None) -> Client:
+    clientsocket, address, hello, version, unread = handoff
+    clientsocket.settimeout(None)  # the last owner may have left it non-blocking
 
+    client = Client(clientsocket, address)
+    client.hello = hello
+    client.codec = CODECS[version]
+    client.reader.feed(unread)
 
-class Client:
-    def __init__(self, clientsocket, ip):
-        self.clientsocket = clientsocket
-        self.ip = ip
+    if heartbeats is not None and hello is not None and hello.get("heartbeat"):
+        heartbeats.add(client)
+        clientsocket.settimeout(heartbeats.timeout)
+
+    return client
 
 
 class GameSetup:
@@ -80,36 +106,33 @@ class GameSetup:
         self.speed = OPTIONS["speed"]  # server tickrate and movement speed, updates every speed / 60 seconds
         self.apple_goal = OPTIONS["apple_goal"]  # how long your snake needs to be to win
 
-    # Wait for two players to connect and start the game
-    def wait_for_players(self):
-        while len(self.clients) < 2:
-            clientsocket, address = server_socket.accept()
-            logging.info(f"Accepted client with address {address}")
-            self.clients.append(Client(clientsocket, address))
-
     """
     Give starting game information to the clients
-    The order is: "start" string, self.board_size, self.speed, self.apple_goal
+    The order is: "start" string, self.board_size, self.speed, self.apple_goal, then for
+    clients that sent a hello, the match info {"mode": "relay", "player": index, "players": count}
     """
     def give_start_info(self):
         logging.info("Giving start info")
 
-        for client in self.clients:
+        for index, client in enumerate(self.clients):
             send(client, "start")
             send(client, self.board_size)
             send(client, self.speed)
             send(client, self.apple_goal)
 
+            if client.hello is not None:
+                send(client, {"mode": "relay", "player": index, "players": len(self.clients)})
+
     def setup(self):
-        self.wait_for_players()
         self.give_start_info()
 
         return self.clients
 
 
 class Game:
-    def __init__(self, clients):
+    def __init__(self, clients, recorder=None):
         self.clients = clients
+        self.recorder = recorder  # records the relayed frames, if recording is on
         self.ended = False
 
     """
@@ -125,19 +148,27 @@ class Game:
         while not self.ended:
             try:
                 screen = receive(giver)
+                received = time.perf_counter()
 
                 if screen == "ready":  # If the client is ready for a new game, start one
                     break
 
                 send(recipient, screen)
 
+                METRICS.frames_relayed += 1
+                METRICS.relay_latency.observe((time.perf_counter() - received) * 1000)
+
+                if self.recorder is not None:
+                    self.recorder.record(self.clients.index(giver), screen)
+
                 # If the player won or lost
                 if screen in ("won", "lost", "Client disconnected"):
                     logging.info(f"Client {screen}")
                     self.ended = True
 
-            except json.JSONDecodeError:
+            except DECODE_ERRORS:
                 logging.warning(f"Invalid packet received from socket {giver}")
+                giver.stats.invalid_packets += 1
 
     """
     Starts two get_player_screen threads to allow both clients to see each other's boards.
@@ -157,26 +188,282 @@ class Game:
         t2.join()
 
 
-def main():
-    clients = []
+"""
+Clear queued messages from the client until it is ready for another game.
 
+Returns: whether the client is still connected
+"""
+def wait_for_rematch(client) -> bool:
     while True:
-        setup = GameSetup(clients)
-        clients = setup.setup()
+        try:
+            packet = receive(client)
 
-        game = Game(clients)
-        game.run()
+        except DECODE_ERRORS:
+            client.stats.invalid_packets += 1
+            continue
+
+        if packet == "Client disconnected":
+            return False
+
+        if packet == "ready2":
+            return True
+
+
+"""
+Plays games in a room until a player leaves. Runs on its own thread so rooms
+don't wait on each other.
+"""
+def run_room(room, lobby):
+    clients = room.clients
+
+    try:
+        while len(clients) == lobby.players_per_room:
+            room.state = Room.PLAYING
+
+            setup = GameSetup(clients)
+            clients = setup.setup()
+
+            recorder = start_recording(OPTIONS, room, "relay")
+            game = Game(clients, recorder)
+            started = time.monotonic()
+            METRICS.games_started += 1
+
+            game.run()
+
+            if recorder is not None:
+                recorder.close()
+
+            METRICS.games_finished += 1
+            METRICS.game_duration.observe(time.monotonic() - started)
+
+            room.games_played += 1
+            room.state = Room.REMATCH
+
+            ready = [client for client in clients if wait_for_rematch(client)]
+
+            for client in clients:
+                if client not in ready:
+                    client.clientsocket.close()
+
+            clients = ready
+
+    except Exception:
+        logging.exception(f"{room} crashed")
 
-        # Clear queued messages from both clients
         for client in clients:
-            packet = receive(client)
+            client.clientsocket.close()
+
+        clients = []
+
+    for client in room.clients:
+        logging.info(f"{client} outbound queue peaked at {client.stats.max_queue_depth} byte(s)")
+
+    lobby.close_room(room, clients)
+
+
+"""
+Runs the threaded server, taking connections from accept() until it raises.
+
+accept: returns the next (socket, address), like socket.accept()
+supervisor: when set, matched rooms and spectators are handed to its workers instead
+of being run here, and the players that want a rematch come back to this lobby
+"""
+def serve(accept, supervisor=None):
+    def lost(client):
+        if lobby.remove_client(client):
+            logging.info(f"{client} left while waiting for a match")
+            client.clientsocket.close()
+
+    heartbeats = Heartbeats(OPTIONS["heartbeat_interval"], OPTIONS["heartbeat_timeout"], lost) \
+        if OPTIONS.get("heartbeat_interval") else None
+
+    if heartbeats is not None:
+        threading.Thread(target=heartbeats.run, daemon=True).start()
+
+    def welcome(client):
+        METRICS.handshakes_pending += 1
+
+        try:
+            negotiate(client, PROTOCOLS, heartbeats)
+
+        finally:
+            METRICS.handshakes_pending -= 1
+
+        if client.hello is not None and client.hello.get("role") == SPECTATOR:
+            if supervisor is not None and OPTIONS.get("server_mode", "threaded") == "asyncio":
+                logging.info(f"{client} is a spectator")
+                supervisor.add_spectator(detach(client, heartbeats))
+                return
+
+            logging.warning(f"Closing {client}, spectators need server_mode set to asyncio")
+            client.clientsocket.close()
+            return
+
+        if OPTIONS.get("authoritative") and client.hello is None:
+            logging.warning(f"Closing {client}, clients need to send a hello to play on a server that runs the game")
+            client.clientsocket.close()
+            return
+
+        lobby.add_client(client)
+
+    def start_room(room):
+        if supervisor is None:
+            thread = threading.Thread(target=run_room, args=(room, lobby), daemon=True)
+            thread.start()
+            return thread
+
+        worker = supervisor.start_room(room.id, [detach(client, heartbeats) for client in room.clients])
+
+        if worker is None:
+            lobby.close_room(room, [])
+
+        return worker
+
+    def room_closed(room_id, games_played, handoffs):
+        room = lobby.rooms[room_id]
+
+        if games_played is not None:
+            room.games_played = games_played
+
+        lobby.close_room(room, [adopt(handoff, heartbeats) for handoff in handoffs])
+
+    lobby = Lobby(start_room, OPTIONS.get("players_per_match", 2))
+
+    if supervisor is None:
+        METRICS.gauges["lobby"] = lobby.stats
+
+    else:
+        METRICS.gauges["lobby"] = lambda: {"waiting": len(lobby.queue)}  # the workers count the rooms
+        supervisor.start(room_closed)
+
+    while True:
+        clientsocket, address = accept()
+        logging.info(f"Accepted client with address {address}")
+        METRICS.connections_accepted += 1
+
+        threading.Thread(target=welcome, args=(Client(clientsocket, address),), daemon=True).start()
+
+
+"""
+Runs the rooms the supervisor hands a threaded worker, until the supervisor is gone.
+"""
+def work(link):
+    heartbeats = Heartbeats(OPTIONS["heartbeat_interval"], OPTIONS["heartbeat_timeout"]) \
+        if OPTIONS.get("heartbeat_interval") else None
+
+    if heartbeats is not None:
+        threading.Thread(target=heartbeats.run, daemon=True).start()
+
+    def start_room(room):
+        thread = threading.Thread(target=run_room, args=(room, lobby), daemon=True)
+        thread.start()
+        return thread
+
+    def requeue(room, clients):
+        link.room_closed(room, [detach(client, heartbeats) for client in clients])
+
+    lobby = Lobby(start_room, OPTIONS.get("players_per_match", 2), requeue)
+    METRICS.gauges["lobby"] = lobby.stats
+
+    while True:
+        kind, *message = link.receive()
+
+        if kind == OPEN_ROOM:
+            room_id, handoffs = message
+            lobby.open_room([adopt(handoff, heartbeats) for handoff in handoffs], room_id)
+
+
+"""
+Runs in each worker process when workers is more than 1. The worker runs the rooms
+the supervisor hands it and reports its stats back until the supervisor is gone.
+
+index: the worker's number, from 0
+connection: the worker's end of the pipe to the supervisor
+options: the supervisor's OPTIONS
+"""
+def run_worker(index, connection, options):
+    OPTIONS.update(options)
+
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)-8s worker{index} %(message)s", LOG_DATE_FORMAT))
+
+    link = SupervisorLink(connection)
+    threading.Thread(target=link.report, daemon=True).start()
+
+    try:
+        if OPTIONS.get("server_mode", "threaded") == "asyncio":
+            async_server.work(OPTIONS, link)
+
+        else:
+            work(link)
+
+    except EOFError:
+        logging.info("The supervisor is gone, stopping")
+
+
+def main():
+    mode = OPTIONS.get("server_mode", "threaded")
+
+    if mode not in SERVER_MODES:
+        logging.critical(f"Unknown server_mode {mode!r}, expected one of {SERVER_MODES}")
+        return
+
+    if OPTIONS.get("authoritative") and mode != "asyncio":
+        logging.critical("authoritative needs server_mode set to asyncio")
+        return
+
+    # Relayed games pass each board to a single opponent, so only games the server runs can have more players
+    players = OPTIONS.get("players_per_match", 2)
+
+    if players < 2 or (players > 2 and not OPTIONS.get("authoritative")):
+        logging.critical("players_per_match must be at least 2, and more than 2 needs authoritative on")
+        return
+
+    if players > MAX_BOARDS:
+        logging.critical(f"players_per_match can be at most {MAX_BOARDS}, the most boards a snapshot holds")
+        return
+
+    if OPTIONS.get("udp_port") and not OPTIONS.get("authoritative"):
+        logging.warning("udp_port is only used when authoritative is on, sending everything over TCP")
+
+    if OPTIONS.get("heartbeat_interval") and OPTIONS.get("heartbeat_timeout", 0) <= OPTIONS["heartbeat_interval"]:
+        logging.critical("heartbeat_timeout must be longer than heartbeat_interval")
+        return
+
+    if OPTIONS.get("resume_timeout") and not OPTIONS.get("authoritative"):
+        logging.warning("resume_timeout is only used when authoritative is on, players that drop forfeit")
+
+    workers = OPTIONS.get("workers", 1)
+
+    if workers < 1:
+        logging.critical("workers must be at least 1")
+        return
+
+    if workers > 1:
+        if OPTIONS.get("resume_timeout") and OPTIONS.get("authoritative"):
+            logging.warning("resume_timeout only works with workers set to 1, since the game a player "
+                            "reconnects to is in a worker. Players that drop forfeit")
+
+        if OPTIONS.get("udp_port") and OPTIONS.get("authoritative"):
+            logging.warning("udp_port only works with workers set to 1, since players register their UDP "
+                            "address before they are matched. Sending everything over TCP")
+
+        supervisor = Supervisor(workers, run_worker, (OPTIONS,))
+
+        if OPTIONS.get("stats_port"):
+            start_stats_server(OPTIONS["stats_port"], supervisor)
+
+        serve(create_server_socket().accept, supervisor)
+        return
+
+    if OPTIONS.get("stats_port"):
+        start_stats_server(OPTIONS["stats_port"])
 
-            if packet == "Client disconnected":
-                clients = []
-                continue
+    if mode == "asyncio":
+        async_server.main(IP, PORT, OPTIONS, PROTOCOLS)
+        return
 
-            while packet != "ready2":
-                packet = receive(client)
+    serve(create_server_socket().accept)
 
 
 if __name__ == "__main__":
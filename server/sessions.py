@@ -0,0 +1,41 @@
+import logging
+import secrets
+
+
+"""
+Session tokens that let a player whose connection dropped get back into their game.
+Every player of a game the server runs gets a token in the match info. A client that
+reconnects sends it in its hello as "resume" and takes its old place, as long as the
+game is still waiting for it.
+"""
+class Sessions:
+    def __init__(self, timeout):
+        self.timeout = timeout  # seconds a game waits for a player to come back
+        self.games = {}  # token: (game, player index)
+
+    """
+    Returns: a new token for each of count players
+    """
+    def issue(self, count) -> list:
+        return [secrets.token_hex(16) for _ in range(count)]
+
+    def register(self, tokens, game) -> None:
+        for index, token in enumerate(tokens):
+            self.games[token] = (game, index)
+
+    def revoke(self, tokens) -> None:
+        for token in tokens:
+            self.games.pop(token, None)
+
+    """
+    Puts a reconnected client back in its game.
+    Returns: whether the game took it back
+    """
+    def resume(self, token, client) -> bool:
+        game, index = self.games.get(token, (None, None))
+
+        if game is None:
+            logging.info(f"{client} tried to resume an unknown or finished session")
+            return False
+
+        return game.rejoin(index, client)
@@ -0,0 +1,83 @@
+# The game rules shared by the client and the server.
+# client/simulation.py and server/simulation.py must be kept identical.
+
+import random
+
+from grid import SnakeBody
+
+DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+"""
+The game rules without pygame. The client's Snake adds keyboard input and drawing on top,
+and a server that runs the game itself uses it as it is. Nothing here needs a display, so
+the rules can be run and benchmarked headless.
+"""
+class SnakeState:
+    def __init__(self, start, board_size):
+        self.coords = SnakeBody([start], board_size)
+        self.dir = (0, 0)
+        self.pop = True  # pop the end of the snake when moving, used for eating an apple
+        self.prev_frame_dir = (0, 0)
+
+    """
+    Turns the snake unless that would reverse it into itself. Ignores anything that isn't a direction.
+    """
+    def turn(self, direction) -> None:
+        if direction not in DIRECTIONS:
+            return
+
+        if (-direction[0], -direction[1]) != self.prev_frame_dir:
+            self.dir = direction
+
+    def move(self) -> None:
+        self.coords.push_head(self.dir)
+
+        if self.pop:
+            self.coords.pop_tail()
+
+        self.pop = True
+        self.prev_frame_dir = self.dir
+
+    def check_apple_eaten(self, apple) -> bool:
+        if self.coords.head == apple:
+            self.pop = False
+            return True
+
+        return False
+
+    """
+    Returns: whether the snake reached win_len or there is nowhere left for the apple
+    """
+    def won(self, win_len) -> bool:
+        return len(self.coords) >= win_len or self.coords.full()
+
+    def lost(self, board_size) -> bool:
+        return self.coords.collided()
+
+
+class BoardState:
+    def __init__(self, board_size, rng=random):
+        self.board_size = board_size
+        self.rng = rng
+
+        self.snake = SnakeState((board_size // 2, board_size // 2), board_size)
+        self.apple = (2, 2)
+
+    """
+    Find new coords for the apple that aren't on the snake. Leaves the apple where it is if the snake fills the board.
+    """
+    def regenerate_apple(self) -> None:
+        apple = self.snake.coords.random_free_cell(self.rng)
+
+        if apple is not None:
+            self.apple = apple
+
+    """
+    Moves the snake one tick and replaces the apple if it was eaten, in the same order as the client's game loop.
+    """
+    def step(self) -> None:
+        self.snake.move()
+
+        if self.snake.check_apple_eaten(self.apple):
+            self.regenerate_apple()
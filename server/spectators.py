@@ -0,0 +1,169 @@
+import collections
+import logging
+import asyncio
+
+
+MAX_QUEUED = 64  # messages waiting for a spectator before the oldest frame is skipped
+MAX_SKIPPED = 256  # frames a spectator may fall behind by in a row before it is dropped
+
+
+"""
+A client watching matches. Messages for it are already encoded and wait in a bounded queue
+that its own task writes out, so a slow spectator can never hold up the players.
+When the queue is full the oldest frame is skipped, which the spectator recovers from at the
+next keyframe, and a spectator that keeps falling behind is disconnected.
+"""
+class Spectator:
+    def __init__(self, client):
+        self.client = client
+
+        self.queue = collections.deque()  # (encoded bytes, whether it may be skipped)
+        self.ready = asyncio.Event()
+        self.skipped = 0  # frames skipped since the spectator last caught up
+        self.closed = False
+
+        self.writer = asyncio.create_task(self.write_loop())
+        self.watcher = asyncio.create_task(self.watch_for_close())
+
+    """
+    Queues an encoded message without waiting.
+
+    skippable: whether the message may be skipped when the spectator falls behind.
+    Match info and results are never skipped.
+    """
+    def push(self, data, skippable=True) -> None:
+        if self.closed:
+            return
+
+        if len(self.queue) >= MAX_QUEUED:
+            for i, (_, queued_skippable) in enumerate(self.queue):
+                if queued_skippable:
+                    del self.queue[i]
+                    break
+
+            self.skipped += 1
+
+            if self.skipped > MAX_SKIPPED:
+                logging.warning(f"Dropping spectator {self.client}, it fell too far behind")
+                self.close()
+                return
+
+        self.queue.append((data, skippable))
+        self.ready.set()
+
+    def send(self, message, skippable=True) -> None:
+        self.push(self.client.codec.encode(message), skippable)
+
+    async def write_loop(self) -> None:
+        while not self.closed:
+            await self.ready.wait()
+            self.ready.clear()
+
+            frames = len(self.queue)
+            data = b"".join(data for data, _ in self.queue)
+            self.queue.clear()
+
+            try:
+                self.client.writer.write(data)
+                self.client.stats.frames_out += frames
+                self.client.stats.bytes_out += len(data)
+                self.client.stats.queued(self.client.queue_depth())
+                await self.client.writer.drain()
+
+                self.client.stats.queued(self.client.queue_depth())
+
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                self.close()
+                return
+
+            self.skipped = 0
+
+    """
+    Spectators send nothing but heartbeats after the hello, so reading only finds out when
+    they leave or go quiet.
+    """
+    async def watch_for_close(self) -> None:
+        try:
+            while await asyncio.wait_for(self.client.reader.read(4096), self.client.heartbeat_timeout):
+                pass
+
+        except (ConnectionResetError, ConnectionAbortedError, asyncio.TimeoutError):
+            pass
+
+        self.close()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        self.closed = True
+        self.ready.set()  # wake the writer so it exits
+        self.queue.clear()
+        self.client.close()
+
+        logging.info(f"Spectator {self.client} left")
+
+    def __repr__(self):
+        return f"Spectator({self.client.ip})"
+
+
+"""
+Sends a room's match to its spectators. Every message is encoded once per codec and the
+same bytes are queued for every spectator using that codec.
+
+Spectators get:
+  {"watching": room_id, "board_size": n, "speed": n, "apple_goal": n, "mode": mode, "players": n}
+      when a game starts, or straight away when joining a game that is already running
+  player_index followed by that player's frame, or by "won", "lost" or "Client disconnected",
+      for relayed games
+  ["N", [frame_0, frame_1, ...]] snapshots, then {"results": [{"result": result, "score": n}, ...]}
+      for games the server runs itself
+"""
+class Broadcast:
+    def __init__(self):
+        self.spectators = []
+        self.info = None  # the current game's "watching" message
+
+    def add(self, spectator) -> None:
+        self.spectators.append(spectator)
+
+        if self.info is not None:
+            spectator.send(self.info, skippable=False)
+
+    """
+    Returns: the spectators that are still connected, forgetting the others
+    """
+    def connected(self) -> list:
+        if any(spectator.closed for spectator in self.spectators):
+            self.spectators = [spectator for spectator in self.spectators if not spectator.closed]
+
+        return self.spectators
+
+    def push(self, encode, skippable) -> None:
+        encoded = {}  # codec: bytes
+
+        for spectator in self.connected():
+            codec = spectator.client.codec
+
+            if codec not in encoded:
+                encoded[codec] = encode(codec)
+
+            spectator.push(encoded[codec], skippable)
+
+    def send(self, message, skippable=True) -> None:
+        if self.spectators:
+            self.push(lambda codec: codec.encode(message), skippable)
+
+    """
+    Sends a relayed message from one player, marked with the player's index
+    """
+    def send_from(self, player, message) -> None:
+        if self.spectators:
+            self.push(lambda codec: codec.encode(player) + codec.encode(message), type(message) == list)
+
+    def start(self, info) -> None:
+        self.info = info
+        self.send(info, skippable=False)
+
+    def __len__(self):
+        return sum(not spectator.closed for spectator in self.spectators)
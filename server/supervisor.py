@@ -0,0 +1,300 @@
+import multiprocessing
+import multiprocessing.connection
+import threading
+import logging
+import time
+
+from metrics import METRICS, merge_snapshots, format_text
+
+
+REPORT_INTERVAL = 1  # seconds between a worker's stats reports, which double as its health check
+WORKER_TIMEOUT = 10  # seconds without a report before a worker counts as hung and is restarted
+
+# Messages between the supervisor and the workers. Clients travel as the tuples that
+# the server's detach() makes, with the socket and the bytes it received but didn't read.
+OPEN_ROOM = "room"  # to a worker: (OPEN_ROOM, room id, clients)
+ADD_SPECTATOR = "spectator"  # to a worker: (ADD_SPECTATOR, client)
+ROOM_CLOSED = "closed"  # to the supervisor: (ROOM_CLOSED, room id, games played, clients ready for another game)
+STATS = "stats"  # to the supervisor: (STATS, METRICS.snapshot())
+
+
+"""
+One worker process, as the supervisor sees it
+"""
+class Worker:
+    def __init__(self, index, process, connection):
+        self.index = index
+        self.process = process
+        self.connection = connection  # the supervisor's end of the pipe
+        self.send_lock = threading.Lock()
+        self.last_report = time.monotonic()
+        self.snapshot = {}  # the worker's last METRICS.snapshot()
+        self.rooms = set()  # ids of the rooms the worker is running
+
+    """
+    Returns: whether the worker got the message
+    """
+    def send(self, message) -> bool:
+        try:
+            with self.send_lock:
+                self.connection.send(message)
+
+            return True
+
+        except OSError:  # the worker exited, monitor() restarts it
+            return False
+
+    def __repr__(self):
+        return f"Worker({self.index}, pid {self.process.pid})"
+
+
+"""
+Runs matches in several worker processes, so they spread over every CPU core instead of
+sharing one interpreter lock. The supervisor keeps the lobby: it accepts every connection,
+does the handshake and matches players, then hands each room to the worker running the
+fewest. When a room closes, the worker sends back the players that want a rematch and the
+supervisor puts them at the front of its queue, as a single process would.
+
+Workers send their stats every REPORT_INTERVAL seconds. One that exits, or sends nothing
+for WORKER_TIMEOUT seconds, is restarted and its rooms are closed. snapshot() adds up the
+workers' last reports and the supervisor's own METRICS, so the counts of a worker that was
+restarted start again from 0.
+
+target: run in each worker process as target(index, connection, *args), where connection
+is the worker's end of the pipe to give to a SupervisorLink
+"""
+class Supervisor:
+    def __init__(self, count, target, args=()):
+        self.context = multiprocessing.get_context("spawn")  # workers start clean rather than copying the supervisor's threads
+        self.target = target
+        self.args = args
+
+        self.lock = threading.Lock()
+        self.workers = [self.start_worker(index) for index in range(count)]
+        self.restarts = 0
+        self.room_closed = None  # set by start()
+        self.spectators = []  # spectators waiting for a room to open, as detach() returns them
+
+    def start_worker(self, index) -> Worker:
+        ours, theirs = self.context.Pipe()
+
+        process = self.context.Process(target=self.target, args=(index, theirs, *self.args),
+                                       name=f"worker{index}", daemon=True)
+        process.start()
+        theirs.close()
+
+        logging.info(f"Started worker {index} with pid {process.pid}")
+
+        return Worker(index, process, ours)
+
+    """
+    Hands a room to the worker running the fewest. If it can't take the room, the next one
+    does. Spectators waiting for a room go along to watch it. The supervisor's copies of the
+    sockets are closed once a worker has them.
+
+    clients: the room's clients, as detach() returns them
+
+    Returns: the worker that runs the room, or None if none could
+    """
+    def start_room(self, room_id, clients):
+        with self.lock:
+            workers = sorted(self.workers, key=lambda worker: len(worker.rooms))
+
+        for worker in workers:
+            if worker.send((OPEN_ROOM, room_id, clients)):
+                break
+
+        else:
+            logging.error(f"No worker could take room {room_id}")
+            worker = None
+
+        close(clients)
+
+        if worker is None:
+            return None
+
+        with self.lock:
+            worker.rooms.add(room_id)
+            spectators, self.spectators = self.spectators, []
+
+        for spectator in spectators:
+            self.hand_spectator([worker], spectator)
+
+        return worker
+
+    """
+    Hands a spectator to the worker running the most rooms, or keeps it until a room opens.
+
+    client: as detach() returns it
+    """
+    def add_spectator(self, client) -> None:
+        with self.lock:
+            workers = sorted([worker for worker in self.workers if worker.rooms],
+                             key=lambda worker: len(worker.rooms), reverse=True)
+
+            if not workers:
+                self.spectators.append(client)
+                return
+
+        self.hand_spectator(workers, client)
+
+    def hand_spectator(self, workers, client) -> None:
+        if not any(worker.send((ADD_SPECTATOR, client)) for worker in workers):
+            logging.error("No worker could take a spectator")
+
+        close([client])
+
+    """
+    Handles everything the worker sent.
+
+    Returns: False once the worker's end of the pipe is closed
+    """
+    def read_messages(self, worker) -> bool:
+        try:
+            while worker.connection.poll():
+                kind, *message = worker.connection.recv()
+
+                if kind == STATS:
+                    worker.snapshot = message[0]
+                    worker.last_report = time.monotonic()
+
+                elif kind == ROOM_CLOSED:
+                    room_id, games_played, clients = message
+
+                    with self.lock:
+                        worker.rooms.discard(room_id)
+
+                    self.room_closed(room_id, games_played, clients)
+
+        except (EOFError, OSError):  # the worker exited
+            return False
+
+        return True
+
+    """
+    Handles the workers' messages as they arrive and restarts the workers that exited
+    or hung, forever
+    """
+    def monitor(self) -> None:
+        while True:
+            with self.lock:
+                workers = list(self.workers)
+
+            ready = multiprocessing.connection.wait([worker.connection for worker in workers], REPORT_INTERVAL)
+
+            for worker in workers:
+                closed = worker.connection in ready and not self.read_messages(worker)
+
+                if closed or not worker.process.is_alive():
+                    worker.process.join()
+                    reason = f"exited with code {worker.process.exitcode}"
+
+                elif time.monotonic() - worker.last_report > WORKER_TIMEOUT:
+                    reason = f"sent nothing for {WORKER_TIMEOUT} s"
+                    worker.process.kill()
+                    worker.process.join()
+
+                else:
+                    continue
+
+                logging.error(f"{worker} {reason}, restarting it")
+                worker.connection.close()
+
+                replacement = self.start_worker(worker.index)
+                self.restarts += 1
+
+                with self.lock:
+                    self.workers[worker.index] = replacement
+                    lost, worker.rooms = worker.rooms, set()
+
+                for room_id in lost:
+                    self.room_closed(room_id, None, [])
+
+    """
+    Starts handling the workers' messages in the background.
+
+    room_closed: called as room_closed(room id, games played, clients) when a worker closes a
+                 room, with the clients as detach() returns them. Rooms lost with a worker are
+                 closed with games played None and no clients.
+    """
+    def start(self, room_closed) -> None:
+        self.room_closed = room_closed
+        threading.Thread(target=self.monitor, daemon=True).start()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            workers = list(self.workers)
+
+        snapshot = merge_snapshots([METRICS.snapshot()] + [worker.snapshot for worker in workers])
+        snapshot["workers"] = {"running": sum(worker.process.is_alive() for worker in workers),
+                               "restarts": self.restarts}
+
+        return snapshot
+
+    def as_text(self) -> str:
+        return format_text(self.snapshot())
+
+
+"""
+Closes this process's copy of the clients' sockets, once they were sent to another process.
+
+clients: as detach() returns them
+"""
+def close(clients) -> None:
+    for client in clients:
+        client[0].close()
+
+
+"""
+A worker's end of the pipe to the supervisor. Rooms and the stats reporter send from
+different threads, so sends take turns.
+"""
+class SupervisorLink:
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    """
+    Waits for the supervisor's next message. Raises EOFError once the supervisor is gone.
+    """
+    def receive(self):
+        try:
+            return self.connection.recv()
+
+        except OSError:  # the supervisor closed its end with reports still unread
+            raise EOFError()
+
+    """
+    Returns: whether the supervisor got the message
+    """
+    def send(self, message) -> bool:
+        try:
+            with self.lock:
+                self.connection.send(message)
+
+            return True
+
+        except OSError:
+            return False
+
+    """
+    Sends the room's clients that are ready for another game back to the supervisor, then
+    closes the worker's copies of their sockets.
+
+    clients: as detach() returns them
+    """
+    def room_closed(self, room, clients) -> None:
+        if not self.send((ROOM_CLOSED, room.id, room.games_played, clients)):
+            logging.warning(f"The supervisor is gone, dropping the players of {room}")
+
+        close(clients)
+
+    """
+    Sends METRICS to the supervisor every REPORT_INTERVAL seconds until it is gone
+    """
+    def report(self) -> None:
+        while True:
+            time.sleep(REPORT_INTERVAL)
+
+            if not self.send((STATS, METRICS.snapshot())):
+                return
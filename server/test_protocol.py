@@ -0,0 +1,39 @@
+import unittest
+
+from protocol import CODECS, PROTOCOL_BINARY, PROTOCOL_JSON, MAX_BOARDS, DECODE_ERRORS
+
+
+"""
+Run from the server directory:
+    python -m unittest test_protocol
+"""
+class SnapshotTest(unittest.TestCase):
+    def round_trip(self, message, version=PROTOCOL_BINARY):
+        codec = CODECS[version]
+        encoded = codec.encode(message)
+
+        return codec.decode(encoded[codec.header_size:])
+
+    def test_long_snake_keyframe(self):
+        # About 20k cells, so the keyframe is longer than 65535 bytes
+        snapshot = ["N", [["K", 0, [1, 1], [1, 1, 1], [1, 1] * 20000], ["D", 1, 2, 3, 1]]]
+
+        self.assertEqual(self.round_trip(snapshot), snapshot)
+        self.assertEqual(self.round_trip(snapshot, PROTOCOL_JSON), snapshot)
+
+    def test_most_boards(self):
+        snapshot = ["N", [["D", 1, index % 20, 3, 0] for index in range(MAX_BOARDS)]]
+
+        self.assertEqual(self.round_trip(snapshot), snapshot)
+
+    def test_malformed_snapshot(self):
+        codec = CODECS[PROTOCOL_BINARY]
+
+        # Cut off length, empty frame, frame running past the end
+        for payload in (bytes([5, 1, 0, 0]), bytes([5, 1, 0, 0, 0, 0]), bytes([5, 1, 9, 0, 0, 0, 1])):
+            with self.assertRaises(DECODE_ERRORS):
+                codec.decode(payload)
+
+
+if __name__ == "__main__":
+    unittest.main()
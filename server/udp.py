@@ -0,0 +1,85 @@
+import logging
+import asyncio
+import secrets
+import weakref
+
+from protocol import DATAGRAM_SEQUENCE, MAX_DATAGRAM
+
+
+"""
+Sends snapshots to clients over UDP, see the UDP notes in protocol.py. A client is
+registered with a token when it asks for UDP in its hello, and gets datagrams once a
+datagram with its token arrived from its IP address.
+"""
+class UdpChannel(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.port = None
+        self.clients = weakref.WeakValueDictionary()  # token: client, forgotten when the client is gone
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.port = transport.get_extra_info("sockname")[1]
+
+    def datagram_received(self, data, address):
+        client = self.clients.get(data)
+
+        if client is None or address[0] != client.ip[0]:
+            return
+
+        if client.udp_address != address:
+            logging.info(f"Sending snapshots to {client} over UDP at {address}")
+            client.udp_address = address
+
+    def error_received(self, exc):
+        logging.debug(f"UDP error: {exc}")
+
+    """
+    Returns: the token the client has to send
+    """
+    def register(self, client) -> str:
+        token = secrets.token_hex(8)
+        self.clients[token.encode("ascii")] = client
+
+        return token
+
+    """
+    Sends a message to the clients that registered their address, encoding it once per codec.
+
+    Returns: the clients it wasn't sent to, because they haven't registered an address
+    or the message doesn't fit in a datagram
+    """
+    def send(self, clients, message) -> list:
+        encoded = {}  # codec: bytes
+        unsent = []
+
+        for client in clients:
+            if client.udp_address is None:
+                unsent.append(client)
+                continue
+
+            if client.codec not in encoded:
+                encoded[client.codec] = client.codec.encode(message)
+
+            data = encoded[client.codec]
+
+            if DATAGRAM_SEQUENCE.size + len(data) > MAX_DATAGRAM:
+                unsent.append(client)
+                continue
+
+            client.udp_sequence += 1
+            self.transport.sendto(DATAGRAM_SEQUENCE.pack(client.udp_sequence) + data, client.udp_address)
+
+            client.stats.frames_out += 1
+            client.stats.bytes_out += DATAGRAM_SEQUENCE.size + len(data)
+
+        return unsent
+
+
+async def start_udp(ip, port) -> UdpChannel:
+    loop = asyncio.get_running_loop()
+    _, channel = await loop.create_datagram_endpoint(UdpChannel, local_addr=(ip, port))
+
+    logging.info(f"Snapshots can be sent over UDP on port {channel.port}")
+
+    return channel